@@ -1,43 +1,157 @@
 # -*- coding: utf-8 -*-
 
+import argparse
+import os
+import numpy as np
 import pandas as pd
-import re
-
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 
 import config as c
+import instrumentation
+from incremental_scoring import PRScorer, count_shard, post_keys, score_shards
+from phrase_matcher import PhraseMatcher
+import sharding
+import token_table as tt
+
+# number of tokens read from the *_spacy.csv file at a time
+chunksize = 1000000
+
+def _join_lemmas(post_ids, lemmas):
+    # post_ids: post id of each token (the tokens of a post are consecutive), lemmas: lowercased lemma of each token
+    # returns the post ids and the lemmas of each post joined by " "
+    if len(post_ids) == 0:
+        return post_ids, []
+    starts = np.flatnonzero(np.concatenate([[True], post_ids[1:] != post_ids[:-1]]))
+    ends = np.append(starts[1:], len(post_ids))
+    return post_ids[starts], [" ".join(lemmas[start:end]) for start, end in zip(starts.tolist(), ends.tolist())]
+
+def iter_posts(posts_file_spacy, batch_size=10000):
+    # yields DataFrames (id, text = lowercased lemmas joined by " ") of batch_size posts, in the order of the tokens file
+    # reads only the post_id and lemma columns in chunks; relies on the tokens of each post being consecutive (as written
+    # by process_posts_with_spacy.py): the last post of a chunk is completed with the next chunk
+    if tt.exists(posts_file_spacy):
+        # lemma strings are only built (and lowercased) once per vocabulary item
+        batch = []
+        for post in tt.TokenTable(posts_file_spacy).lemma_texts(lowercase=True):
+            batch.append(post)
+            if len(batch) == batch_size:
+                yield pd.DataFrame(batch, columns=["id", "text"])
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=["id", "text"])
+        return
+
+    seen = set()
+    ids, texts = [], []
+    rest = None
+    for tokens in pd.read_csv(posts_file_spacy, usecols=["post_id", "lemma"], dtype={"lemma": str},
+                              keep_default_na=False, na_values=[], chunksize=chunksize):
+        if rest is not None:
+            tokens = pd.concat([rest, tokens])
+        post_ids = tokens.post_id.to_numpy()
+        if not len(post_ids):
+            # empty file (only the header)
+            continue
+        # the last post may continue in the next chunk
+        last = len(post_ids) - np.argmax(post_ids[::-1] != post_ids[-1]) if (post_ids != post_ids[-1]).any() else 0
+        rest = tokens.iloc[last:]
+        batch_ids, batch_texts = _join_lemmas(post_ids[:last], tokens.lemma.iloc[:last].str.lower().tolist())
+        ids.extend(batch_ids.tolist())
+        texts.extend(batch_texts)
+        while len(ids) >= batch_size:
+            yield _batch(ids[:batch_size], texts[:batch_size], seen)
+            ids, texts = ids[batch_size:], texts[batch_size:]
+    if rest is not None and len(rest):
+        batch_ids, batch_texts = _join_lemmas(rest.post_id.to_numpy(), rest.lemma.str.lower().tolist())
+        ids.extend(batch_ids.tolist())
+        texts.extend(batch_texts)
+    for start in range(0, len(ids), batch_size):
+        yield _batch(ids[start:start + batch_size], texts[start:start + batch_size], seen)
+
+def _batch(ids, texts, seen):
+    n_seen = len(seen)
+    seen.update(ids)
+    if len(seen) != n_seen + len(ids):
+        raise ValueError("The tokens of each post need to be consecutive in the tokens file")
+    return pd.DataFrame({"id": ids, "text": texts})
+
+def iter_phrase_posts(posts_file_spacy, matcher, batch_size=10000):
+    # batches of iter_posts with the PR phrases identified (column text_with_phrases) while the file is read
+    for batch in iter_posts(posts_file_spacy, batch_size):
+        yield add_PR_phrases(batch, matcher)
 
 # read spacy output and concatenate texts to tokenised version
-def read_posts(posts_file_spacy):
-    posts = pd.read_csv(posts_file_spacy, keep_default_na=False, na_values=[])
-
-    tokenised_posts = posts.groupby("post_id")["lemma"].apply(lambda x: " ".join(x)).reset_index(). \
-        rename(columns={"lemma": "text"})
-    # lowercase all posts
-    tokenised_posts["text"] = tokenised_posts.text.str.lower()
-    tokenised_posts.rename(columns={"post_id": "id"}, inplace=True)
-    print("Concatenated lemmas from %s" %posts_file_spacy)
+def read_posts(posts_file_spacy, matcher=None, shard=None, n_shards=None):
+    # matcher: PhraseMatcher, the PR phrases of each batch are identified before the next batch is read
+    # shard, n_shards: only keep the posts of hash shard i of n (see sharding.py)
+    batches = iter_posts(posts_file_spacy) if matcher is None else iter_phrase_posts(posts_file_spacy, matcher)
+    if n_shards is not None:
+        batches = (batch[sharding.shard_of(batch.id, n_shards) == shard] for batch in batches)
+    batches = list(batches)
+    # no posts: empty file
+    tokenised_posts = pd.concat(batches, ignore_index=True) if batches else \
+        pd.DataFrame({col: [] for col in ["id", "text"] + ([] if matcher is None else ["text_with_phrases"])})
+    # sorted by id (same order as grouping the tokens by post_id)
+    tokenised_posts = tokenised_posts.sort_values("id").reset_index(drop=True)
+    print("Concatenated lemmas from %s" %(tt.table_path(posts_file_spacy) if tt.exists(posts_file_spacy) else
+                                          posts_file_spacy))
     return tokenised_posts
 
+def concatenate_lemmas(posts):
+    # posts: tokens with the columns post_id and lemma, the tokens of each post consecutive
+    post_ids, texts = _join_lemmas(posts.post_id.to_numpy(), posts.lemma.astype(str).str.lower().tolist())
+    return pd.DataFrame({"id": post_ids, "text": texts}).sort_values("id").reset_index(drop=True)
+
+def read_shard_posts(posts_file_spacy, shard, n_shards):
+    # the posts of hash shard i of n (see sharding.py), from the shard file of process_posts_with_spacy.py --shard
+    # if it was tokenised with the same number of shards
+    shard_file = sharding.shard_file(sharding.shard_dir(posts_file_spacy, n_shards), shard)
+    if os.path.exists(shard_file):
+        print("Concatenated lemmas from %s" %shard_file)
+        return concatenate_lemmas(pd.read_csv(shard_file, keep_default_na=False, na_values=[]))
+    return read_posts(posts_file_spacy, shard=shard, n_shards=n_shards)
+
 # identify PR phrases in lemmatised posts
-def identify_PR_phrases(tokenised_posts, PR_terms):
-    PR_terms = pd.read_csv(PR_terms_file)
-
-    def replace_phrases(text, terms):
-        for term, replacement in zip(terms.term, terms.replacement):
-            # only match single terms, do not need re.IGNORECASE because lowercased both the post and the terms
-            text = re.sub(r"\b%s(?!\S)" % re.escape(term), replacement, text)
-        # print(text)
-        return text
-    tokenised_posts["text_with_phrases"] = tokenised_posts.text.apply(lambda x: replace_phrases(x, PR_terms))
+@instrumentation.instrument("identify_PR_phrases")
+def identify_PR_phrases(tokenised_posts, PR_terms_file):
+    return add_PR_phrases(tokenised_posts, PhraseMatcher.from_csv(PR_terms_file))
+
+def add_PR_phrases(tokenised_posts, matcher):
+    # matches all PR terms in one pass over each post, same result as one re.sub per term (see phrase_matcher.py)
+    tokenised_posts["text_with_phrases"] = tokenised_posts.text.apply(matcher.replace)
     return tokenised_posts
 
 def process_spacy_output(posts_file, PR_terms_file, outfile):
-    tokenised_posts = identify_PR_phrases(read_posts(posts_file), PR_terms_file)
-    print("Identified PR term phrases in %d posts\nNow writing to %s" % (len(tokenised_posts), outfile))
-    tokenised_posts.to_csv(outfile)
-    return tokenised_posts
+    # the PR phrases are identified batch by batch while the tokens are read, each batch is written to outfile before
+    # the next one is read, so the posts are not held in memory (read outfile for score_posts)
+    # returns the number of posts
+    staging = outfile + ".tmp"
+    n_posts = 0
+    # outfile is sorted by id as read_posts: the batches are written as they are if the tokens file is sorted by post id
+    last_id = None
+    ordered = True
+    with instrumentation.stage("identify_PR_phrases") as stage:
+        for batch in iter_phrase_posts(posts_file, PhraseMatcher.from_csv(PR_terms_file)):
+            ids = batch.id.to_numpy()
+            ordered = ordered and (last_id is None or ids[0] > last_id) and bool((np.diff(ids) > 0).all())
+            last_id = ids[-1]
+            batch.index = range(n_posts, n_posts + len(batch))
+            batch.to_csv(staging, mode="a" if n_posts else "w", header=not n_posts)
+            n_posts += len(batch)
+        if not n_posts:
+            pd.DataFrame({col: [] for col in ["id", "text", "text_with_phrases"]}).to_csv(staging)
+        if not ordered:
+            print("The posts of %s are not sorted by id, sorting %s" %(posts_file, outfile))
+            posts = pd.read_csv(staging, index_col=0, keep_default_na=False, na_values=[])
+            posts.sort_values("id").reset_index(drop=True).to_csv(staging)
+        os.replace(staging, outfile)
+        stage.set_rows(n_posts)
+    print("Concatenated lemmas from %s" %(tt.table_path(posts_file) if tt.exists(posts_file) else posts_file))
+    print("Identified PR term phrases in %d posts, wrote them to %s" % (n_posts, outfile))
+    return n_posts
+
+def read_phrase_posts(fname):
+    # the output of process_spacy_output
+    return pd.read_csv(fname, index_col=0, keep_default_na=False, na_values=[])
 
 def to_tfidf(series, vectorizer):
     # default analyzer splits at space and only retains tokens of at least 2 characters
@@ -51,7 +165,12 @@ def to_tfidf(series, vectorizer):
 
     return vectors
 
+@instrumentation.instrument("score_posts")
 def score_posts(posts, terms_file):
+    # sklearn is imported here, so that importing this module (e.g. in pipeline.py) does not load it
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.metrics.pairwise import cosine_similarity
+
     vectorizer = TfidfVectorizer(tokenizer=lambda x: x.split())
 
     post_vectors = to_tfidf(posts["text_with_phrases"], vectorizer)
@@ -78,26 +197,147 @@ def score_posts(posts, terms_file):
     posts_PR_scored = pd.concat([posts, post_PR_scores_df], axis=1)
     return posts_PR_scored
 
+@instrumentation.instrument("score_posts_incremental")
+def score_posts_incremental(posts, terms_file, state_dir, batch_size=10000, tolerance=0.01):
+    # same scores as score_posts, but posts whose ids are already in state_dir are not vectorised again
+    # and only the posts affected by the idf changes are rescored (see incremental_scoring.py)
+    batches = (posts.iloc[start:start + batch_size] for start in range(0, len(posts), batch_size))
+    return score_batches_incremental(batches, terms_file, state_dir, tolerance)
+
+def score_batches_incremental(batches, terms_file, state_dir, tolerance=0.01):
+    # batches: DataFrames with the columns id and text_with_phrases, e.g. from iter_posts, so scoring starts before
+    # all posts are read
+    scorer = PRScorer(state_dir, terms_file)
+    stored = scorer.keys()
+    posts = []
+    keys = []
+    n_new = 0
+    for batch in batches:
+        posts.append(batch)
+        batch_keys = post_keys(batch.id, batch.text_with_phrases)
+        keys.append(batch_keys)
+        new = ~batch_keys.isin(stored)
+        if new.any():
+            scorer.add_batch(batch.id[new], batch.text_with_phrases[new])
+            n_new += int(new.sum())
+    posts = pd.concat(posts, ignore_index=True)
+    print("%d of %d posts are new" %(n_new, len(posts)))
+    scorer.retain(keys[0].append(keys[1:]) if keys else post_keys([], []))
+    scorer.rescore(tolerance)
+
+    posts_PR_scored = posts.merge(scorer.scores(), left_on="id", right_on="id", how="left")
+    print(posts_PR_scored[["PR"]].describe())
+    print("%d posts have non-zero PR score" %len(posts_PR_scored[posts_PR_scored.PR > 0]))
+    return posts_PR_scored
+
+@instrumentation.instrument("process_and_score_incremental")
+def process_and_score_incremental(posts_file, PR_terms_file, outfile, state_dir, batch_size=10000, tolerance=0.01):
+    # streaming version of process_spacy_output + score_posts_incremental: the PR phrases of each batch of posts are
+    # identified and its terms counted while the tokens file is read
+    batches = iter_phrase_posts(posts_file, PhraseMatcher.from_csv(PR_terms_file), batch_size)
+    posts_PR_scored = score_batches_incremental(batches, PR_terms_file, state_dir, tolerance)
+    posts_PR_scored = posts_PR_scored.sort_values("id").reset_index(drop=True)
+    print("Identified PR term phrases in %d posts\nNow writing to %s" % (len(posts_PR_scored), outfile))
+    posts_PR_scored[["id", "text", "text_with_phrases"]].to_csv(outfile)
+    return posts_PR_scored
+
+def add_post_metadata(posts_PR_scored, posts_meta):
+    # add metadata to the scored posts and use the original text (rather than tokenised + lemmatised via spacy)
+    posts_PR_scored = posts_PR_scored.drop(labels="text", axis=1)
+    posts_meta = posts_meta[["id", "user_id", "subreddit_name", "text_wordcount", "text"]]
+    posts_PR_scored = posts_PR_scored.merge(posts_meta, left_on="id", right_on="id", how="left")
+    return posts_PR_scored[["id", "user_id", "subreddit_name", "text_wordcount", "text", "text_with_phrases",
+                            "PR"]].sort_values(by="PR", ascending=False)
+
+def write_scored_posts(posts_PR_scored, posts_meta_file, outfile):
+    posts_meta = pd.read_csv(posts_meta_file, usecols=["id", "user_id", "subreddit_name", "text_wordcount",
+                                                       "text"], keep_default_na=False, na_values=[])
+    posts_PR_scored = add_post_metadata(posts_PR_scored, posts_meta)
+    posts_PR_scored.to_csv(outfile)
+    return posts_PR_scored
+
+def score_shard(posts_file, PR_terms_file, directory, shard, n_shards):
+    # identify the PR phrases in the posts of a hash shard and count their terms (the idf needs all shards)
+    with instrumentation.stage("score_shard", shard=shard, n_shards=n_shards) as stage:
+        tokenised_posts = identify_PR_phrases(read_shard_posts(posts_file, shard, n_shards), PR_terms_file)
+        os.makedirs(directory, exist_ok=True)
+        tokenised_posts.to_csv(sharding.shard_file(directory, shard, "phrases.csv") + ".tmp", index=False)
+        os.replace(sharding.shard_file(directory, shard, "phrases.csv") + ".tmp",
+                   sharding.shard_file(directory, shard, "phrases.csv"))
+        count_shard(directory, shard, tokenised_posts.id, tokenised_posts.text_with_phrases)
+        stage.set_rows(len(tokenised_posts))
+
+def merge_scored_shards(directory, n_shards, PR_terms_file, phrases_outfile, scored_outfile, posts_meta_file):
+    # same output files as scoring all posts at once: posts sorted by id (order of read_posts), scored with the idf of
+    # all shards
+    with instrumentation.stage("merge_scored_shards", n_shards=n_shards) as stage:
+        tokenised_posts = pd.concat([pd.read_csv(sharding.shard_file(directory, shard, "phrases.csv"),
+                                                 keep_default_na=False, na_values=[]) for shard in range(n_shards)])
+        tokenised_posts = tokenised_posts.sort_values("id").reset_index(drop=True)
+        tokenised_posts.to_csv(phrases_outfile)
+        posts_PR_scored = tokenised_posts.merge(score_shards(directory, n_shards, PR_terms_file), left_on="id",
+                                                right_on="id", how="left")
+        print(posts_PR_scored[["PR"]].describe())
+        print("%d posts have non-zero PR score" %len(posts_PR_scored[posts_PR_scored.PR > 0]))
+        stage.set_rows(len(posts_PR_scored))
+        return write_scored_posts(posts_PR_scored, posts_meta_file, scored_outfile)
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="PR scoring of the lemmatised BD posts")
+    parser.add_argument("-s", "--state_dir", help="Score incrementally: keep term counts and document frequencies in "
+                                                  "this directory and only vectorise posts that are not in it yet",
+                        type=str, required=False, default=None)
+    parser.add_argument("-t", "--tolerance", help="Incremental scoring: only rescore posts with a term whose idf "
+                                                  "drifted by more than this fraction; the other scores are computed "
+                                                  "with idfs within 2 x tolerance of the current ones (0: exact)",
+                        type=float, required=False, default=0.01)
+    parser.add_argument("--shard", help="Only identify the phrases in and count the terms of hash shard i of N posts "
+                                        "(i/N, see sharding.py); score the posts with --merge N",
+                        type=str, required=False, default=None)
+    parser.add_argument("--queue", help="Process hash shards of N posts from the work queue until all are processed, "
+                                        "then merge and score them (start one worker per machine/process)",
+                        type=int, required=False, default=None)
+    parser.add_argument("--merge", help="Score the posts of the N processed hash shards with the idf of all shards",
+                        type=int, required=False, default=None)
+    parser.add_argument("--lease", help="Work queue: seconds after which a claimed shard that was not processed is "
+                                        "claimed again (crashed worker)",
+                        type=float, required=False, default=None)
+    args = parser.parse_args()
+
     posts_file = c.data + "posts_bd_spacy.csv"
     PR_terms_file = c.data + "PR_terms.csv"
     filename_posts_with_PR_phrases = c.data + "posts_bd_spacy_phrases.csv"
     filename_posts_scored = c.data + "posts_bd_PR_scored.csv"
     posts_meta_file = c.data + "posts_bd.csv"
 
-    # identify multiword phrases in lemmatised posts, write to filename_posts_with_PR_phrases
-    tokenised_posts = process_spacy_output(posts_file, PR_terms_file, filename_posts_with_PR_phrases)
+    n_shards = sharding.parse_shard(args.shard)[1] if args.shard else args.queue or args.merge
+    if n_shards:
+        directory = sharding.shard_dir(filename_posts_scored, n_shards)
+        if args.shard:
+            score_shard(posts_file, PR_terms_file, directory, *sharding.parse_shard(args.shard))
+        elif args.queue:
+            queue = sharding.WorkQueue(os.path.join(directory, "queue"), n_shards, args.lease)
+            sharding.run_queue(queue, lambda shard: score_shard(posts_file, PR_terms_file, directory, shard, n_shards),
+                               lambda: merge_scored_shards(directory, n_shards, PR_terms_file,
+                                                           filename_posts_with_PR_phrases, filename_posts_scored,
+                                                           posts_meta_file))
+        else:
+            merge_scored_shards(directory, n_shards, PR_terms_file, filename_posts_with_PR_phrases,
+                                filename_posts_scored, posts_meta_file)
+    elif args.state_dir:
+        # read the tokens, identify the phrases and count the terms of the posts in batches
+        posts_PR_scored = process_and_score_incremental(posts_file, PR_terms_file, filename_posts_with_PR_phrases,
+                                                        args.state_dir, tolerance=args.tolerance)
+        print("Finished scoring, writing to %s" %(filename_posts_scored))
+        write_scored_posts(posts_PR_scored, posts_meta_file, filename_posts_scored)
+    else:
+        # identify multiword phrases in lemmatised posts, write to filename_posts_with_PR_phrases (streamed, batch by
+        # batch)
+        process_spacy_output(posts_file, PR_terms_file, filename_posts_with_PR_phrases)
 
-    # already concatenated spacy lemmas
-    # tokenised_posts = pd.read_csv(filename_posts_with_PR_phrases, keep_default_na=False, na_values=[])
+        # the posts are only read at once for the tf-idf vectors of all posts
+        tokenised_posts = read_phrase_posts(filename_posts_with_PR_phrases)
 
-    posts_PR_scored = score_posts(tokenised_posts, PR_terms_file)
-    print("Finished scoring, writing to %s" %(filename_posts_scored))
-
-    # add metadata to the scored posts and use the original text (rather than tokenised + lemmatised via spacy)
-    posts_PR_scored.drop(labels="text", axis=1, inplace=True)
-    posts_meta = pd.read_csv(c.data + "posts_bd.csv", usecols=["id", "user_id", "subreddit_name", "text_wordcount",
-                                                               "text"], keep_default_na=False, na_values=[])
-    posts_PR_scored = posts_PR_scored.merge(posts_meta, left_on="id", right_on="id", how="left")
-    posts_PR_scored[["id", "user_id", "subreddit_name", "text_wordcount", "text", "text_with_phrases", "PR"]].\
-        sort_values(by="PR", ascending=False).to_csv(filename_posts_scored)
\ No newline at end of file
+        posts_PR_scored = score_posts(tokenised_posts, PR_terms_file)
+        print("Finished scoring, writing to %s" %(filename_posts_scored))
+        write_scored_posts(posts_PR_scored, posts_meta_file, filename_posts_scored)
\ No newline at end of file
@@ -1,21 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# replaces the original post ids in files derived from the dataset by the ids of post_id_mapping.csv (original_id ->
+# id) and optionally user ids/names by the ids of a user mapping (user_id_mapping.csv, original_id -> id)
+# the mappings are looked up in sorted memory-mapped arrays (id_index.py, built from the mapping files on the first
+# run), csv files are read and written in chunks, so the memory needed does not depend on the size of the files or
+# of the mappings (a pickle is read at once)
+# with --scrub, usernames (u/name, /u/name and the names in --usernames) and URLs in the text columns are replaced by
+# [USER] and [URL], matched by one compiled pattern (the names in --usernames by a character trie, see phrase_matcher.py)
+# several files are processed in parallel (-p)
+# output: <file>.csv (replaces a csv input file when it is complete), ids that are not in the mapping are empty
+#
+# python anonymise_posts.py posts_users.pkl
+# python anonymise_posts.py posts_users.pkl posts_text.csv --user_columns user_id --scrub text -p 2
+
+import argparse
+import multiprocessing
+import os
+import re
+
 import pandas as pd
-import sys
 
-post_id_mapping = pd.read_csv("/mnt/dhr/datasets/reddit-bipolar-diagnosis/posts/post_id_mapping.csv")
-post_id_map = dict(zip(post_id_mapping.original_id, post_id_mapping.id))
+import id_index as ix
+import instrumentation
+import phrase_matcher
+
+mapping_file = "/mnt/dhr/datasets/reddit-bipolar-diagnosis/posts/post_id_mapping.csv"
+
+url_pattern = r"(?:https?://|www\.)[^\s<>()\[\]]+"
+user_pattern = r"(?<![\w/])/?u/[\w-]+"
+
+def scrub_pattern(usernames=()):
+    # one pattern for URLs and usernames, the group that matched (url/user) gives the replacement
+    users = [user_pattern]
+    if len(usernames):
+        # a name is not matched by a shorter name it starts with: the trie tries the longer continuation first
+        users.append(r"(?<![\w/])%s(?![\w-])" %phrase_matcher.trie_pattern(set(usernames)))
+    return re.compile(r"(?P<url>%s)|(?P<user>%s)" %(url_pattern, "|".join(users)), re.IGNORECASE)
+
+def _replacement(match):
+    return "[URL]" if match.lastgroup == "url" else "[USER]"
+
+def scrub(texts, pattern):
+    return texts.str.replace(pattern, _replacement, regex=True)
+
+def anonymise(posts, post_id_columns=("id",), user_columns=(), text_columns=(), pattern=None):
+    for col in post_id_columns:
+        posts[col] = ix.map_original_ids(posts[col]).astype("Int64")
+    for col in user_columns:
+        posts[col] = ix.map_original_ids(posts[col], ix.user_mapping_index).astype("Int64")
+    for col in text_columns:
+        posts[col] = scrub(posts[col], pattern)
+    return posts
 
-fname = sys.argv[1] # "posts_users.pkl"
+def _chunks(fname, columns, chunksize):
+    if os.path.splitext(fname)[1] == ".pkl":
+        posts = pd.read_pickle(fname)
+        return (posts.iloc[start:start + chunksize].copy() for start in range(0, max(len(posts), 1), chunksize))
+    # ids as strings, as in the mapping index
+    return pd.read_csv(fname, dtype={col: str for col in columns}, chunksize=chunksize)
 
-fname_base = fname.split(".")[0]
-fname_type = fname.split(".")[1]
+def anonymise_file(fname, post_id_columns=("id",), user_columns=(), text_columns=(), usernames=(), chunksize=10 ** 6):
+    outfile = os.path.splitext(fname)[0] + ".csv"
+    staging = "%s.staging-%d" %(outfile, os.getpid())
+    pattern = scrub_pattern(usernames) if text_columns else None
+    rows = 0
+    try:
+        with instrumentation.stage("anonymise_file", file=fname) as progress:
+            for chunk in _chunks(fname, list(post_id_columns) + list(user_columns), chunksize):
+                # columns that are not in the file are skipped, e.g. a file without texts
+                anonymise(chunk, [col for col in post_id_columns if col in chunk.columns],
+                          [col for col in user_columns if col in chunk.columns],
+                          [col for col in text_columns if col in chunk.columns], pattern)
+                chunk.to_csv(staging, mode="a" if rows else "w", header=not rows, index=False)
+                rows += len(chunk)
+                progress.add_rows(len(chunk))
+    except BaseException:
+        if os.path.exists(staging):
+            os.remove(staging)
+        raise
+    os.replace(staging, outfile)
+    print("Anonymised %d rows of %s -> %s" %(rows, fname, outfile))
+    return rows
 
-print(fname_base, fname_type)
+def _read_usernames(fname):
+    if fname is None:
+        return []
+    with open(fname, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
 
-if fname_type == "pkl":
-    posts = pd.read_pickle(fname)
-elif fname_type == "csv":
-    posts = pd.pread_csv(fname)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replace original post ids (and user ids/names) by the ids of the "
+                                                 "mappings, optionally scrub usernames and URLs from texts")
+    parser.add_argument("files", nargs="+", help="csv or pkl files, e.g. posts_users.pkl")
+    parser.add_argument("-m", "--mapping", default=mapping_file, help="post_id_mapping.csv (original_id -> id), only "
+                                                                       "read if the mapping index does not exist yet")
+    parser.add_argument("--user_mapping", help="user_id_mapping.csv (original_id -> id) of user ids/names")
+    parser.add_argument("--post_id_columns", nargs="*", default=["id"], help="Columns with original post ids")
+    parser.add_argument("--user_columns", nargs="*", default=[], help="Columns with original user ids/names")
+    parser.add_argument("--scrub", nargs="*", default=[], help="Text columns to scrub usernames and URLs from")
+    parser.add_argument("--usernames", help="File with usernames to scrub (one per line)")
+    parser.add_argument("-p", "--processes", type=int, default=1, help="Files processed in parallel")
+    parser.add_argument("--chunksize", type=int, default=10 ** 6)
+    args = parser.parse_args()
 
-posts["id"] = posts.id.map(post_id_map)
+    # the mappings are indexed once (see id_index.py), the processes share the memory-mapped index
+    if args.post_id_columns and not ix.mapping_available():
+        ix.build_mapping(args.mapping)
+    if args.user_columns and not ix.mapping_available(ix.user_mapping_index):
+        if args.user_mapping is None:
+            parser.error("--user_columns needs --user_mapping (or python id_index.py --user_mapping)")
+        ix.build_mapping(args.user_mapping, ix.user_mapping_index)
 
-posts.to_csv(fname_base + ".csv", index=False)
\ No newline at end of file
+    tasks = [(fname, args.post_id_columns, args.user_columns, args.scrub, _read_usernames(args.usernames),
+              args.chunksize) for fname in args.files]
+    if args.processes == 1:
+        for task in tasks:
+            anonymise_file(*task)
+    else:
+        with multiprocessing.Pool(min(args.processes, len(tasks))) as pool:
+            pool.starmap(anonymise_file, tasks)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# balances a corpus by capping the number of posts per user (and optionally per subreddit)
+# the posts are sampled without replacement by bottom-k reservoirs: each post id gets a pseudo-random priority (a
+# hash of the id and the seed, see sharding.mix), each reservoir keeps the cap posts of its group with the lowest
+# priorities
+# - one pass over a stream of (post id, user id, subreddit) chunks, the reservoirs hold at most users x cap posts
+# - reproducible: the sample only depends on the post ids, the seed and the cap, not on the order or chunking of the
+#   stream (the same post ids are selected from the token file, the posts file or a shard of it)
+# - with a subreddit cap, the posts that remain after the user cap are capped per subreddit (by the same priorities)
+# output: the ids of the selected posts (data/<name>_post_ids.csv, post_ids/ only holds the published post ids), the
+# tokens/posts of the selected posts are looked up by id (id_index.py if the file is indexed, PostRows for a DataFrame
+# in memory)
+#
+# python balancing.py data/posts_contain_recover_content_term.csv --cap 540 --users 1629 -o posts_recover_corpus_own_sampling_post_ids.csv --select
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import config as c
+import instrumentation
+import select_posts_via_ids as sp
+import sharding
+
+# added to the seed before it is mixed: mix(0) is 0, so without it seed 0 would give the priorities of the hash shards
+# (sharding.shard_of) and the sample would depend on the shard of a post
+seed_offset = np.uint64(0x9e3779b97f4a7c15)
+
+def priorities(ids, seed=0):
+    # pseudo-random priority (uint64) of each post id
+    with np.errstate(over="ignore"):
+        key = sharding.mix(np.array([seed], dtype=np.uint64) + seed_offset)[0]
+    return sharding.mix(np.asarray(ids).astype(np.uint64) ^ key)
+
+def _cap(posts, column, cap, capped=None):
+    # keeps the cap posts with the lowest priorities per value of column (only the values in capped, if given)
+    posts = posts.sort_values([column, "priority"], kind="mergesort")
+    keep = posts.groupby(column, sort=False).cumcount().to_numpy() < cap
+    if capped is not None:
+        keep |= ~posts[column].isin(capped).to_numpy()
+    return posts[keep]
+
+def cap_posts(chunks, cap, seed=0, users=None, subreddit_cap=None, user_column="user_id",
+              subreddit_column="subreddit_name"):
+    # chunks: DataFrames with an id and user column (and subreddit column with subreddit_cap), several rows per post
+    # (e.g. tokens) are counted once
+    # users: only cap the posts of these users, all posts of the other users are kept
+    # returns the selected posts (id, user, subreddit column) sorted by id
+    columns = ["id", user_column] + ([subreddit_column] if subreddit_cap is not None else [])
+    kept = pd.DataFrame({col: [] for col in columns + ["priority"]})
+    with instrumentation.stage("cap_posts", total=None, cap=cap, seed=seed) as progress:
+        for chunk in chunks:
+            progress.add_rows(len(chunk))
+            chunk = chunk[columns].drop_duplicates("id")
+            chunk = chunk.assign(priority=priorities(chunk.id, seed))
+            # a post of several chunks has the same priority in each chunk, so it is either kept once or dropped
+            kept = pd.concat([kept, chunk], ignore_index=True).drop_duplicates("id") if len(kept) else chunk
+            kept = _cap(kept, user_column, cap, users)
+        if subreddit_cap is not None:
+            kept = _cap(kept, subreddit_column, subreddit_cap)
+        progress.fields["posts"] = len(kept)
+    print("Selected %d posts (at most %d per user%s)" %(len(kept), cap, "" if subreddit_cap is None else
+                                                        ", %d per subreddit" %subreddit_cap))
+    return kept.drop(columns="priority").sort_values("id").reset_index(drop=True)
+
+def write_post_ids(posts, outfile):
+    posts[["id"]].to_csv(c.data + outfile, index=False)
+    print("Wrote %d post ids to %s%s" %(len(posts), c.data, outfile))
+
+class PostRows(object):
+    # rows of each post id of a DataFrame (e.g. tokens, several rows per post): built with one sort, the rows of a
+    # set of posts are then looked up by binary search instead of an isin over all rows
+
+    def __init__(self, ids):
+        ids = np.asarray(ids)
+        self.order = np.argsort(ids, kind="stable")
+        sorted_ids = ids[self.order]
+        starts = np.flatnonzero(np.concatenate([[True], sorted_ids[1:] != sorted_ids[:-1]])) if len(ids) else \
+            np.zeros(0, dtype=np.int64)
+        self.ids = sorted_ids[starts]
+        self.offsets = np.concatenate([starts, [len(ids)]]).astype(np.int64)
+
+    def rows(self, ids):
+        # ascending rows of the posts with the given ids (ids that do not occur are ignored)
+        ids = np.unique(np.asarray(ids))
+        positions = np.searchsorted(self.ids, ids).clip(0, max(len(self.ids) - 1, 0))
+        positions = positions[self.ids[positions] == ids] if len(self.ids) else positions[:0]
+        starts, ends = self.offsets[positions], self.offsets[positions + 1]
+        lengths = ends - starts
+        # start + 0, ..., start + length - 1 of each post
+        within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return np.sort(self.order[np.repeat(starts, lengths) + within])
+
+    def select(self, frame, ids):
+        return frame.iloc[self.rows(ids)]
+
+def read_posts(fname, subreddit_cap=None, chunksize=10 ** 6):
+    columns = ["id", "user_id"] + (["subreddit_name"] if subreddit_cap is not None else [])
+    return pd.read_csv(fname, usecols=columns, chunksize=chunksize, keep_default_na=False, na_filter=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cap the number of posts per user (and subreddit) by seeded "
+                                                 "reservoir sampling")
+    parser.add_argument("posts", help="CSV file with id and user_id columns (and subreddit_name), e.g. posts or tokens")
+    parser.add_argument("--cap", type=int, required=True, help="Maximum number of posts per user")
+    parser.add_argument("--users", type=int, nargs="+", help="Only cap the posts of these users")
+    parser.add_argument("--subreddit_cap", type=int, help="Maximum number of posts per subreddit")
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    parser.add_argument("-o", "--outfile", required=True, help="Post ids file in data/, *_post_ids.csv")
+    parser.add_argument("--select", action="store_true",
+                        help="Also write the rows of the selected posts to data/ (file name without _post_ids)")
+    parser.add_argument("--chunksize", type=int, default=10 ** 6)
+    args = parser.parse_args()
+
+    posts = cap_posts(read_posts(args.posts, args.subreddit_cap, args.chunksize), args.cap, args.seed, args.users,
+                      args.subreddit_cap)
+    write_post_ids(posts, args.outfile)
+    if args.select:
+        # by the id index of the file if available (id_index.py), otherwise in one streaming pass
+        selected = sp.read_selected(args.posts, ids=posts.id, keep_default_na=False, na_filter=False)
+        outfile = c.data + "_".join(args.outfile.split("_")[:-2]) + ".csv"
+        selected.to_csv(outfile, index=False)
+        print("Wrote %d rows to %s" %(len(selected), outfile))
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+
+# benchmark of the pipeline stages on synthetic data in the format of the S-BiDD dataset
+# generate: writes posts_meta.csv, posts_text.csv and the post id files for n posts to a working directory
+#   - number of words per post: log-normal (median ~60 words, long tail)
+#   - posts per user: Zipf distributed, plus one user (1629) with a disproportionately large share of the posts
+#   - subreddits: the BD subreddits in data/bipolar-subreddits.txt and other (mental health) subreddits
+#   - texts: words drawn from a Zipf-distributed vocabulary that contains the PR terms and *recover* terms, a share
+#     of the posts use PR terms more often
+# run: runs each stage in a separate process in the working directory and appends one json line per stage
+#   (commit, number of posts, wall time, peak memory = maximum resident set size during the stage, output rows, status)
+#   to the results file, so the results of different commits can be compared
+# if the spacy language model is not installed, the tokens for the later stages are generated with a whitespace
+# tokeniser (stage synthetic_tokens) and nlp_preprocess_posts is recorded as failed
+#
+# python benchmark.py run -n 10000 100000
+# python benchmark.py compare <commit> <other commit>
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+
+import config as c
+import instrumentation
+
+repo = os.path.dirname(os.path.abspath(__file__))
+results_file = os.path.join(repo, "output", "benchmark.jsonl")
+work_dir = os.path.join(repo, c.data, "benchmark")
+
+# user with disproportionally many posts (see step 3 in build_recover_corpus.py) and share of all posts
+superuser = 1629
+superuser_share = 0.03
+
+other_subreddits = ["depression", "anxiety", "mentalhealth", "BPD", "ADHD", "schizophrenia", "AskReddit",
+                    "relationships", "CasualConversation", "offmychest", "Advice", "books", "running", "fitness"]
+common_words = ["i", "the", "to", "and", "a", "my", "it", "of", "that", "is", "in", "me", "have", "for", "but", "was",
+                "not", "this", "just", "be", "so", "with", "you", "on", "feel", "like", "do", "am", "'m", "n't", "when",
+                "get", "about", "or", "all", "what", "know", "been", "can", "if", "out", "up", "at", "time", "really",
+                "now", "are", "one", "would", "they", "he", "she", "because", "go", "think", "people", "day", "want",
+                "how", "even", "more", "going", "life", "much", "had", "things", "back", "still", "mood", "meds",
+                "doctor", "sleep", "work", "help", "manic", "depressed", "lithium", "anxiety", "better", "bad",
+                "good", "years", "never", "always", "something", "anyone", "else", "week", "month", "friends",
+                "family", "Bipolar", "I", "It", "My", "The", "Recovery", "?", "!", ","]
+recover_words = ["recovery", "recover", "recovering", "recovered", "Recovery", "unrecoverable", "recovery-"]
+
+stages = ["select_posts", "select_bd_posts", "nlp_preprocess_posts", "identify_PR_phrases", "score_posts",
+          "write_corpora", "keyness", "build_recover_corpus_step_1", "build_recover_corpus_step_2",
+          "build_recover_corpus_step_3", "build_recover_corpus_select_post_to_code"]
+
+def vocabulary(n_rare_words=20000, seed=0):
+    # Zipf-distributed vocabulary: common words, PR terms, *recover* terms and a long tail of rare (pseudo) words
+    rng = np.random.default_rng(seed)
+    PR_terms = pd.read_csv(os.path.join(repo, c.data, "PR_terms.csv"), keep_default_na=False, na_filter=False).term
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    rare_words = ["".join(rng.choice(letters, size=rng.integers(3, 12))) for _ in range(n_rare_words)]
+    words = common_words + recover_words + rare_words
+    probabilities = 1 / np.arange(1, len(words) + 1) ** 1.1
+    # *recover* terms in ~5% of the posts
+    probabilities[len(common_words):len(common_words) + len(recover_words)] = 0.0002
+    return np.array(words, dtype=object), probabilities / probabilities.sum(), np.array(PR_terms, dtype=object)
+
+def _texts(rng, n_words, words, probabilities, PR_terms, PR_share):
+    # texts with n_words word slots each, PR_share of the slots of PR posts are PR terms (which can have several words)
+    total = int(n_words.sum())
+    slots = words[rng.choice(len(words), size=total, p=probabilities)]
+    is_PR = rng.random(total) < PR_share
+    slots[is_PR] = PR_terms[rng.integers(0, len(PR_terms), size=is_PR.sum())]
+    # end of sentence after ~1 in 15 words
+    slots[rng.random(total) < 1 / 15] += " ."
+    ends = np.cumsum(n_words)
+    return [" ".join(slots[start:end]) for start, end in zip(np.concatenate([[0], ends[:-1]]), ends)]
+
+def generate(n_posts, directory, seed=0, chunksize=100000):
+    # writes data/posts_meta.csv, data/posts_text.csv and post_ids/*_post_ids.csv to directory
+    rng = np.random.default_rng(seed)
+    for subdir in ["data", "post_ids", "output", "exploratory_study_2"]:
+        os.makedirs(os.path.join(directory, subdir), exist_ok=True)
+    for fname in ["PR_terms.csv", "bipolar-subreddits.txt"]:
+        shutil.copy(os.path.join(repo, c.data, fname), os.path.join(directory, "data", fname))
+    shutil.copy(os.path.join(repo, "exploratory_study_2", "recover_content_terms.csv"),
+                os.path.join(directory, "exploratory_study_2", "recover_content_terms.csv"))
+
+    words, probabilities, PR_terms = vocabulary(seed=seed)
+    bd_subreddits = pd.read_csv(os.path.join(repo, c.data, "bipolar-subreddits.txt"), header=None).iloc[:, 0].tolist()
+    subreddits = np.array(bd_subreddits + other_subreddits, dtype=object)
+    subreddit_types = np.array(["bd"] * len(bd_subreddits) + ["mh"] * 6 + ["other"] * (len(other_subreddits) - 6),
+                               dtype=object)
+    # ~40% of the posts in BD subreddits
+    subreddit_probabilities = np.concatenate([np.full(len(bd_subreddits), 0.4 / len(bd_subreddits)),
+                                              np.full(len(other_subreddits), 0.6 / len(other_subreddits))])
+
+    # Zipf distributed posts per user, user 1629 has superuser_share of the posts
+    n_users = max(50, n_posts // 15)
+    user_ids = np.arange(2, n_users + 2)
+    user_ids[user_ids >= superuser] += 1
+    user_ids[0] = superuser
+    user_probabilities = 1 / np.arange(1, n_users + 1) ** 1.2
+    user_probabilities[0] = 0
+    user_probabilities *= (1 - superuser_share) / user_probabilities.sum()
+    user_probabilities[0] = superuser_share
+
+    next_id = 1
+    recover_ids = []
+    PR_scores = []
+    for start in range(0, n_posts, chunksize):
+        n = min(chunksize, n_posts - start)
+        # ids are increasing with gaps
+        ids = next_id + np.cumsum(rng.integers(1, 4, size=n))
+        next_id = ids[-1]
+        subreddit = rng.choice(len(subreddits), size=n, p=subreddit_probabilities)
+        lang = rng.choice(np.array(["en", "de", "es"], dtype=object), size=n, p=[0.95, 0.03, 0.02])
+        mentions_bd = rng.random(n) < np.where(subreddit_types[subreddit] == "bd", 0.6, 0.05)
+        n_words = np.clip(np.round(rng.lognormal(np.log(60), 1.0, size=n)), 1, 5000).astype(np.int64)
+        # 15% of the posts use PR terms frequently
+        is_PR_post = rng.random(n) < 0.15
+        texts = (_texts(rng, n_words[is_PR_post], words, probabilities, PR_terms, 0.08) +
+                 _texts(rng, n_words[~is_PR_post], words, probabilities, PR_terms, 0.002))
+        texts = pd.Series(texts, index=np.concatenate([np.flatnonzero(is_PR_post), np.flatnonzero(~is_PR_post)])).\
+            sort_index()
+        texts[mentions_bd] = "bipolar " + texts[mentions_bd]
+
+        meta = pd.DataFrame({"id": ids, "user_id": user_ids[rng.choice(n_users, size=n, p=user_probabilities)],
+                             "subreddit_name": subreddits[subreddit], "subreddit_type": subreddit_types[subreddit],
+                             "lang": lang, "text_wordcount": texts.str.count(" ").to_numpy() + 1,
+                             "mentions_bd": mentions_bd})
+        posts_text = pd.DataFrame({"id": ids, "text": texts.to_numpy()})
+        first = start == 0
+        meta.to_csv(os.path.join(directory, "data", "posts_meta.csv"), index=False, mode="w" if first else "a",
+                    header=first)
+        posts_text.to_csv(os.path.join(directory, "data", "posts_text.csv"), index=False, mode="w" if first else "a",
+                          header=first)
+
+        # English posts that contain *recover*, see exploratory_study_2/select_recover_posts.sql
+        recover_ids.append(ids[(lang == "en") & texts.str.lower().str.contains("recover", regex=False).to_numpy()])
+        PR_scores.append(pd.DataFrame({"id": ids, "PR": np.where(is_PR_post, rng.uniform(0.025, 0.1, size=n),
+                                                                 rng.uniform(0, 0.013, size=n))}))
+        print("Generated %d posts" %(start + n))
+
+    post_ids = os.path.join(directory, "post_ids")
+    recover_ids = pd.DataFrame({"id": np.concatenate(recover_ids)})
+    recover_ids.to_csv(os.path.join(post_ids, "posts_contain_recover_post_ids.csv"), index=False)
+    recover_corpus = recover_ids.sample(frac=0.9, random_state=seed).sort_values("id")
+    recover_corpus.to_csv(os.path.join(post_ids, "posts_recover_corpus_post_ids.csv"), index=False)
+    recover_corpus.sample(frac=0.05, random_state=seed).sort_values("id").\
+        to_csv(os.path.join(post_ids, "posts_recover_corpus_to_code_post_ids.csv"), index=False)
+    PR_scores = pd.concat(PR_scores).sample(frac=min(1.0, 30000 / n_posts), random_state=seed)
+    PR_scores[PR_scores.PR > 0.025].to_csv(os.path.join(post_ids, "PR-BD_Corpus_post_ids.csv"), index=False)
+    PR_scores[PR_scores.PR < 0.013].to_csv(os.path.join(post_ids, "Reference_Corpus_post_ids.csv"), index=False)
+
+    with open(os.path.join(directory, "benchmark_data.json"), "w") as f:
+        json.dump({"n_posts": n_posts, "seed": seed}, f)
+
+def synthetic_tokens(posts_file):
+    # *_spacy.csv file of posts_file with a whitespace tokeniser (lemma = lowercased token, no POS tags)
+    posts = pd.read_csv(posts_file, usecols=["id", "text"], keep_default_na=False, na_filter=False)
+    tokens = posts.assign(text=posts.text.str.split(" ")).explode("text")
+    tokens = tokens.rename(columns={"id": "post_id"})
+    tokens["sentence_id"] = 0
+    tokens["token_id"] = tokens.groupby("post_id").cumcount()
+    tokens["lemma"] = tokens.text.str.lower()
+    tokens["pos"] = np.where(tokens.text == ".", "PUNCT", "NOUN")
+    for col in ["tag", "dep", "shape"]:
+        tokens[col] = ""
+    tokens["is_alpha"] = tokens.text.str.isalpha()
+    tokens["is_stop"] = False
+    tokens = tokens[["post_id", "sentence_id", "token_id", "text", "lemma", "pos", "tag", "dep", "shape", "is_alpha",
+                     "is_stop"]].reset_index(drop=True)
+    tokens.to_csv(posts_file.split(".")[0] + "_spacy.csv")
+    return tokens
+
+# stages, run in the working directory; each returns the number of rows it wrote
+
+def stage_select_posts(params):
+    import select_posts_via_ids as sp
+    selected = sp.select_posts_multiple(["PR-BD_Corpus_post_ids.csv", "Reference_Corpus_post_ids.csv"])
+    return sum(len(posts) for posts in selected.values())
+
+def stage_select_bd_posts(params):
+    import select_bd_posts
+    posts = select_bd_posts.select_bd_posts()
+    posts.to_csv(c.data + "posts_bd.csv")
+    return len(posts)
+
+def stage_nlp_preprocess_posts(params):
+    import process_posts_with_spacy as ps
+    ps.nlp_preprocess_posts(c.data + "posts_bd.csv")
+    return len(pd.read_csv(c.data + "posts_bd_spacy.csv", usecols=["post_id"]))
+
+def stage_synthetic_tokens(params):
+    return len(synthetic_tokens(c.data + "posts_bd.csv"))
+
+def stage_identify_PR_phrases(params):
+    import PR_scoring
+    return PR_scoring.process_spacy_output(c.data + "posts_bd_spacy.csv", c.data + "PR_terms.csv",
+                                           c.data + "posts_bd_spacy_phrases.csv")
+
+def stage_score_posts(params):
+    import PR_scoring
+    posts = PR_scoring.read_phrase_posts(c.data + "posts_bd_spacy_phrases.csv")
+    posts_PR_scored = PR_scoring.score_posts(posts, c.data + "PR_terms.csv")
+    return len(PR_scoring.write_scored_posts(posts_PR_scored, c.data + "posts_bd.csv",
+                                             c.data + "posts_bd_PR_scored.csv"))
+
+def stage_write_corpora(params):
+    import create_corpora
+    PR, not_PR = create_corpora.select(params.get("layout", "files"))
+    return len(PR) + len(not_PR)
+
+def stage_keyness(params):
+    import lemma_frequencies as lf
+    return len(lf.lemma_statistics(c.data + "posts_bd_spacy.csv"))
+
+def _recover_step(step, **kwargs):
+    import build_recover_corpus as brc
+    # plots are written to output/, which needs kaleido
+    return len(getattr(brc, step)(**kwargs))
+
+def stage_build_recover_corpus_step_1(params):
+    if params.get("synthetic_tokens"):
+        # step 1 without spacy: select the posts and tokenise them with a whitespace tokeniser
+        import build_recover_corpus as brc
+        import process_posts_with_spacy as ps
+        original = ps.nlp_preprocess_posts
+        ps.nlp_preprocess_posts = lambda fname, **kwargs: synthetic_tokens(fname)
+        try:
+            return len(brc.step_1())
+        finally:
+            ps.nlp_preprocess_posts = original
+    return _recover_step("step_1")
+
+def stage_build_recover_corpus_step_2(params):
+    return _recover_step("step_2")
+
+def stage_build_recover_corpus_step_3(params):
+    # the superuser has fewer posts in small synthetic datasets than in the S-BiDD dataset
+    tokens = pd.read_csv(c.data + "posts_contain_recover_content_term.csv", usecols=["id", "user_id"])
+    superuser_posts = min(540, tokens[tokens.user_id == superuser].id.nunique() // 2)
+    return _recover_step("step_3", superuser_posts=superuser_posts)
+
+def stage_build_recover_corpus_select_post_to_code(params):
+    return _recover_step("select_post_to_code")
+
+def _run_stage(stage, params, directory, queue):
+    # runs in a new process, so the peak memory is that of the stage
+    os.chdir(directory)
+    progress = instrumentation.stage("benchmark_" + stage)
+    try:
+        with progress:
+            progress.set_rows(int(globals()["stage_" + stage](params)))
+        result = {"status": "ok", "rows": progress.rows}
+    except Exception as e:
+        traceback.print_exc()
+        result = {"status": "failed", "rows": None, "error": "%s: %s" %(type(e).__name__, e)}
+    # peak memory of the process during the stage
+    result.update({"seconds": time.time() - progress.start, "peak_memory_mb": progress.peak})
+    queue.put(result)
+
+def run_stage(stage, params, directory):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_run_stage, args=(stage, params, directory, queue))
+    process.start()
+    process.join()
+    if queue.empty():
+        return {"status": "failed", "rows": None, "error": "exit code %s" %process.exitcode, "seconds": None,
+                "peak_memory_mb": None}
+    return queue.get()
+
+def commit():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo, capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return revision + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def run(n_posts, selected_stages=stages, seed=0, directory=work_dir, outfile=results_file, layout="files"):
+    directory = os.path.join(directory, "%d_%d" %(n_posts, seed))
+    meta_file = os.path.join(directory, "benchmark_data.json")
+    if not os.path.exists(meta_file):
+        start = time.time()
+        generate(n_posts, directory, seed)
+        print("Generated %d posts in %.1f s" %(n_posts, time.time() - start))
+
+    revision = commit()
+    params = {"layout": layout}
+    os.makedirs(os.path.dirname(outfile), exist_ok=True)
+    for stage in selected_stages:
+        print("Benchmark %s (%d posts)" %(stage, n_posts))
+        result = run_stage(stage, params, directory)
+        records = [dict(stage=stage, synthetic_tokens=params.get("synthetic_tokens", False), **result)]
+        if stage == "nlp_preprocess_posts" and result["status"] == "failed":
+            # e.g. language model not installed: continue with whitespace tokens
+            params["synthetic_tokens"] = True
+            records.append(dict(stage="synthetic_tokens", synthetic_tokens=True,
+                                **run_stage("synthetic_tokens", params, directory)))
+        with open(outfile, "a") as f:
+            for record in records:
+                record = dict({"commit": revision, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "n_posts": n_posts,
+                               "seed": seed}, **record)
+                f.write(json.dumps(record) + "\n")
+                print("%-45s %-7s %8s s %8s MB" %(record["stage"], record["status"],
+                                                  "%.2f" %record["seconds"] if record["seconds"] is not None else "-",
+                                                  "%.0f" %record["peak_memory_mb"] if record["peak_memory_mb"] else "-"))
+
+def compare(commit_1, commit_2, outfile=results_file):
+    # wall time and peak memory per stage and number of posts, last run of each commit
+    results = pd.read_json(outfile, lines=True)
+    results = results[results.commit.isin([commit_1, commit_2]) & (results.status == "ok")]
+    results = results.drop_duplicates(subset=["commit", "n_posts", "stage"], keep="last")
+    table = results.pivot_table(index=["n_posts", "stage"], columns="commit", values=["seconds", "peak_memory_mb"])
+    for value in ["seconds", "peak_memory_mb"]:
+        if (value, commit_1) in table and (value, commit_2) in table:
+            table[(value, "ratio")] = table[(value, commit_2)] / table[(value, commit_1)]
+    print(table.to_string())
+    return table
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the pipeline stages on synthetic data")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Generate synthetic data (if needed) and run the stages")
+    run_parser.add_argument("-n", "--n_posts", nargs="+", type=int, default=[10000], help="Numbers of posts")
+    run_parser.add_argument("-s", "--stages", nargs="+", default=stages, choices=stages, help="Stages to run")
+    run_parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic data")
+    run_parser.add_argument("-d", "--directory", default=work_dir, help="Working directory for the synthetic data")
+    run_parser.add_argument("-o", "--outfile", default=results_file, help="Results file (json lines)")
+    run_parser.add_argument("-l", "--layout", default="files", help="Layout of the per-user files, see corpus_files.py")
+    compare_parser = subparsers.add_parser("compare", help="Compare the results of two commits")
+    compare_parser.add_argument("commits", nargs=2)
+    compare_parser.add_argument("-o", "--outfile", default=results_file, help="Results file (json lines)")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        for n_posts in args.n_posts:
+            run(n_posts, args.stages, args.seed, os.path.abspath(args.directory), os.path.abspath(args.outfile),
+                args.layout)
+    else:
+        compare(args.commits[0], args.commits[1], args.outfile)
@@ -1,27 +1,48 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import argparse
+import os
 import pandas as pd
-import numpy as np
-import re
-import plotly.express as px
 
+import balancing
 import config as c
 import select_posts_via_ids as sp
 import process_posts_with_spacy as ps
-
-# regex that matches *recover* tokens (not case-sensitive)
-regex_recover = re.compile(r'(.*)recover(.*)', re.IGNORECASE)
-
-def get_dataset_stats(df):
+import token_table as tt
+from stage_cache import StageCache
+
+# wildcard pattern that matches *recover* tokens (not case-sensitive)
+pattern_recover = "*recover*"
+# post ids of the posts selected by the downsampling of step 3
+own_sampling_post_ids = c.data + "posts_recover_corpus_own_sampling_post_ids.csv"
+
+def index_tokens(tokens):
+    # lowercased vocabulary index of the token texts, the rows of the index are the positions in tokens
+    return tt.VocabularyIndex.from_series(tokens.text, tokens.id)
+
+def index_recover_tokens(tokens):
+    # index of the tokens of step 1, stored with the token table if process_posts_with_spacy.py wrote one
+    # (the tokens of step 1 are in the same order as the rows of the token table)
+    spacy_csv = c.data + "posts_contain_recover_spacy.csv"
+    if tt.exists(spacy_csv):
+        return tt.VocabularyIndex.from_table(spacy_csv)
+    return index_tokens(tokens)
+
+def get_dataset_stats(df, index=None):
+    # index: VocabularyIndex of df or of a dataset df was selected from by post (all tokens of a post)
     print("%d posts by %d users in %d subreddits, %d sentences with %d tokens" %(df.id.nunique(), df.user_id.nunique(),\
                                                                                  df.subreddit_name.nunique(),\
                                                                                  df.sentence_id.nunique(),\
                                                                                  len(df)))
 
-    tokens_recover = df[df.text.str.match(regex_recover)]
-    terms_recover = tokens_recover.text.str.lower().value_counts().reset_index().rename(
-        columns={"index": "term", "text": "frequency"})
+    if index is None:
+        index = index_tokens(df)
+        post_ids = None
+    else:
+        post_ids = df.id.unique()
+    # the pattern is matched against the unique lowercased tokens, not against every token
+    terms_recover = index.frequencies(index.match(pattern_recover), post_ids)
     print("%d unique terms that match *recover*" % len(terms_recover))
     print(terms_recover[terms_recover.frequency >= 3])
 
@@ -31,6 +52,8 @@ def plot_posts_per_user(posts, outfile_name):
         rename(columns={"id": "posts (n)"}).sort_values("posts (n)", ascending=False)
     # convert id to text so the bars are not reordered on the x-axis according to the ids
     posts_per_user["user id"] = posts_per_user.user_id.astype(str)
+    # plotly is imported here, so that importing this module does not load it
+    import plotly.express as px
     fig = px.bar(posts_per_user.head(n=30), x="user id", y="posts (n)", width=500)
     # need tickmode=linear to show all user ids
     fig.update_xaxes(showticklabels=True, type='category', tickmode='linear')
@@ -38,10 +61,16 @@ def plot_posts_per_user(posts, outfile_name):
     print("Plot image to output/%s.png" %outfile_name)
     fig.write_image("output/%s.png" % outfile_name)
 
-def select_tokenised_posts_via_ids(post_ids_file, tokenised_posts_file):
+def select_tokenised_posts_via_ids(post_ids_file, tokenised_posts_file, tokens=None, rows=None):
+    # rows: balancing.PostRows of tokens, looks up the tokens of the post ids instead of an isin over all tokens
     post_ids_to_code = pd.read_csv("post_ids/%s" %post_ids_file)
-    tokens = pd.read_csv(c.data + tokenised_posts_file, keep_default_na=False, na_filter=False)
-    selected_posts = tokens[tokens.id.isin(post_ids_to_code.id)]
+    if tokens is None:
+        tokens = sp.read_selected(c.data + tokenised_posts_file, ids=post_ids_to_code.id, keep_default_na=False,
+                                  na_filter=False)
+    if rows is None:
+        selected_posts = tokens[tokens.id.isin(post_ids_to_code.id)]
+    else:
+        selected_posts = rows.select(tokens, post_ids_to_code.id)
     selected_posts.to_csv(c.data + "_".join(post_ids_file.split("_")[:-2])+ ".csv", index=False)
     return selected_posts
 
@@ -53,62 +82,72 @@ def step_1():
     sp.select_posts("posts_contain_recover_post_ids.csv")
 
     # run spacy to tokenise
-    ps.nlp_preprocess_posts(c.data + "posts_contain_recover.csv")
+    ps.nlp_preprocess_posts(c.data + "posts_contain_recover.csv", table=True)
 
-    tokens = pd.read_csv(c.data + "posts_contain_recover_spacy.csv", keep_default_na=False, na_filter=False,
-                         usecols=["post_id", "sentence_id", "token_id", "text"])
+    # from the token table if process_posts_with_spacy.py wrote one, otherwise from the csv file
+    tokens = tt.read_tokens(c.data + "posts_contain_recover_spacy.csv", ["post_id", "sentence_id", "token_id", "text"])
     tokens.rename(columns={"post_id": "id"}, inplace=True)
     # make sentence_id unique within the dataset
     tokens["sentence_id"] = tokens.id.astype(str) + "_" + tokens.sentence_id.astype(str)
-    posts = pd.read_csv(c.data + "posts_meta.csv", keep_default_na=False, na_filter=False,
-                        usecols=["id", "user_id", "lang", "subreddit_name", "subreddit_type"])
+    posts = sp.read_posts("posts_meta", columns=["id", "user_id", "lang", "subreddit_name", "subreddit_type"],
+                          ids=tokens.id.unique(), keep_default_na=False, na_filter=False)
     tokens = tokens.merge(posts, left_on="id", right_on="id", how="left")
 
     print("After Step 1:\nAll English S-BiDD dataset posts with at least one token that matches *recover*")
-    get_dataset_stats(tokens)
+    get_dataset_stats(tokens, index_recover_tokens(tokens))
     tokens.to_csv(c.data + "posts_contain_recover_tokenised.csv", index=False)
+    return tokens
 
-def step_2():
+def step_2(tokens=None, index=None):
     print("Step 2")
     # 2 Select only posts that contain a *recover* content term
     recover_content_terms = pd.read_csv("exploratory_study_2/recover_content_terms.csv", keep_default_na=False, na_filter=False)
     print("Read in %d recover content terms" %len(recover_content_terms))
 
-    tokens = pd.read_csv(c.data + "posts_contain_recover_tokenised.csv", keep_default_na=False, na_filter=False)
-    recover_content_tokens = tokens[tokens.text.str.lower().isin(recover_content_terms.term.str.lower())]
+    if tokens is None:
+        tokens = pd.read_csv(c.data + "posts_contain_recover_tokenised.csv", keep_default_na=False, na_filter=False)
+    if index is None:
+        index = index_tokens(tokens)
 
-    posts_with_recover_content_term = recover_content_tokens.id.unique()
+    # posts of the index that contain a content term, looked up in the lowercased vocabulary
+    posts_with_recover_content_term = index.post_ids(index.lookup(recover_content_terms.term))
     posts_contain_recover_content_term = tokens[tokens.id.isin(posts_with_recover_content_term)]
 
     print("After Step 2:\n After selecting only posts with at least one *recover* content term")
-    get_dataset_stats(posts_contain_recover_content_term)
+    get_dataset_stats(posts_contain_recover_content_term, index)
 
     plot_posts_per_user(posts_contain_recover_content_term, "posts_per_user_top30_contains_recover_content_term")
 
     posts_contain_recover_content_term.to_csv(c.data + "posts_contain_recover_content_term.csv", index=False)
+    return posts_contain_recover_content_term
 
-def step_3():
+def step_3(tokens=None, seed=0, index=None, superuser=1629, superuser_posts=540):
     print("Step 3")
     # 3 Downsample number of posts for user with most posts
-    # fix random seed for reproducibility - see here: https://stackoverflow.com/questions/52375356/is-there-a-way-to-set-random-state-for-all-pandas-function
-    np.random.seed(0)
-
-    tokens = pd.read_csv(c.data + "posts_contain_recover_content_term.csv", keep_default_na=False, na_filter=False)
-    get_dataset_stats(tokens)
-    posts_superuser = np.random.choice(tokens[tokens.user_id == 1629].id.unique(), size=540, replace=False)
-    tokens_superuser = tokens[tokens.id.isin(posts_superuser)]
-    recover_corpus = pd.concat([tokens[tokens.user_id != 1629], tokens_superuser])
+    # seeded reservoir sampling (balancing.py): the same seed always selects the same posts
+    # with superuser=None, the posts of every user are capped at superuser_posts
+
+    if tokens is None:
+        tokens = pd.read_csv(c.data + "posts_contain_recover_content_term.csv", keep_default_na=False, na_filter=False)
+    if index is None:
+        index = index_tokens(tokens)
+    get_dataset_stats(tokens, index)
+    own_sampling = balancing.cap_posts([tokens[["id", "user_id"]]], superuser_posts, seed,
+                                       users=None if superuser is None else [superuser])
+    balancing.write_post_ids(own_sampling, os.path.basename(own_sampling_post_ids))
+    # rows of each post in tokens, the tokens of the sampled posts and of the posts of the paper are looked up by id
+    rows = balancing.PostRows(tokens.id)
+    recover_corpus = rows.select(tokens, own_sampling.id)
+    recover_corpus.to_csv(c.data + "posts_recover_corpus_own_sampling.csv", index=False)
 
     print("After Step 3\n*recover* corpus: after downsampling user with disproportionally many posts\n(Note that the "
           "corpus statistics may slightly differ from supplementary Table 4 due to random sampling.")
-    get_dataset_stats(recover_corpus)
-
-    recover_corpus.to_csv(c.data + "posts_recover_corpus_own_sampling.csv", index=False)
+    get_dataset_stats(recover_corpus, index)
 
     recover_corpus = select_tokenised_posts_via_ids("posts_recover_corpus_post_ids.csv",
-                                                   "posts_contain_recover_content_term.csv")
+                                                   "posts_contain_recover_content_term.csv", tokens, rows)
     print("After Step 3\n*recover* corpus as used in the paper reconstructed from the post ids")
-    get_dataset_stats(recover_corpus)
+    get_dataset_stats(recover_corpus, index)
 
     # number of posts per user
     plot_posts_per_user(recover_corpus, "posts_per_user_top30_recover_corpus")
@@ -117,29 +156,71 @@ def step_3():
     posts_per_subreddit = recover_corpus.groupby("subreddit_name").id.nunique().reset_index().\
         rename(columns={"id": "posts (n)"}).sort_values("posts (n)", ascending=False).head(n=10)
 
-    posts = pd.read_csv(c.data + "posts_meta.csv", usecols=["id", "subreddit_name"])
-    posts_per_subreddit_total = posts[posts.subreddit_name.isin(posts_per_subreddit.subreddit_name)].\
-        groupby("subreddit_name").id.nunique().reset_index().rename(columns={"id": "posts (n)"})
+    posts = sp.read_posts("posts_meta", columns=["id", "subreddit_name"],
+                          filters=[("subreddit_name", "in", posts_per_subreddit.subreddit_name)])
+    posts_per_subreddit_total = posts.groupby("subreddit_name").id.nunique().reset_index().\
+        rename(columns={"id": "posts (n)"})
 
     posts_per_subreddit = posts_per_subreddit.merge(posts_per_subreddit_total, left_on="subreddit_name",
                                             right_on="subreddit_name", how="left", suffixes=('_recover', '_total'))
     posts_per_subreddit["% total"] = posts_per_subreddit["posts (n)_recover"] / posts_per_subreddit["posts (n)_total"] * 100
     print(posts_per_subreddit)
+    return recover_corpus
 
-def select_post_to_code():
+def select_post_to_code(recover_corpus=None, index=None):
     print("Select posts to code")
     # select posts to code
     # code for the random sampling of 0.5% of the posts + upsampling of posts to 50 posts in BD subreddits
     # and *recover* term instances to at least 5 instances not reproduced since the post distribution varies with the
     # random sampling
-    posts_to_code = select_tokenised_posts_via_ids("posts_recover_corpus_to_code_post_ids.csv", "posts_recover_corpus.csv")
+    posts_to_code = select_tokenised_posts_via_ids("posts_recover_corpus_to_code_post_ids.csv", "posts_recover_corpus.csv",
+                                                   recover_corpus)
     print("Posts from *recover* corpus for manual coding of *recover* instances")
-    get_dataset_stats(posts_to_code)
+    get_dataset_stats(posts_to_code, index)
+    return posts_to_code
+
+def code_files(*modules):
+    return [os.path.join(os.path.dirname(os.path.abspath(__file__)), module) for module in modules]
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="*recover* corpus construction")
+    parser.add_argument("--no-cache", help="Re-run all steps even if their inputs did not change",
+                        action="store_true")
+    args = parser.parse_args()
+
     print("Constructing *recover* corpus ...")
-    step_1()
-    step_2()
-    step_3()
-    select_post_to_code()
+    # each step is skipped if its input files, parameters, code and the output of the previous step did not change
+    cache = StageCache(c.data + "build_recover_corpus_cache/", enabled=not args.no_cache)
+    code = code_files("build_recover_corpus.py", "config.py")
+    # modules used to read posts_meta.csv/posts_text.csv and the columnar store (c.store) if it exists
+    read_code = code_files("select_posts_via_ids.py", "columnar_store.py", "id_index.py", "instrumentation.py")
+    # the files written by the steps: a step whose output file was deleted is run again
+    tokens, fingerprint = cache.run("step_1", step_1,
+                                    files=[c.post_ids + "posts_contain_recover_post_ids.csv", c.data + "posts_meta.csv",
+                                           c.data + "posts_text.csv", c.store] + code + read_code +
+                                          code_files("process_posts_with_spacy.py", "token_table.py", "sharding.py"),
+                                    outputs=[c.data + "posts_contain_recover.csv",
+                                             c.data + "posts_contain_recover_spacy.csv",
+                                             c.data + "posts_contain_recover_tokenised.csv"])
+    # built once, the later steps select posts from the tokens of step 1
+    index = index_recover_tokens(tokens)
+    tokens, fingerprint = cache.run("step_2", step_2, args=(tokens, index),
+                                    files=["exploratory_study_2/recover_content_terms.csv"] + code,
+                                    upstream=fingerprint,
+                                    outputs=[c.data + "posts_contain_recover_content_term.csv",
+                                             "output/posts_per_user_top30_contains_recover_content_term.png"])
+    recover_corpus, fingerprint = cache.run("step_3", step_3, args=(tokens, 0, index),
+                                            files=[c.post_ids + "posts_recover_corpus_post_ids.csv",
+                                                   c.data + "posts_meta.csv", c.store] + code + read_code +
+                                                  code_files("balancing.py", "sharding.py"),
+                                            params={"seed": 0}, upstream=fingerprint,
+                                            outputs=[own_sampling_post_ids,
+                                                     c.data + "posts_recover_corpus_own_sampling.csv",
+                                                     c.data + "posts_recover_corpus.csv",
+                                                     "output/posts_per_user_top30_recover_corpus.png"])
+    del(tokens)
+    cache.run("select_post_to_code", select_post_to_code, args=(recover_corpus, index),
+              files=[c.post_ids + "posts_recover_corpus_to_code_post_ids.csv"] + code, upstream=fingerprint,
+              outputs=[c.data + "posts_recover_corpus_to_code.csv"])
+    cache.print_report()
 
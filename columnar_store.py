@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+# one-time conversion of posts_meta.csv and posts_text.csv into a partitioned Parquet store (data/store/)
+# posts_meta is partitioned by subreddit_type and lang, posts_text by id range (id_bucket), so that reading posts via
+# their ids or via a filter like mentions_bd only reads the needed columns and files/row groups
+# requires pyarrow - if pyarrow or the store are not available, select_posts_via_ids.read_posts falls back to the csv files
+# the row number of each post in the csv file is stored too (column row), so that posts are read in the order of the csv
+# file as from the csv file
+# only empty fields are stored as missing values (null), the missing values of pandas.read_csv (e.g. "NA" with the default
+# na_values, nothing with na_filter=False) are applied when the posts are read (csv_missing_values), so that the posts
+# of the store are the posts of the csv file read with the same options
+
+import operator
+import os
+import shutil
+import sys
+
+import pandas as pd
+
+import config as c
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+partitioning = {"posts_meta": ["subreddit_type", "lang"], "posts_text": ["id_bucket"]}
+# number of consecutive post ids stored in one posts_text partition
+id_bucket_size = 1000000
+column_types = {"posts_meta": {"id": "int64", "user_id": "int64"}, "posts_text": {"id": "int64", "text": "string"}}
+# written after the conversion (files starting with _ are not read as part of the dataset): stores converted with the
+# missing values of pyarrow (e.g. "NA" and "null" as null) do not have it
+null_values_file = "_null_values"
+# missing values of pandas.read_csv with keep_default_na=True
+default_na_values = {"", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>",
+                     "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"}
+
+def available(table):
+    if pa is None or not os.path.isdir(c.store + table):
+        return False
+    if not os.path.exists(os.path.join(c.store + table, null_values_file)):
+        print("%s%s was converted with pyarrow's missing values (e.g. \"NA\" as missing), reading %s.csv instead (run "
+              "python columnar_store.py %s again to use the store)" %(c.store, table, table, table))
+        return False
+    return True
+
+def _with_row(batches, table):
+    # adds the row number in the csv file (and the id_bucket partition column of posts_text)
+    row = 0
+    for batch in batches:
+        columns = batch.columns + [pa.array(range(row, row + batch.num_rows), type=pa.int64())]
+        names = batch.schema.names + ["row"]
+        if table == "posts_text":
+            columns.append(pc.divide(batch.column("id"), id_bucket_size))
+            names.append("id_bucket")
+        row += batch.num_rows
+        yield pa.RecordBatch.from_arrays(columns, names=names)
+
+def convert(table):
+    if pa is None:
+        raise ImportError("Converting %s.csv to the columnar store requires pyarrow" %table)
+    print("Converting %s.csv to %s" %(table, c.store + table))
+    # posts_text.csv does not fit into RAM on most machines: stream it in blocks of 64MB
+    reader = pa_csv.open_csv(c.data + table + ".csv", read_options=pa_csv.ReadOptions(block_size=64 << 20),
+                             convert_options=pa_csv.ConvertOptions(
+                                 column_types={col: pa.type_for_alias(t) for col, t in column_types[table].items()},
+                                 null_values=[""], strings_can_be_null=True))
+    schema = reader.schema.append(pa.field("row", pa.int64()))
+    if table == "posts_text":
+        schema = schema.append(pa.field("id_bucket", pa.int64()))
+    batches = pa.RecordBatchReader.from_batches(schema, _with_row(reader, table))
+
+    shutil.rmtree(c.store + table, ignore_errors=True)
+    ds.write_dataset(batches, c.store + table, format="parquet",
+                     partitioning=partitioning[table], partitioning_flavor="hive",
+                     max_rows_per_group=100000, min_rows_per_group=100000)
+    with open(os.path.join(c.store + table, null_values_file), "w") as f:
+        f.write("\n")
+
+def csv_missing_values(posts, keep_default_na=True, na_filter=True, na_values=None, **csv_kwargs):
+    # the missing values of the string columns as if the csv file was read with pandas.read_csv(..., keep_default_na,
+    # na_filter, na_values): the store only has empty fields as missing values
+    na_values = set() if not na_filter else \
+        ({na_values} if isinstance(na_values, str) else set(na_values or [])) | (default_na_values if keep_default_na
+                                                                                else set())
+    for col in posts.columns:
+        if pd.api.types.is_numeric_dtype(posts[col]) or pd.api.types.is_bool_dtype(posts[col]):
+            continue
+        if "" not in na_values:
+            posts[col] = posts[col].fillna("")
+        na_values_col = na_values - {""}
+        if na_values_col:
+            posts[col] = posts[col].mask(posts[col].isin(na_values_col))
+    return posts
+
+# filters are lists of (column, operator, value) tuples as in pandas.read_parquet, e.g. [("mentions_bd", "==", True)]
+# the operators work on dataset fields (store) and on pandas Series (csv files)
+operators = {"==": operator.eq, "!=": operator.ne, "<": operator.lt, "<=": operator.le, ">": operator.gt,
+             ">=": operator.ge, "in": lambda field, value: field.isin(list(value))}
+
+def _condition(field, op, value):
+    if op not in operators:
+        raise ValueError("Unsupported filter operator %s" %op)
+    return operators[op](field, value)
+
+def _to_expression(filters):
+    expression = None
+    for column, op, value in filters or []:
+        condition = _condition(ds.field(column), op, value)
+        expression = condition if expression is None else expression & condition
+    return expression
+
+def apply_filters(df, filters):
+    # same semantics as _to_expression for a pandas DataFrame (csv fallback)
+    for column, op, value in filters or []:
+        df = df[_condition(df[column], op, value)]
+    return df
+
+def read_table(table, columns=None, ids=None, filters=None):
+    dataset = ds.dataset(c.store + table, format="parquet", partitioning="hive")
+    expression = _to_expression(filters)
+    if ids is not None:
+        ids = pa.array(sorted(set(ids)), type=pa.int64())
+        id_expression = ds.field("id").isin(ids)
+        if table == "posts_text":
+            # only read the partitions that can contain the ids
+            id_expression = id_expression & ds.field("id_bucket").isin(pc.unique(pc.divide(ids, id_bucket_size)))
+        expression = id_expression if expression is None else expression & id_expression
+    if columns is None:
+        columns = [col for col in dataset.schema.names if col not in ["id_bucket", "row"]]
+    columns = list(columns)
+
+    if "row" in dataset.schema.names:
+        # partitions are not stored in the order of the csv files - return the posts in the order of the csv file
+        posts = dataset.to_table(columns=columns + ["row"], filter=expression).to_pandas()
+        return posts.sort_values("row").drop(columns="row").reset_index(drop=True)
+    # store converted without row numbers: sorted by id
+    print("%s%s has no row numbers, the posts are sorted by id (run python columnar_store.py %s again to read them in "
+          "the order of the csv file)" %(c.store, table, table))
+    posts = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    if "id" in posts.columns:
+        posts = posts.sort_values("id", kind="stable").reset_index(drop=True)
+    return posts
+
+if __name__ == '__main__':
+    # python columnar_store.py [posts_meta] [posts_text]
+    for table in sys.argv[1:] or ["posts_meta", "posts_text"]:
+        convert(table)
@@ -2,4 +2,6 @@
 
 data = "data/"
 post_ids = "post_ids/"
-results = "results/"
\ No newline at end of file
+results = "results/"
+# partitioned Parquet version of posts_meta.csv and posts_text.csv, see columnar_store.py
+store = data + "store/"
\ No newline at end of file
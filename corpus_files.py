@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+# writes the texts of a corpus as one text per user (e.g. for the dispersion calculation in LancsBox)
+# layouts:
+# - files: one <user_id>.txt file per user in a directory; the files are written to a staging directory by a thread
+#   pool and the staging directory then replaces the previous version of the directory
+# - tar/zip: one archive <directory>.tar/.zip with one <user_id>.txt member per user
+# - offsets: all user texts concatenated in <directory>_concatenated.txt, <directory>_offsets.csv gives the user_id,
+#   byte offset and byte length of each user's text (both are staged and replace the previous version together)
+
+import csv
+import io
+import os
+import shutil
+import tarfile
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+layouts = ["files", "tar", "zip", "offsets"]
+
+def user_texts(posts):
+    # yields (user_id, texts of the user's posts joined by newlines), users in ascending order, posts in corpus order
+    # same result as iterating over posts.groupby("user_id"), but sorts only once and does not create a group per user
+    posts = posts[["user_id", "text"]].sort_values("user_id", kind="mergesort")
+    user_ids = posts.user_id.to_numpy()
+    texts = posts.text.tolist()
+    starts = np.concatenate([[0], np.flatnonzero(user_ids[1:] != user_ids[:-1]) + 1, [len(user_ids)]])
+    for start, end in zip(starts[:-1], starts[1:]):
+        yield user_ids[start], "\n".join(texts[start:end])
+
+def _write_file(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+def _replace(staging, target):
+    # the previous version is only removed after the new one is in place
+    old = None
+    if os.path.exists(target):
+        old = target.rstrip("/") + ".old-%d" %os.getpid()
+        os.rename(target, old)
+    os.rename(staging, target)
+    if old is not None:
+        shutil.rmtree(old) if os.path.isdir(old) else os.remove(old)
+
+class UserFileWriter(object):
+    # writes the user texts one at a time in one of the layouts (e.g. while streaming the posts of a corpus)
+    # the texts are written to a staging file/directory that replaces the previous version on close()
+
+    def __init__(self, directory, layout="files", n_threads=8):
+        if layout not in layouts:
+            raise ValueError("Unknown layout %s, use one of %s" %(layout, ", ".join(layouts)))
+        self.directory = directory.rstrip("/")
+        self.layout = layout
+        self.staging = "%s.staging-%d" %(self.directory, os.getpid())
+        self.n_users = 0
+        if layout == "files":
+            os.makedirs(self.staging)
+            self.executor = ThreadPoolExecutor(max_workers=n_threads)
+            # files that are not written yet (a future holds its text until it is written)
+            self.futures = set()
+            self.max_pending = 4 * n_threads
+            self.target = self.directory
+        elif layout == "tar":
+            self.archive = tarfile.open(self.staging, "w")
+            self.target = self.directory + ".tar"
+        elif layout == "zip":
+            self.archive = zipfile.ZipFile(self.staging, "w", compression=zipfile.ZIP_DEFLATED)
+            self.target = self.directory + ".zip"
+        else:
+            self.file = open(self.staging, "wb")
+            self.offsets = []
+            self.target = self.directory + "_concatenated.txt"
+            self.offsets_file = self.directory + "_offsets.csv"
+            self.offsets_staging = "%s.staging-%d" %(self.offsets_file, os.getpid())
+
+    def add(self, user_id, text):
+        self.n_users += 1
+        if self.layout == "files":
+            if len(self.futures) >= self.max_pending:
+                # the texts of the written files are dropped, exceptions of the threads are raised here
+                done, self.futures = wait(self.futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            self.futures.add(self.executor.submit(_write_file, os.path.join(self.staging, "%s.txt" %user_id), text))
+        elif self.layout == "tar":
+            data = text.encode("utf-8")
+            member = tarfile.TarInfo("%s.txt" %user_id)
+            member.size = len(data)
+            self.archive.addfile(member, io.BytesIO(data))
+        elif self.layout == "zip":
+            self.archive.writestr("%s.txt" %user_id, text)
+        else:
+            data = text.encode("utf-8")
+            self.offsets.append([user_id, self.file.tell(), len(data)])
+            self.file.write(data)
+
+    def _finish(self):
+        if self.layout == "files":
+            self.executor.shutdown()
+            # raises exceptions of the threads here
+            for future in self.futures:
+                future.result()
+            self.futures = set()
+        elif self.layout in ["tar", "zip"]:
+            self.archive.close()
+        else:
+            self.file.close()
+
+    def close(self):
+        self._finish()
+        if self.layout == "offsets":
+            with open(self.offsets_staging, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["user_id", "offset", "length"])
+                writer.writerows(self.offsets)
+        _replace(self.staging, self.target)
+        if self.layout == "offsets":
+            # right after the texts, the offsets are only written once the texts are complete
+            _replace(self.offsets_staging, self.offsets_file)
+        return self.target
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # the previous version stays in place
+            self._finish()
+            shutil.rmtree(self.staging) if os.path.isdir(self.staging) else os.remove(self.staging)
+            if self.layout == "offsets" and os.path.exists(self.offsets_staging):
+                os.remove(self.offsets_staging)
+        return False
+
+def write_user_files(posts, directory, layout="files", n_threads=8):
+    with UserFileWriter(directory, layout, n_threads) as writer:
+        for user_id, text in user_texts(posts):
+            writer.add(user_id, text)
+    print("Wrote texts of %d users to %s" %(writer.n_users, writer.target))
+
+def read_user_text(directory, user_id):
+    # read the text of one user from the offsets layout
+    directory = directory.rstrip("/")
+    with open(directory + "_offsets.csv") as f:
+        for row in csv.DictReader(f):
+            if row["user_id"] == str(user_id):
+                with open(directory + "_concatenated.txt", "rb") as texts:
+                    texts.seek(int(row["offset"]))
+                    return texts.read(int(row["length"])).decode("utf-8")
+    raise KeyError(user_id)
@@ -1,23 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import argparse
+
+import numpy as np
 import pandas as pd
-import sys
-import os
-import shutil
 
 import config as c
-from select_posts_via_ids import select_posts
-
-mode = sys.argv[1]
-
-def write_corpora(PR, not_PR, cols_to_write):
-    # important! Need to remove corpus folder with individual files for user if re-creating the corpus,
-    # otherwise files of users that were in a previous corpus version but not in the current one remain in the folder
-    PR_corpus_dir = c.data + "/PR-BD_corpus/"
-    # removes the directory if it exists
-    shutil.rmtree(PR_corpus_dir, ignore_errors=True)
-    os.makedirs(PR_corpus_dir)
+import corpus_files as cf
+import dedupe as dd
+import instrumentation
+from select_posts_via_ids import select_posts_multiple
 
+@instrumentation.instrument("write_corpora", rows=None)
+def write_corpora(PR, not_PR, cols_to_write, layout="files"):
     PR[cols_to_write].to_csv(
         c.data + "PR-BD_Corpus.csv", index=False)
 
@@ -26,10 +21,11 @@ def write_corpora(PR, not_PR, cols_to_write):
         f.write("\n".join(PR.text.tolist()))
 
     # write one file per user to calculate dispersion in LancsBox
-    users = PR.groupby("user_id")
-    for user_id, posts in users:
-        with open(PR_corpus_dir + "%s.txt" %user_id, "w") as f:
-            f.write("\n".join(posts.text.tolist()))
+    # important! files of users that were in a previous corpus version but not in the current one must not remain in
+    # the folder: the new folder is written to a staging folder that replaces the previous one
+    # (layout "none": do not write the user files, e.g. when using select_key_lemmas.py native)
+    if layout != "none":
+        cf.write_user_files(PR, c.data + "PR-BD_corpus/", layout)
 
     not_PR[cols_to_write].to_csv(
         c.data + "Reference_Corpus.csv", index=False)
@@ -38,29 +34,103 @@ def write_corpora(PR, not_PR, cols_to_write):
     with open(c.data + "Reference_Corpus.txt", "w") as f:
         f.write("\n".join(not_PR.text.tolist()))
 
-if mode == "select":
-    posts = pd.read_csv(c.data + "posts_bd_PR_scored.csv", keep_default_na=False, na_values=[])
-
-    # 3) Select posts with at least 94 words, remove duplicates (same text by same user)
-    posts = posts[posts.text_wordcount > 93]
-    posts.drop_duplicates(subset=["text", "user_id"], keep = "last", inplace=True)
-    print("Posts with at least 94 words, duplicates removed:\nPosts: %d\nWords: %d\nUsers: %d" %(len(posts), posts.text_wordcount.sum(),
-                                                                       posts.user_id.nunique()))
+# cut-offs of the paper: at least 94 words, PR-BD Corpus PR > 0.025, Reference Corpus PR < 0.013
+min_words = 94
+PR_min = 0.025
+not_PR_max = 0.013
+
+def read_scored_posts():
+    return pd.read_csv(c.data + "posts_bd_PR_scored.csv", keep_default_na=False, na_values=[])
+
+@instrumentation.instrument("create_corpora_select", rows=lambda corpora: len(corpora[0]) + len(corpora[1]))
+def select(layout="files", PR_min=PR_min, not_PR_max=not_PR_max, min_words=min_words, posts=None, dedupe="exact",
+           bits=64):
+    # 3) Select posts with at least 94 words, remove duplicates (same text by same user, see dedupe.py for the modes)
+    # posts: posts_bd_PR_scored.csv if already read (sweep mode), otherwise it is streamed and only the selected posts
+    # are kept in memory
+    if posts is None:
+        posts = dd.read_deduplicated(c.data + "posts_bd_PR_scored.csv", dedupe, bits,
+                                     condition=lambda chunk: chunk.text_wordcount >= min_words,
+                                     keep_default_na=False, na_values=[])
+    else:
+        posts = posts[dd.keep_mask([posts], dedupe, bits)]
+        posts = posts[posts.text_wordcount >= min_words]
+    print("Posts with at least %d words, duplicates removed:\nPosts: %d\nWords: %d\nUsers: %d" %(
+        min_words, len(posts), posts.text_wordcount.sum(), posts.user_id.nunique()))
 
     # 4.1) Select posts for PR-BD corpus
-    PR = posts[posts.PR > 0.025]
+    PR = posts[posts.PR > PR_min]
     print("PR-BD Corpus:\nPosts: %d\nWords: %d\nUsers: %d" %(len(PR), PR.text_wordcount.sum(), PR.user_id.nunique()))
 
     # 4.2) Select posts for Reference corpus
-    not_PR = posts[posts.PR < 0.013]
+    not_PR = posts[posts.PR < not_PR_max]
     print("Reference Corpus:\nPosts: %d\nWords: %d\nUsers: %d" %(len(not_PR), not_PR.text_wordcount.sum(), not_PR.user_id.nunique()))
 
     write_corpora(PR, not_PR,
-                  cols_to_write=['id', 'user_id', 'subreddit_name', 'text_wordcount', 'text', 'text_with_phrases', 'PR'])
-
-elif mode == "ids":
-    select_posts("PR-BD_Corpus_post_ids.csv")
-    select_posts("Reference_Corpus_post_ids.csv")
+                  cols_to_write=['id', 'user_id', 'subreddit_name', 'text_wordcount', 'text', 'text_with_phrases', 'PR'],
+                  layout=layout)
+    return PR, not_PR
+
+def _sweep_corpus(PR, words, users, duplicates, thresholds, above):
+    # posts, words, users and removed duplicates of the corpus selected by each threshold (PR > threshold if above,
+    # otherwise PR < threshold), from cumulative sums over the posts sorted by PR
+    order = np.argsort(PR, kind="stable")
+    PR_sorted = PR[order]
+    cumulative = {name: np.concatenate([[0], np.cumsum(values[order])])
+                  for name, values in [("words", words), ("duplicates", duplicates)]}
+    # a user is in the corpus if their highest (PR-BD) / lowest (Reference) PR score is selected
+    user_PR = pd.Series(PR).groupby(users).agg("max" if above else "min").sort_values().to_numpy()
+    n_posts, n_users = len(PR), len(user_PR)
+    if above:
+        first = np.searchsorted(PR_sorted, thresholds, side="right")
+        users_selected = n_users - np.searchsorted(user_PR, thresholds, side="right")
+        selected = {name: values[-1] - values[first] for name, values in cumulative.items()}
+        posts_selected = n_posts - first
+    else:
+        last = np.searchsorted(PR_sorted, thresholds, side="left")
+        users_selected = np.searchsorted(user_PR, thresholds, side="left")
+        selected = {name: values[last] for name, values in cumulative.items()}
+        posts_selected = last
+    return pd.DataFrame({"threshold": thresholds, "posts": posts_selected, "words": selected["words"],
+                         "users": users_selected, "duplicates_removed": selected["duplicates"]})
+
+@instrumentation.instrument("create_corpora_sweep")
+def sweep(posts, PR_mins, not_PR_maxes, min_words_list, outfile="output/create_corpora_sweep.csv", dedupe="exact",
+          bits=64):
+    # size of the PR-BD Corpus and Reference Corpus for each combination of cut-offs, without writing the corpora
+    # duplicates (same text by same user) have the same word count and PR score, so they are removed once for all
+    # cut-offs: each post that is kept counts the duplicates that were removed with it
+    # (near duplicates, dedupe="simhash", are counted with the post that is kept even if their word count differs)
+    kept_for = dd.representatives([posts], dedupe, bits)
+    keep = kept_for == np.arange(len(kept_for))
+    duplicates = np.bincount(kept_for, minlength=len(kept_for))[keep] - 1
+    posts = posts[keep]
+    words = posts.text_wordcount.to_numpy()
+    PR = posts.PR.to_numpy()
+    users = posts.user_id.to_numpy()
+
+    results = []
+    for minimum in min_words_list:
+        keep = words >= minimum
+        results.append(pd.DataFrame({"min_words": [minimum], "corpus": ["all"], "threshold": [np.nan],
+                                     "posts": [keep.sum()], "words": [words[keep].sum()],
+                                     "users": [pd.unique(users[keep]).size], "duplicates_removed": [duplicates[keep].sum()]}))
+        for corpus, thresholds, above in [("PR-BD", PR_mins, True), ("Reference", not_PR_maxes, False)]:
+            result = _sweep_corpus(PR[keep], words[keep], users[keep], duplicates[keep],
+                                   np.asarray(thresholds, dtype=float), above)
+            result.insert(0, "corpus", corpus)
+            result.insert(0, "min_words", minimum)
+            results.append(result)
+    results = pd.concat(results, ignore_index=True)
+    results.to_csv(outfile, index=False)
+    print(results.to_string(index=False))
+    print("Wrote sweep of %d cut-off combinations to %s" %(len(results), outfile))
+    return results
+
+@instrumentation.instrument("create_corpora_from_ids", rows=lambda corpora: len(corpora[0]) + len(corpora[1]))
+def from_ids(layout="files"):
+    # one pass over posts_text.csv and posts_meta.csv for both corpora
+    select_posts_multiple(["PR-BD_Corpus_post_ids.csv", "Reference_Corpus_post_ids.csv"])
     PR = pd.read_csv(c.data + "PR-BD_Corpus.csv")
     PR_scores = pd.read_csv(c.post_ids + "PR-BD_Corpus_post_ids.csv")
     PR = PR.merge(PR_scores, left_on="id", right_on="id")
@@ -68,4 +138,40 @@ elif mode == "ids":
     PR_scores = pd.read_csv(c.post_ids + "Reference_Corpus_post_ids.csv")
     not_PR = not_PR.merge(PR_scores, left_on="id", right_on="id")
 
-    write_corpora(PR, not_PR, cols_to_write=['id', 'user_id', 'subreddit_name', 'text_wordcount', 'text', 'PR'])
\ No newline at end of file
+    write_corpora(PR, not_PR, cols_to_write=['id', 'user_id', 'subreddit_name', 'text_wordcount', 'text', 'PR'],
+                  layout=layout)
+    return PR, not_PR
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create the PR-BD Corpus and Reference Corpus")
+    parser.add_argument("mode", choices=["select", "ids", "sweep"],
+                        help="select: by PR score cut-offs, ids: from the post ids files, sweep: corpus sizes for a grid "
+                             "of cut-offs")
+    # layout of the per-user files of the PR-BD Corpus, see corpus_files.py
+    parser.add_argument("layout", nargs="?", default="files", choices=["files", "tar", "zip", "offsets", "none"])
+    parser.add_argument("--PR_min", type=float, nargs="+", default=[PR_min],
+                        help="PR-BD Corpus: posts with PR score > PR_min (select: one value, sweep: several)")
+    parser.add_argument("--not_PR_max", type=float, nargs="+", default=[not_PR_max],
+                        help="Reference Corpus: posts with PR score < not_PR_max")
+    parser.add_argument("--min_words", type=int, nargs="+", default=[min_words], help="Posts with at least min_words words")
+    parser.add_argument("--dedupe", choices=dd.modes, default="exact",
+                        help="Duplicates: same text (exact), same text after lowercasing and removing links and "
+                             "whitespace (normalised) or near duplicates (simhash)")
+    parser.add_argument("--bits", type=int, choices=[64, 128], default=64, help="Bits of the text fingerprints")
+    parser.add_argument("--write", nargs=3, metavar=("PR_MIN", "NOT_PR_MAX", "MIN_WORDS"),
+                        help="sweep: afterwards write the corpora of the chosen cut-offs")
+    args = parser.parse_args()
+
+    if args.mode == "select":
+        if max(len(args.PR_min), len(args.not_PR_max), len(args.min_words)) > 1:
+            parser.error("select takes one value per cut-off, use sweep for several")
+        select(args.layout, args.PR_min[0], args.not_PR_max[0], args.min_words[0], dedupe=args.dedupe, bits=args.bits)
+    elif args.mode == "ids":
+        from_ids(args.layout)
+    else:
+        # posts_bd_PR_scored.csv is read once for the sweep and the chosen cut-offs
+        posts = read_scored_posts()
+        sweep(posts, args.PR_min, args.not_PR_max, args.min_words, dedupe=args.dedupe, bits=args.bits)
+        if args.write:
+            select(args.layout, float(args.write[0]), float(args.write[1]), int(args.write[2]), posts=posts,
+                   dedupe=args.dedupe, bits=args.bits)
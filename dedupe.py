@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# streaming removal of duplicate posts (same text by the same user), used by create_corpora.py
+# the posts are read in chunks and only a fingerprint of each text is kept: a 64-bit (or 128-bit) hash of the text
+# (SipHash, pd.util.hash_array) together with the user id, so the texts of all posts are never in memory at once
+# as with drop_duplicates(subset=["text", "user_id"], keep="last"), the last post of each group of duplicates is kept
+# modes:
+# - exact: same text
+# - normalised: same text after lowercasing, removing links and collapsing whitespace
+# - simhash: near duplicates, 64-bit SimHash of the words of the normalised text within a Hamming distance of at most
+#   max_distance (default 3) - candidates are posts of the same user that have one of 4 16-bit bands of the SimHash
+#   in common, so each pair of near duplicates is found without comparing all posts of a user
+#
+# python dedupe.py data/posts_bd_PR_scored.csv -m simhash
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+modes = ["exact", "normalised", "simhash"]
+chunksize = 100000
+# posts per SimHash batch: the batch's words x 64 bits are in memory at once
+simhash_batch_size = 2000
+max_distance = 3
+bands = 4
+# second key of pd.util.hash_array for 128-bit fingerprints (16 characters)
+hash_key_2 = "dedupe128bitskey"
+
+def normalise(texts):
+    texts = pd.Series(texts, dtype=object).fillna("").astype(str).str.lower()
+    texts = texts.str.replace(r"https?://\S+|www\.\S+", " ", regex=True)
+    return texts.str.replace(r"\s+", " ", regex=True).str.strip()
+
+def fingerprints(texts, bits=64):
+    # 64-bit hash of each text, (n, 2) array for 128 bits
+    texts = np.asarray(texts, dtype=object)
+    if bits == 64:
+        return pd.util.hash_array(texts)
+    if bits == 128:
+        return np.stack([pd.util.hash_array(texts), pd.util.hash_array(texts, hash_key=hash_key_2)], axis=1)
+    raise ValueError("Fingerprints have 64 or 128 bits: %s" %bits)
+
+def simhashes(texts):
+    # 64-bit SimHash of the words of each (normalised) text
+    result = np.zeros(len(texts), dtype=np.uint64)
+    shifts = np.arange(64, dtype=np.uint64)
+    texts = pd.Series(texts, dtype=object).reset_index(drop=True)
+    for start in range(0, len(texts), simhash_batch_size):
+        words = texts[start:start + simhash_batch_size].str.split(" ")
+        lengths = words.str.len().to_numpy()
+        hashes = pd.util.hash_array(np.asarray(words.explode().fillna("").to_numpy(), dtype=object))
+        # +1 for each set bit of a word's hash, -1 otherwise, summed over the words of each text
+        signs = ((hashes[:, None] >> shifts) & np.uint64(1)).astype(np.int32) * 2 - 1
+        weights = np.add.reduceat(signs, np.concatenate([[0], np.cumsum(lengths)[:-1]]), axis=0)
+        result[start:start + len(words)] = ((weights > 0).astype(np.uint64) << shifts).sum(axis=1, dtype=np.uint64)
+    return result
+
+def _popcount(values):
+    return np.unpackbits(np.ascontiguousarray(values, dtype=np.uint64).view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+def _last_of_group(keys):
+    # row number of the last row with the same key for each row (keys: (n, k) array)
+    _, groups = np.unique(keys, axis=0, return_inverse=True)
+    groups = groups.reshape(-1)
+    last = np.zeros(groups.max() + 1 if len(groups) else 0, dtype=np.int64)
+    np.maximum.at(last, groups, np.arange(len(groups)))
+    return last[groups]
+
+def _near_duplicates(users, hashes, rows, distance=max_distance):
+    # last row of the group of near duplicates of each row (groups connected by pairs within distance, union-find)
+    parent = np.arange(len(rows))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for band in range(bands):
+        values = (hashes >> np.uint64(band * 64 // bands)) & np.uint64((1 << (64 // bands)) - 1)
+        order = np.lexsort((values, users))
+        same = (users[order][1:] == users[order][:-1]) & (values[order][1:] == values[order][:-1])
+        # groups of consecutive rows with the same user and band
+        starts = np.flatnonzero(np.concatenate([[True], ~same]))
+        ends = np.concatenate([starts[1:], [len(order)]])
+        for start, end in zip(starts[ends - starts > 1], ends[ends - starts > 1]):
+            group = order[start:end]
+            first, second = np.triu_indices(len(group), k=1)
+            close = _popcount(hashes[group[first]] ^ hashes[group[second]]) <= distance
+            for i, j in zip(group[first[close]].tolist(), group[second[close]].tolist()):
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j:
+                    parent[root_i] = root_j
+    roots = np.array([find(i) for i in range(len(rows))], dtype=np.int64)
+    return pd.Series(rows).groupby(roots).transform("max").to_numpy()
+
+def representatives(chunks, mode="exact", bits=64, user_column="user_id", text_column="text"):
+    # chunks: DataFrames with the user and text columns of consecutive rows (e.g. pd.read_csv(chunksize=...))
+    # returns for each row the number of the row that is kept for it (the row itself if it is kept)
+    if mode not in modes:
+        raise ValueError("Unknown dedupe mode %s, expected one of %s" %(mode, ", ".join(modes)))
+    users, keys, near = [], [], []
+    with instrumentation.stage("dedupe_fingerprints", mode=mode) as progress:
+        for chunk in chunks:
+            texts = chunk[text_column].fillna("").astype(str)
+            if mode != "exact":
+                texts = normalise(texts)
+            users.append(chunk[user_column].to_numpy(dtype=np.int64))
+            keys.append(fingerprints(texts, bits).reshape(len(chunk), -1))
+            if mode == "simhash":
+                near.append(simhashes(texts))
+            progress.add_rows(len(chunk))
+    if not users:
+        return np.zeros(0, dtype=np.int64)
+    users = np.concatenate(users)
+    kept_for = _last_of_group(np.column_stack([users.astype(np.uint64), np.concatenate(keys)]))
+    rows = np.flatnonzero(kept_for == np.arange(len(kept_for)))
+    print("Duplicates (%s): %d of %d posts" %("same text" if mode == "exact" else "same normalised text",
+                                               len(kept_for) - len(rows), len(kept_for)))
+    if mode == "simhash":
+        near_kept_for = np.arange(len(kept_for))
+        near_kept_for[rows] = _near_duplicates(users[rows], np.concatenate(near)[rows], rows)
+        kept_for = near_kept_for[kept_for]
+        print("Near duplicates (SimHash distance <= %d): %d more posts" %(
+            max_distance, len(rows) - (kept_for == np.arange(len(kept_for))).sum()))
+    return kept_for
+
+def keep_mask(chunks, mode="exact", bits=64, **kwargs):
+    # True for the rows that are kept
+    kept_for = representatives(chunks, mode, bits, **kwargs)
+    return kept_for == np.arange(len(kept_for))
+
+def read_deduplicated(fname, mode="exact", bits=64, condition=None, chunksize=chunksize, **csv_kwargs):
+    # two passes over fname: fingerprints of the user ids and texts, then the rows that are kept and match
+    # condition (function of a chunk returning a boolean Series, e.g. a minimum word count)
+    keep = keep_mask(pd.read_csv(fname, usecols=["user_id", "text"], chunksize=chunksize, **csv_kwargs), mode, bits)
+    selected = []
+    start = 0
+    for chunk in pd.read_csv(fname, chunksize=chunksize, **csv_kwargs):
+        mask = keep[start:start + len(chunk)]
+        if condition is not None:
+            mask = mask & condition(chunk).to_numpy()
+        selected.append(chunk[mask])
+        start += len(chunk)
+    return pd.concat(selected) if selected else pd.DataFrame()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Count duplicate posts (same user) in a csv file")
+    parser.add_argument("fname", help="csv file with user_id and text columns, e.g. data/posts_bd_PR_scored.csv")
+    parser.add_argument("-m", "--mode", choices=modes, default="exact")
+    parser.add_argument("-b", "--bits", type=int, choices=[64, 128], default=64, help="Bits of the text fingerprints")
+    args = parser.parse_args()
+    keep_mask(pd.read_csv(args.fname, usecols=["user_id", "text"], chunksize=chunksize, keep_default_na=False,
+                          na_values=[]), args.mode, args.bits)
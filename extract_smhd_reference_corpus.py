@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+# extracts the SMHD Reference Corpus (exploratory study 1) from SMHD_train.jl.gz (SMHDv1.1)
+# post_ids/SMHD_Reference_Corpus_post_ids.csv gives user_id;post_id pairs: the user id is the field "id" of a record
+# (one user per line) and the post id the index of the post in the record's "posts" list (starting with 0)
+# the dump is decompressed and read in one pass, one record at a time (with pigz if installed, which decompresses in
+# a separate thread); only the records of the wanted users are parsed, the id of a record is read from the start of
+# the line if possible
+# with -p, the records of the wanted users are parsed by a process pool (the ids are checked before)
+# output as for the corpora of create_corpora.py: SMHD_Reference_Corpus.csv (columns of the corpora created from post
+# ids, the posts numbered in the order of the dump as id, no subreddit and PR score, and the post index in the record
+# as post_index), SMHD_Reference_Corpus.txt and the texts per user (SMHD_Reference_Corpus/ or another layout, see
+# corpus_files.py)
+#
+# python extract_smhd_reference_corpus.py /path/to/SMHD_train.jl.gz
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+
+import pandas as pd
+
+import config as c
+import corpus_files as cf
+import instrumentation
+
+post_ids_file = c.post_ids + "SMHD_Reference_Corpus_post_ids.csv"
+corpus = "SMHD_Reference_Corpus"
+# columns of the corpora of create_corpora.py (created from post ids) and the post index in the record
+columns = ["id", "user_id", "subreddit_name", "text_wordcount", "text", "PR", "post_index"]
+# "id" as the first field of a record
+record_id = re.compile(r'^\s*\{\s*"id"\s*:\s*"?([^",}\s]+)')
+
+# wanted post indexes per user id of the worker processes, set by _init
+_wanted = {}
+
+def read_wanted(fname=post_ids_file):
+    # user id (str) -> sorted post indexes
+    pairs = pd.read_csv(fname, sep=";", dtype=str, header=None, names=["user_id", "post_id"])
+    # with or without header row: a header has no post index in the second column
+    if len(pairs) and not pairs.post_id.iloc[0].strip().isdigit():
+        print("Skipping header %s;%s of %s" %(pairs.user_id.iloc[0], pairs.post_id.iloc[0], fname))
+        pairs = pairs.iloc[1:]
+    pairs["post_id"] = pairs.post_id.astype(int)
+    return {user_id: sorted(posts) for user_id, posts in pairs.groupby("user_id").post_id}
+
+def open_dump(fname):
+    # lines of the decompressed dump (bytes) and the pigz process (None if pigz is not used)
+    if fname.endswith(".gz") and shutil.which("pigz") is not None:
+        process = subprocess.Popen(["pigz", "-dc", fname], stdout=subprocess.PIPE, bufsize=1024 * 1024)
+        return process.stdout, process
+    if fname.endswith(".gz"):
+        return io.BufferedReader(gzip.open(fname, "rb"), buffer_size=1024 * 1024), None
+    return open(fname, "rb"), None
+
+def _init(wanted):
+    _wanted.clear()
+    _wanted.update(wanted)
+
+def maybe_wanted(line):
+    # False if the id at the start of the line is not wanted (records without id at the start need to be parsed)
+    match = record_id.match(line[:100].decode("utf-8", errors="replace"))
+    return match is None or match.group(1) in _wanted
+
+def parse_record(line, text_field="text"):
+    # (user id, [(post index, text)]) of a wanted user, None otherwise
+    if not maybe_wanted(line):
+        return None
+    record = json.loads(line)
+    user_id = str(record["id"])
+    if user_id not in _wanted:
+        return None
+    posts = record["posts"]
+    return user_id, [(index, posts[index][text_field] if index < len(posts) else None) for index in _wanted[user_id]]
+
+def extract(dump_file, wanted, layout="files", processes=1, text_field="text"):
+    outfile = c.data + corpus + ".csv"
+    staging = {extension: "%s%s.staging-%d.%s" %(c.data, corpus, os.getpid(), extension) for extension in ["csv", "txt"]}
+    found = set()
+    n_posts = 0
+    missing_posts = 0
+
+    dump, decompress = open_dump(dump_file)
+    # the ids are checked in this process, with -p too
+    _init(wanted)
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=_init, initargs=(wanted,))
+        records = _parse_parallel(pool, dump, text_field, 16 * processes)
+    else:
+        pool = None
+        records = (parse_record(line, text_field) for line in dump)
+
+    try:
+        with instrumentation.stage("extract_smhd_reference_corpus", total=None, users=len(wanted)) as progress, \
+                open(staging["csv"], "w", newline="", encoding="utf-8") as csv_file, \
+                open(staging["txt"], "w", encoding="utf-8") as txt_file, \
+                cf.UserFileWriter(c.data + corpus + "/", layout) if layout != "none" else _NoUserFiles() as user_files:
+            writer = csv.writer(csv_file)
+            writer.writerow(columns)
+            for record in records:
+                progress.add_rows(1)
+                if record is None:
+                    continue
+                user_id, posts = record
+                found.add(user_id)
+                texts = []
+                for index, text in posts:
+                    if text is None:
+                        print("User %s has no post %d" %(user_id, index))
+                        missing_posts += 1
+                        continue
+                    writer.writerow([n_posts, user_id, "", len(text.split()), text, "", index])
+                    # .txt file format for LancsBox - only the texts, one per line
+                    txt_file.write(("\n" if n_posts else "") + text)
+                    texts.append(text)
+                    n_posts += 1
+                user_files.add(user_id, "\n".join(texts))
+                # all wanted users found: the rest of the dump does not need to be read
+                if len(found) == len(wanted):
+                    break
+            progress.fields["posts"] = n_posts
+    except BaseException:
+        for fname in staging.values():
+            if os.path.exists(fname):
+                os.remove(fname)
+        raise
+    finally:
+        if pool is not None:
+            pool.terminate()
+        dump.close()
+        if decompress is not None:
+            # stopped before the end of the dump if all users were found
+            decompress.kill()
+            decompress.wait()
+    for extension, fname in staging.items():
+        os.replace(fname, c.data + corpus + "." + extension)
+    print("Extracted %d posts of %d users to %s" %(n_posts, len(found), outfile))
+    if len(found) < len(wanted) or missing_posts:
+        print("Not found: %d users, %d posts" %(len(wanted) - len(found), missing_posts))
+    return n_posts
+
+def _parse_parallel(pool, dump, text_field, batch_size):
+    # parses batch_size records of wanted users at a time, so that at most batch_size records are in memory; the
+    # records of the other users are not sent to the pool (None, as from parse_record)
+    parse = _parse_record_text(text_field)
+    lines = []
+    for line in dump:
+        if not maybe_wanted(line):
+            yield None
+            continue
+        lines.append(line)
+        if len(lines) == batch_size:
+            for record in pool.map(parse, lines, chunksize=1):
+                yield record
+            lines = []
+    for record in pool.map(parse, lines, chunksize=1):
+        yield record
+
+class _parse_record_text(object):
+    # picklable parse_record with a text field for the process pool
+    def __init__(self, text_field):
+        self.text_field = text_field
+
+    def __call__(self, line):
+        return parse_record(line, self.text_field)
+
+class _NoUserFiles(object):
+    # layout "none": no per-user texts
+    def add(self, user_id, text):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Extract the SMHD Reference Corpus from SMHD_train.jl.gz")
+    parser.add_argument("dump", help="SMHD_train.jl.gz")
+    parser.add_argument("-i", "--post_ids", default=post_ids_file, help="user_id;post_id pairs (with or without header)")
+    parser.add_argument("-l", "--layout", default="files", choices=cf.layouts + ["none"],
+                        help="Layout of the per-user texts, see corpus_files.py")
+    parser.add_argument("-p", "--processes", type=int, default=1, help="Processes parsing the records")
+    parser.add_argument("-t", "--text_field", default="text", help="Field of the post text in the records")
+    args = parser.parse_args()
+    extract(args.dump, read_wanted(args.post_ids), args.layout, args.processes, args.text_field)
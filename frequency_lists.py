@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+# frequency lists of two (or more) tagged corpora in the input format of keyness.py (read_items_csv):
+# item,f_corpus,f_reference with the total number of counted tokens in the first row (TOTAL), e.g.
+# exploratory_study_1/BD_Subreddit_SMHD_Reference_Corpus_domains_frequency.csv
+# tagged corpora:
+# - vertical files: one token per line, tab-separated columns (e.g. word, POS tag, USAS semantic tag); empty lines and
+#   lines starting with < (e.g. <s>, <text id=...>) are skipped; the item is one column or several joined by _
+#   (e.g. --columns 0 1 for word_POS), with --first_tag only the first of several space-separated tags is counted
+# - token tables of process_posts_with_spacy.py (token_table.py): the item is one or more string columns (e.g. lemma,
+#   lemma pos), optionally only the tokens of the posts in a corpus file written by create_corpora.py
+# the files are split into ranges (byte ranges at line starts / token rows) that are counted by a process pool, the
+# counts of the ranges are added up, so the memory needed depends on the number of unique items, not on the corpus size
+#
+# python frequency_lists.py -c BD_Subreddit_Corpus.vert -r SMHD_Reference_Corpus.vert --columns 2 --first_tag -o exploratory_study_1/BD_Subreddit_SMHD_Reference_Corpus_domains_frequency.csv
+# python frequency_lists.py -c data/posts_bd_spacy.csv --corpus_posts PR-BD_Corpus.csv -r data/posts_bd_spacy.csv --reference_posts Reference_Corpus.csv --columns lemma --lower -o data/PR-BD_Reference_Corpus_lemmas_frequency.csv
+
+import argparse
+import multiprocessing
+import os
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+import config as c
+import instrumentation
+import token_table as tt
+
+# ranges per process, so that the processes finish at about the same time
+ranges_per_process = 4
+
+def _vertical_item(line, columns, separator, lower, first_tag):
+    fields = line.rstrip("\r\n").split(separator)
+    if len(fields) <= max(columns):
+        return None
+    values = [fields[col].split()[0] if first_tag and fields[col].strip() else fields[col] for col in columns]
+    item = "_".join(values)
+    return item.lower() if lower else item
+
+def count_vertical_range(fname, start, end, columns, separator="\t", lower=False, first_tag=False):
+    # counts the items of the lines that start in [start, end)
+    counts = Counter()
+    with open(fname, "rb") as f:
+        if start > 0:
+            # the line that contains start - 1 belongs to the previous range
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            line = line.decode("utf-8", errors="replace")
+            if not line.strip() or line.startswith("<"):
+                continue
+            item = _vertical_item(line, columns, separator, lower, first_tag)
+            if item is not None:
+                counts[item] += 1
+    return counts
+
+def count_table_range(fname, row_ranges, columns, exclude_pos=()):
+    # (keys, counts) of the combined codes of the columns in the row ranges of the token table
+    table = tt.TokenTable(fname)
+    sizes = [len(table.vocab(col)) for col in columns]
+    excluded = np.flatnonzero(np.isin(np.asarray(table.vocab("pos"), dtype=object), list(exclude_pos))) \
+        if exclude_pos else None
+    keys = []
+    for start, end in row_ranges:
+        key = np.zeros(end - start, dtype=np.int64)
+        for col, size in zip(columns, sizes):
+            key = key * size + np.asarray(table.codes(col)[start:end], dtype=np.int64)
+        if excluded is not None:
+            key = key[~np.isin(np.asarray(table.codes("pos")[start:end]), excluded)]
+        keys.append(key)
+    keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+    return np.unique(keys, return_counts=True)
+
+def _vertical_ranges(fname, n_ranges):
+    size = os.path.getsize(fname)
+    bounds = np.linspace(0, size, n_ranges + 1).astype(np.int64)
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+def _table_ranges(fname, n_ranges, post_ids=None):
+    # row ranges of the posts (all posts or the posts with the given ids), split into n_ranges groups of similar size
+    table = tt.TokenTable(fname)
+    offsets = np.asarray(table.offsets)
+    if post_ids is None:
+        posts = np.arange(len(table.post_ids))
+    else:
+        posts = np.flatnonzero(np.isin(np.asarray(table.post_ids), np.asarray(post_ids)))
+    starts, ends = offsets[posts], offsets[posts + 1]
+    cumulative = np.cumsum(ends - starts)
+    groups = np.searchsorted(np.linspace(0, cumulative[-1] if len(cumulative) else 0, n_ranges + 1)[1:-1], cumulative,
+                             side="left") if len(cumulative) else np.zeros(0, dtype=np.int64)
+    return [list(zip(starts[groups == group].tolist(), ends[groups == group].tolist())) for group in range(n_ranges)
+            if (groups == group).any()]
+
+def _map(function, tasks, processes):
+    if processes == 1:
+        return [function(*task) for task in tasks]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.starmap(function, tasks)
+
+def count(fname, columns, processes=1, post_ids=None, lower=False, first_tag=False, separator="\t", exclude_pos=()):
+    # pd.Series item -> frequency of a tagged corpus
+    n_ranges = processes * ranges_per_process
+    with instrumentation.stage("count_items", file=fname, processes=processes) as progress:
+        if tt.exists(fname):
+            columns = [str(col) for col in columns]
+            results = _map(count_table_range, [(fname, ranges, columns, exclude_pos)
+                                               for ranges in _table_ranges(fname, n_ranges, post_ids)], processes)
+            keys, counts = (np.concatenate(values) for values in zip(*results)) if results else ([], [])
+            keys, inverse = np.unique(keys, return_inverse=True)
+            counts = np.bincount(inverse.reshape(-1), weights=counts).astype(np.int64)
+            table = tt.TokenTable(fname)
+            items = None
+            # decode the combined codes, last column first
+            for col in reversed(columns):
+                vocab = np.asarray(table.vocab(col), dtype=object)
+                size = len(vocab)
+                values = vocab[keys % size]
+                items = values if items is None else values + "_" + items
+                keys = keys // size
+            frequencies = pd.Series(counts, index=pd.Index(items if items is not None else [], dtype=object))
+            if lower:
+                frequencies = frequencies.groupby(frequencies.index.str.lower()).sum()
+        else:
+            if post_ids is not None:
+                raise ValueError("Selecting posts needs the token table of %s" %fname)
+            columns = [int(col) for col in columns]
+            total = Counter()
+            for counts in _map(count_vertical_range, [(fname, start, end, columns, separator, lower, first_tag)
+                                                      for start, end in _vertical_ranges(fname, n_ranges)], processes):
+                # Counter.update adds the counts
+                total.update(counts)
+            frequencies = pd.Series(total, dtype=np.int64)
+        progress.set_rows(int(frequencies.sum()))
+    print("Counted %d tokens, %d unique items in %s" %(frequencies.sum(), len(frequencies), fname))
+    return frequencies
+
+def write_frequency_list(frequencies, frequencies_reference, outfile):
+    # frequencies: dict corpus name -> pd.Series (one corpus: "corpus")
+    # items that do not occur in a corpus have frequency 0
+    items = pd.DataFrame({"f_%s" %name: counts for name, counts in frequencies.items()})
+    items["f_reference"] = frequencies_reference
+    items = items.fillna(0).astype(np.int64)
+    items = items.sort_values(list(items.columns), ascending=False, kind="mergesort")
+    items.index.name = "item"
+    totals = pd.DataFrame([items.sum()], index=pd.Index(["TOTAL"], name="item"))
+    pd.concat([totals, items]).to_csv(outfile)
+    print("Wrote frequencies of %d items to %s" %(len(items), outfile))
+
+def _post_ids(corpus_file):
+    return None if corpus_file is None else pd.read_csv(c.data + corpus_file, usecols=["id"]).id.to_numpy()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Frequency lists of tagged corpora as input for keyness.py")
+    parser.add_argument("-c", "--corpus", nargs="+", required=True,
+                        help="Tagged corpus (vertical file or *_spacy.csv with a token table), several corpora are "
+                             "written as f_<file name> columns")
+    parser.add_argument("-r", "--reference", required=True, help="Tagged reference corpus")
+    parser.add_argument("--corpus_posts", nargs="+", help="Token tables: corpus files of the posts to count, e.g. "
+                                                          "PR-BD_Corpus.csv (one per corpus)")
+    parser.add_argument("--reference_posts", help="Token table: corpus file of the reference posts, e.g. Reference_Corpus.csv")
+    parser.add_argument("--columns", nargs="+", default=["0"],
+                        help="Columns of the item: indexes (vertical files) or names (token tables)")
+    parser.add_argument("--separator", default="\t", help="Column separator of vertical files")
+    parser.add_argument("--lower", action="store_true", help="Lowercase the items")
+    parser.add_argument("--first_tag", action="store_true", help="Only the first of several space-separated tags")
+    parser.add_argument("--exclude_pos", nargs="+", default=[], help="Token tables: skip tokens with these POS tags, "
+                                                                      "e.g. PUNCT SPACE")
+    parser.add_argument("-p", "--processes", type=int, default=1)
+    parser.add_argument("-o", "--outfile", required=True)
+    args = parser.parse_args()
+
+    corpus_posts = args.corpus_posts or [None] * len(args.corpus)
+    frequencies = {}
+    for corpus, posts in zip(args.corpus, corpus_posts):
+        name = "corpus" if len(args.corpus) == 1 else \
+            os.path.splitext(os.path.basename(posts or corpus))[0].replace("_spacy", "")
+        frequencies[name] = count(corpus, args.columns, args.processes, _post_ids(posts), args.lower, args.first_tag,
+                                  args.separator, args.exclude_pos)
+    frequencies_reference = count(args.reference, args.columns, args.processes, _post_ids(args.reference_posts),
+                                  args.lower, args.first_tag, args.separator, args.exclude_pos)
+    write_frequency_list(frequencies, frequencies_reference, args.outfile)
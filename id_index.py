@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+# persistent index of the post ids in a csv file (e.g. posts_meta.csv, posts_text.csv, a tokenised posts file), so that
+# the rows of selected posts are read with one seek per post instead of reading the whole file
+# the index of data/posts_text.csv is the directory data/posts_text_id_index/ with NumPy arrays sorted by id:
+# - ids.npy: the ids
+# - offsets.npy, lengths.npy: byte offset and length of the rows of each id in the csv file
+# - rows.npy, counts.npy: number of the first row of each id and number of rows (several rows per id in token files,
+#   the rows of an id need to be consecutive)
+# the arrays are opened with mmap_mode="r" and looked up by binary search
+# meta.json stores the size and modification time of the csv file: the index is not used if the file changed
+# the file is scanned in blocks with NumPy (byte offsets of the records) and pandas (ids of the records), not row by row
+#
+# the index of post_id_mapping.csv (original_id -> id, see anonymise_posts.py) is stored in
+# data/post_id_mapping_index/ (original_ids.npy sorted, ids.npy), the index of a user id/name mapping
+# (user_id_mapping.csv, same columns) in data/user_id_mapping_index/, the original ids are stored as UTF-8 bytes
+#
+# python id_index.py data/posts_meta.csv data/posts_text.csv
+# python id_index.py --mapping /path/to/post_id_mapping.csv
+# python id_index.py --user_mapping /path/to/user_id_mapping.csv
+
+import argparse
+import io
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import config as c
+import instrumentation
+
+mapping_index = c.data + "post_id_mapping_index/"
+user_mapping_index = c.data + "user_id_mapping_index/"
+
+def index_path(fname):
+    # data/posts_text.csv -> data/posts_text_id_index/
+    return fname[:-len(".csv")] + "_id_index/" if fname.endswith(".csv") else fname + "_id_index/"
+
+def _source_stat(fname):
+    stat = os.stat(fname)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def available(fname):
+    # True if fname has an index that is up to date
+    meta_file = os.path.join(index_path(fname), "meta.json")
+    if not os.path.exists(meta_file):
+        return False
+    with open(meta_file) as f:
+        meta = json.load(f)
+    if meta["source"] != _source_stat(fname):
+        print("%s changed since its id index was built, not using the index" %fname)
+        return False
+    return True
+
+def _record_offsets(f, blocksize=2 ** 26):
+    # byte offset of each csv record from the position of f on, and the end of the last record: a line break ends a
+    # record if the number of quotes up to it is even (quoted fields can contain line breaks, quotes in quoted fields
+    # are doubled)
+    position = f.tell()
+    offsets = [np.array([position], dtype=np.int64)]
+    quotes = 0
+    while True:
+        block = f.read(blocksize)
+        if not block:
+            break
+        block = np.frombuffer(block, dtype=np.uint8)
+        quote_positions = np.flatnonzero(block == ord('"'))
+        line_breaks = np.flatnonzero(block == ord("\n"))
+        # number of quotes before each line break (in the file)
+        parity = (quotes + np.searchsorted(quote_positions, line_breaks)) % 2
+        offsets.append(position + line_breaks[parity == 0] + 1)
+        quotes += len(quote_positions)
+        position += len(block)
+    offsets = np.concatenate(offsets)
+    # a last record without line break ends at the end of the file
+    return offsets if offsets[-1] == position else np.append(offsets, position)
+
+def _ids(fname, id_column, chunksize=10 ** 6):
+    for chunk in pd.read_csv(fname, usecols=[id_column], dtype={id_column: np.int64}, chunksize=chunksize):
+        yield chunk[id_column].to_numpy()
+
+def build(fname, id_column="id"):
+    with instrumentation.stage("build_id_index", file=fname) as progress:
+        with open(fname, "rb") as f:
+            header = f.readline()
+            bounds = _record_offsets(f)
+        post_ids = []
+        for chunk in _ids(fname, id_column):
+            post_ids.append(chunk)
+            progress.add_rows(len(chunk))
+        post_ids = np.concatenate(post_ids) if post_ids else np.zeros(0, dtype=np.int64)
+        if len(post_ids) != len(bounds) - 1:
+            raise ValueError("%s has %d csv records but %d ids (empty lines?)" %(fname, len(bounds) - 1,
+                                                                                 len(post_ids)))
+        # the rows of an id (e.g. the tokens of a post) are one entry: first row, number of rows, bytes of the rows
+        starts = np.flatnonzero(np.concatenate([[True], post_ids[1:] != post_ids[:-1]])) if len(post_ids) else \
+            np.zeros(0, dtype=np.int64)
+        ends = np.append(starts[1:], len(post_ids))
+        ids, rows, counts = post_ids[starts], starts, ends - starts
+        offsets, lengths = bounds[starts], bounds[ends] - bounds[starts]
+
+    order = np.argsort(ids, kind="stable")
+    if len(ids) and (np.diff(ids[order]) == 0).any():
+        raise ValueError("The rows of each id in %s need to be consecutive" %fname)
+    path = index_path(fname)
+    os.makedirs(path, exist_ok=True)
+    for name, values in [("ids", ids), ("offsets", offsets), ("lengths", lengths), ("rows", rows), ("counts", counts)]:
+        np.save(os.path.join(path, "%s.npy" %name), np.asarray(values, dtype=np.int64)[order])
+    # written last: an index without meta.json is incomplete
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"source": _source_stat(fname), "header_length": len(header), "id_column": id_column}, f)
+    print("Indexed %d ids in %s" %(len(ids), fname))
+
+class IdIndex(object):
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.path = index_path(fname)
+        with open(os.path.join(self.path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.ids = self._load("ids")
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, "%s.npy" %name), mmap_mode="r")
+
+    def positions(self, ids):
+        # positions of the ids in the index (binary search), ids that are not in the file are left out
+        ids = np.unique(np.asarray(list(ids) if isinstance(ids, (set, frozenset)) else ids, dtype=np.int64))
+        if not len(self.ids):
+            return np.zeros(0, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+        return positions[np.asarray(self.ids[positions]) == ids]
+
+    def rows(self, ids):
+        # first row number and number of rows of each of the ids that is in the file (sorted by id)
+        positions = self.positions(ids)
+        return np.asarray(self._load("rows")[positions]), np.asarray(self._load("counts")[positions])
+
+    def read(self, ids, **csv_kwargs):
+        # the rows of the ids (in the order of the file), csv_kwargs are passed to pd.read_csv (e.g. usecols)
+        positions = self.positions(ids)
+        offsets = np.asarray(self._load("offsets")[positions])
+        lengths = np.asarray(self._load("lengths")[positions])
+        order = np.argsort(offsets)
+        with open(self.fname, "rb") as f:
+            data = [f.read(self.meta["header_length"])]
+            for offset, length in zip(offsets[order].tolist(), lengths[order].tolist()):
+                f.seek(offset)
+                record = f.read(length)
+                data.append(record if record.endswith(b"\n") else record + b"\n")
+        return pd.read_csv(io.BytesIO(b"".join(data)), **csv_kwargs)
+
+def _utf8(values):
+    # fixed-width bytes (sorted and compared by NumPy) of the values as strings
+    return pd.Series(values, dtype=object).astype(str).str.encode("utf-8").to_numpy(dtype="S")
+
+def build_mapping(mapping_file, index=mapping_index):
+    mapping = pd.read_csv(mapping_file, usecols=["original_id", "id"], dtype={"original_id": str})
+    original_ids = _utf8(mapping.original_id)
+    order = np.argsort(original_ids, kind="stable")
+    os.makedirs(index, exist_ok=True)
+    np.save(os.path.join(index, "ids.npy"), mapping.id.to_numpy(dtype=np.int64)[order])
+    # written last
+    np.save(os.path.join(index, "original_ids.npy"), original_ids[order])
+    print("Indexed %d original ids of %s" %(len(mapping), mapping_file))
+
+def mapping_available(index=mapping_index):
+    return os.path.exists(os.path.join(index, "original_ids.npy"))
+
+def map_original_ids(original_ids, index=mapping_index):
+    # id of each original id (NaN if it is not in the mapping, e.g. post_id_mapping.csv), same result as mapping with
+    # a dict
+    index_original_ids = np.load(os.path.join(index, "original_ids.npy"), mmap_mode="r")
+    index_ids = np.load(os.path.join(index, "ids.npy"), mmap_mode="r")
+    original_ids = pd.Series(original_ids)
+    keys = _utf8(original_ids)
+    positions = np.minimum(np.searchsorted(index_original_ids, keys), max(len(index_original_ids) - 1, 0))
+    found = (np.asarray(index_original_ids[positions]) == keys) & original_ids.notna().to_numpy() \
+        if len(index_original_ids) else np.zeros(len(keys), dtype=bool)
+    ids = pd.Series(np.nan, index=original_ids.index)
+    ids[found] = np.asarray(index_ids[positions[found]])
+    return ids if not found.all() else ids.astype(np.int64)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build id indexes of csv files")
+    parser.add_argument("files", nargs="*", help="csv files with an id column, e.g. %sposts_text.csv" %c.data)
+    parser.add_argument("-i", "--id_column", default="id", help="Name of the id column (e.g. post_id in token files)")
+    parser.add_argument("-m", "--mapping", help="post_id_mapping.csv (original_id -> id)", default=None)
+    parser.add_argument("-u", "--user_mapping", help="user_id_mapping.csv (original_id -> id) of user ids/names",
+                        default=None)
+    args = parser.parse_args()
+    for fname in args.files:
+        build(fname, args.id_column)
+    if args.mapping:
+        build_mapping(args.mapping)
+    if args.user_mapping:
+        build_mapping(args.user_mapping, user_mapping_index)
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+# incremental, out-of-core version of PR_scoring.score_posts
+# posts are added in batches: the term counts of each batch are stored as a sparse matrix in the state directory and
+# the document frequencies of all terms are updated, so adding new posts does not require re-vectorising the old ones
+# the PR score is the cosine similarity between the tf-idf vector of a post and of the PR terms, computed directly
+# from the term counts with the same definition as sklearn's TfidfVectorizer (lowercase, smooth_idf, l2 norm):
+# idf(t) = ln((1 + n) / (1 + df(t))) + 1
+# the stored posts are identified by id and a hash of the text: posts that are no longer in the input and old versions
+# of posts whose text changed are removed (retain), so that the document frequencies are those of the input
+# rescore() scores the new posts and only rescores the posts that contain a term whose idf drifted by more than a
+# relative tolerance from the idf baseline the stored scores were computed with (all posts if the idf of a PR term
+# drifted that much); the baseline is stored once, state.json records the batches it applies to (scored_batches)
+# count_shard/score_shards: sharded scoring with the idf of all shards
+
+import json
+import os
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+def count_terms(texts, vocabulary):
+    # sparse post x term count matrix, new terms are added to vocabulary (term -> column)
+    indptr = [0]
+    indices = []
+    data = []
+    for text in texts:
+        counts = Counter(text.lower().split())
+        for term, count in counts.items():
+            indices.append(vocabulary.setdefault(term, len(vocabulary)))
+            data.append(count)
+        indptr.append(len(indices))
+    return scipy.sparse.csr_matrix((np.array(data, dtype=np.float64), np.array(indices, dtype=np.int64),
+                                    np.array(indptr, dtype=np.int64)), shape=(len(indptr) - 1, len(vocabulary)))
+
+def query_counts(terms_file):
+    # the vectorizer lowercases the concatenated PR terms before splitting them
+    PR_terms = pd.read_csv(terms_file, usecols=["replacement"])
+    return Counter(" ".join(PR_terms.replacement.to_list()).lower().split())
+
+def idf(n_docs, df):
+    return np.log((1 + n_docs) / (1 + df)) + 1
+
+def query_vector(query_counts, vocabulary, idf, df=None):
+    # df: terms that no longer occur in any post (df 0, removed posts) are not in the vocabulary of the vectorizer
+    query = np.zeros(len(idf))
+    for term, count in query_counts.items():
+        if term in vocabulary and (df is None or df[vocabulary[term]] > 0):
+            query[vocabulary[term]] = count
+    query *= idf
+    norm = np.linalg.norm(query)
+    return query / norm if norm > 0 else query
+
+def score_rows(counts, idf, query):
+    # cosine similarity between the l2-normalised tf-idf vectors of the posts and the query vector
+    weighted = counts.multiply(idf[:counts.shape[1]]).tocsr()
+    norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+    scores = weighted @ query[:counts.shape[1]]
+    return np.divide(scores, norms, out=np.zeros_like(scores), where=norms > 0)
+
+def post_keys(ids, texts):
+    # (id, hash of the text) of each post: a post whose text changed is a different post
+    texts = np.asarray(texts, dtype=object)
+    return pd.MultiIndex.from_arrays([np.asarray(ids, dtype=np.int64), pd.util.hash_array(texts)],
+                                     names=["id", "hash"])
+
+class PRScorer(object):
+
+    def __init__(self, state_dir, terms_file):
+        self.state_dir = state_dir
+        os.makedirs(os.path.join(state_dir, "batches"), exist_ok=True)
+        if os.path.exists(self._file("state.json")):
+            with open(self._file("state.json")) as f:
+                state = json.load(f)
+            if "scored_batches" not in state:
+                raise ValueError("%s was written by an older version of incremental_scoring.py, delete it to score "
+                                 "all posts again" %state_dir)
+            self.n_docs, self.n_batches = state["n_docs"], state["n_batches"]
+            self.scored_batches = state["scored_batches"]
+            with open(self._file("vocabulary.json"), encoding="utf-8") as f:
+                self.vocabulary = {term: i for i, term in enumerate(json.load(f))}
+            self.df = np.load(self._file("df.npy"))
+            self.idf_baseline = np.load(self._file("idf_baseline.npy"))
+        else:
+            self.n_docs, self.n_batches, self.scored_batches = 0, 0, 0
+            self.vocabulary = {}
+            self.df = np.zeros(0, dtype=np.int64)
+            self.idf_baseline = np.zeros(0)
+
+        self.query_counts = query_counts(terms_file)
+
+    def _file(self, name):
+        return os.path.join(self.state_dir, name)
+
+    def _batch_file(self, name, batch):
+        return os.path.join(self.state_dir, "batches", "%s_%05d.npy" %(name, batch))
+
+    def _save_state(self):
+        np.save(self._file("df.npy"), self.df)
+        np.save(self._file("idf_baseline.npy"), self.idf_baseline)
+        with open(self._file("vocabulary.json"), "w", encoding="utf-8") as f:
+            json.dump(sorted(self.vocabulary, key=self.vocabulary.get), f)
+        # written last, so that an interrupted update does not refer to missing batches
+        with open(self._file("state.json"), "w") as f:
+            json.dump({"n_docs": self.n_docs, "n_batches": self.n_batches, "scored_batches": self.scored_batches}, f)
+
+    def idf(self):
+        return idf(self.n_docs, self.df)
+
+    def _counts(self, batch):
+        return scipy.sparse.load_npz(os.path.join(self.state_dir, "batches", "counts_%05d.npz" %batch))
+
+    def _save_batch(self, batch, counts, keys):
+        scipy.sparse.save_npz(os.path.join(self.state_dir, "batches", "counts_%05d.npz" %batch), counts)
+        np.save(self._batch_file("ids", batch), keys.get_level_values("id").to_numpy())
+        np.save(self._batch_file("hashes", batch), keys.get_level_values("hash").to_numpy())
+
+    def _keys(self, batch):
+        return pd.MultiIndex.from_arrays([np.load(self._batch_file("ids", batch)),
+                                          np.load(self._batch_file("hashes", batch))], names=["id", "hash"])
+
+    def ids(self):
+        return np.concatenate([np.load(self._batch_file("ids", batch)) for batch in range(self.n_batches)]) \
+            if self.n_batches else np.zeros(0, dtype=np.int64)
+
+    def keys(self):
+        # post_keys of the stored posts
+        keys = [self._keys(batch) for batch in range(self.n_batches)]
+        return keys[0].append(keys[1:]) if keys else post_keys([], [])
+
+    def add_batch(self, ids, texts):
+        # texts: lemmatised posts with PR phrases (text_with_phrases)
+        # the posts are scored by the next rescore()
+        texts = list(texts)
+        counts = count_terms(texts, self.vocabulary)
+
+        self.df = np.concatenate([self.df, np.zeros(len(self.vocabulary) - len(self.df), dtype=np.int64)])
+        self.df += np.bincount(counts.indices, minlength=len(self.vocabulary))
+        self.n_docs += counts.shape[0]
+
+        batch = self.n_batches
+        self._save_batch(batch, counts, post_keys(ids, texts))
+        self.n_batches += 1
+        self._save_state()
+        print("Added batch %d with %d posts (%d posts, %d terms in total)" %(batch, counts.shape[0], self.n_docs,
+                                                                           len(self.vocabulary)))
+
+    def retain(self, keys):
+        # removes the stored posts whose post_keys are not in keys (posts that are no longer in the input or whose
+        # text changed), so that they do not count towards the document frequencies
+        n_removed = 0
+        for batch in range(self.n_batches):
+            keep = self._keys(batch).isin(keys)
+            if keep.all():
+                continue
+            counts = self._counts(batch)
+            self.df -= np.bincount(counts[~keep].indices, minlength=len(self.df))
+            self.n_docs -= int((~keep).sum())
+            n_removed += int((~keep).sum())
+            self._save_batch(batch, counts[keep], self._keys(batch)[keep])
+            if batch < self.scored_batches:
+                np.save(self._batch_file("scores", batch), np.load(self._batch_file("scores", batch))[keep])
+        self._save_state()
+        if n_removed:
+            print("Removed %d posts that are not in the input or whose text changed" %n_removed)
+        return n_removed
+
+    def _score_rows(self, counts, idf):
+        return score_rows(counts, idf, query_vector(self.query_counts, self.vocabulary, idf, self.df))
+
+    def rescore(self, tolerance=0.01):
+        # scores the new batches, and rescores the posts of the scored batches that contain a term whose idf drifted
+        # by more than tolerance (relative) from the baseline (all posts if the idf of a PR term drifted)
+        # the baseline of a term is only updated when all posts with the term are rescored, so every score was
+        # computed with idfs within tolerance of the baseline, and within 2 x tolerance of the current idfs
+        # tolerance=0: exact scores (every post is rescored after any change of the number of posts)
+        idf = self.idf()
+        baseline = np.full(len(idf), np.nan)
+        baseline[:len(self.idf_baseline)] = self.idf_baseline
+        # terms without a baseline (not in the vocabulary when the posts were last scored) have drifted
+        drifted = ~(np.abs(idf - baseline) <= tolerance * baseline)
+        query_terms = [self.vocabulary[term] for term in self.query_counts if term in self.vocabulary]
+        rescore_all = drifted[query_terms].any()
+        n_rescored = 0
+        for batch in range(self.n_batches):
+            counts = self._counts(batch)
+            if batch >= self.scored_batches or rescore_all:
+                rows = np.arange(counts.shape[0])
+            else:
+                # terms that were not in the vocabulary when the batch was added cannot occur in it
+                rows = np.flatnonzero(counts[:, np.flatnonzero(drifted[:counts.shape[1]])].getnnz(axis=1))
+            if len(rows) == counts.shape[0]:
+                np.save(self._batch_file("scores", batch), self._score_rows(counts, idf))
+            elif len(rows):
+                scores = np.load(self._batch_file("scores", batch))
+                scores[rows] = self._score_rows(counts[rows], idf)
+                np.save(self._batch_file("scores", batch), scores)
+            n_rescored += len(rows)
+        self.idf_baseline = idf if rescore_all else np.where(drifted, idf, baseline)
+        self.scored_batches = self.n_batches
+        self._save_state()
+        print("Rescored %d of %d posts" %(n_rescored, self.n_docs))
+        return n_rescored
+
+    def scores(self):
+        scores = [np.load(self._batch_file("scores", batch)) for batch in range(self.n_batches)]
+        return pd.DataFrame({"id": self.ids(), "PR": np.concatenate(scores) if scores else np.zeros(0)})
+
+# sharded scoring (see sharding.py): the term counts of each shard are stored with the shard's own vocabulary, the
+# vocabularies and document frequencies of all shards are merged to the global idf, which is used to score all posts
+
+def count_shard(directory, shard, ids, texts):
+    vocabulary = {}
+    counts = count_terms(texts, vocabulary)
+    scipy.sparse.save_npz(os.path.join(directory, "shard_%05d_counts.npz" %shard), counts)
+    np.save(os.path.join(directory, "shard_%05d_ids.npy" %shard), np.asarray(ids, dtype=np.int64))
+    # written last: a shard without vocabulary is incomplete
+    with open(os.path.join(directory, "shard_%05d_vocabulary.json" %shard), "w", encoding="utf-8") as f:
+        json.dump(sorted(vocabulary, key=vocabulary.get), f)
+    print("Counted %d terms in %d posts of shard %d" %(len(vocabulary), counts.shape[0], shard))
+
+def score_shards(directory, n_shards, terms_file):
+    # global vocabulary (sorted, independent of the order the shards were processed in) and document frequencies
+    shard_vocabularies = []
+    for shard in range(n_shards):
+        with open(os.path.join(directory, "shard_%05d_vocabulary.json" %shard), encoding="utf-8") as f:
+            shard_vocabularies.append(json.load(f))
+    vocabulary = {term: i for i, term in enumerate(sorted(set().union(*shard_vocabularies)))}
+    df = np.zeros(len(vocabulary), dtype=np.int64)
+    n_docs = 0
+    columns = []
+    for shard in range(n_shards):
+        counts = scipy.sparse.load_npz(os.path.join(directory, "shard_%05d_counts.npz" %shard))
+        # shard column -> global column
+        columns.append(np.array([vocabulary[term] for term in shard_vocabularies[shard]], dtype=np.int64))
+        df += np.bincount(columns[shard][counts.indices], minlength=len(vocabulary))
+        n_docs += counts.shape[0]
+    global_idf = idf(n_docs, df)
+    query = query_vector(query_counts(terms_file), vocabulary, global_idf)
+    print("Merged %d shards: %d posts, %d terms" %(n_shards, n_docs, len(vocabulary)))
+
+    scores = []
+    for shard in range(n_shards):
+        counts = scipy.sparse.load_npz(os.path.join(directory, "shard_%05d_counts.npz" %shard))
+        # the idf and query weights of the shard's terms in the shard's column order
+        scores.append(pd.DataFrame({"id": np.load(os.path.join(directory, "shard_%05d_ids.npy" %shard)),
+                                    "PR": score_rows(counts, global_idf[columns[shard]], query[columns[shard]])}))
+    return pd.concat(scores, ignore_index=True)
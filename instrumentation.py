@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# structured progress and metrics of the pipeline stages
+# each stage emits json events (one line each), appended to the file given by the environment variable PIPELINE_EVENTS
+# (e.g. PIPELINE_EVENTS=output/pipeline_events.jsonl; not set: no events are written):
+# - start
+# - progress (at most every progress_interval seconds): rows processed so far, rows/s, estimated seconds remaining
+# - end: duration, rows, rows/s, peak memory (maximum resident set size during the stage, on Linux; otherwise of the
+#   process so far) and current memory
+# a summary of the progress and end events is also printed
+#
+# profiling a single stage: set PIPELINE_PROFILE to the name of the stage, e.g.
+#   PIPELINE_PROFILE=nlp_preprocess_posts python process_posts_with_spacy.py data/posts_bd.csv
+# writes output/profile_<stage>.prof (cProfile, view with python -m pstats or snakeviz)
+# with PIPELINE_PROFILER=py-spy, py-spy (if installed) is attached to the process for the duration of the stage and
+# writes output/profile_<stage>.svg (flame graph)
+
+import cProfile
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from functools import wraps
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+events_file = os.environ.get("PIPELINE_EVENTS") or None
+profile_stage = os.environ.get("PIPELINE_PROFILE")
+profiler = os.environ.get("PIPELINE_PROFILER", "cprofile")
+profile_dir = "output/"
+# seconds between progress events
+progress_interval = 30
+
+# stages that are running, the innermost last
+_running = []
+
+def _status_mb(field):
+    # VmHWM (peak) / VmRSS (current) in /proc/self/status (Linux)
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def peak_memory_mb():
+    # maximum resident set size of the process in MB (since the last reset_peak_memory() on Linux)
+    peak = _status_mb("VmHWM")
+    if peak is not None:
+        return peak
+    if resource is None:
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def memory_mb():
+    return _status_mb("VmRSS")
+
+def reset_peak_memory():
+    # Linux: resets VmHWM to the current resident set size, returns False if not possible
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def emit(event):
+    event = dict({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "pid": os.getpid()}, **event)
+    if events_file:
+        directory = os.path.dirname(events_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(events_file, "a") as f:
+            f.write(json.dumps(event, default=str) + "\n")
+    return event
+
+class Stage(object):
+
+    def __init__(self, name, total=None, **fields):
+        self.name = name
+        # expected number of rows (for the estimated time remaining), optional
+        self.total = total
+        self.fields = fields
+        # None: the stage does not report rows
+        self.rows = None
+        self.peak = 0
+
+    def _metrics(self):
+        seconds = time.time() - self.start
+        return {"seconds": round(seconds, 3), "rows": self.rows,
+                "rows_per_second": round(self.rows / seconds, 1) if self.rows is not None and seconds > 0 else None}
+
+    def add_rows(self, n):
+        # report n more processed rows (posts, tokens, ...), emits a progress event every progress_interval seconds
+        self.rows = (self.rows or 0) + n
+        now = time.time()
+        if now - self.last_progress >= progress_interval:
+            self.last_progress = now
+            event = dict({"event": "progress", "stage": self.name}, **self._metrics())
+            if self.total and self.rows:
+                event["total"] = self.total
+                event["seconds_remaining"] = round((self.total - self.rows) * (now - self.start) / self.rows, 1)
+            emit(event)
+            print("[%s] %d%s rows, %.0f rows/s%s" %(self.name, self.rows, "/%d" %self.total if self.total else "",
+                                                    event["rows_per_second"] or 0,
+                                                    ", %.0f s remaining" %event["seconds_remaining"]
+                                                    if "seconds_remaining" in event else ""))
+
+    def set_rows(self, n):
+        self.rows = n
+
+    def __enter__(self):
+        # the peak memory of the stages around this one includes the peak before this stage
+        peak = peak_memory_mb()
+        for stage in _running:
+            stage.peak = max(stage.peak, peak)
+        reset_peak_memory()
+        _running.append(self)
+        self.start = self.last_progress = time.time()
+        emit(dict({"event": "start", "stage": self.name, "total": self.total}, **self.fields))
+        self._profiler = _start_profiler(self.name) if self.name == profile_stage else None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._profiler is not None:
+            _stop_profiler(self.name, self._profiler)
+        _running.remove(self)
+        self.peak = max(self.peak, peak_memory_mb())
+        for stage in _running:
+            stage.peak = max(stage.peak, self.peak)
+        event = dict({"event": "end", "stage": self.name, "status": "ok" if exc_type is None else "failed"},
+                     **self._metrics())
+        event.update({"peak_rss_mb": round(self.peak, 1), "rss_mb": memory_mb()}, **self.fields)
+        emit(event)
+        print("[%s] %s after %.1f s%s, peak memory %.0f MB" %(
+            self.name, "finished" if exc_type is None else "failed", event["seconds"],
+            ": %d rows (%.0f rows/s)" %(self.rows, event["rows_per_second"] or 0) if self.rows is not None else "",
+            self.peak))
+        return False
+
+def stage(name, total=None, **fields):
+    # with stage("score_posts", total=len(posts)) as s: ... s.add_rows(len(batch))
+    return Stage(name, total, **fields)
+
+def instrument(name=None, rows=len):
+    # decorator: runs the function as a stage, the rows of the stage are rows(return value) (None: no rows)
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name or function.__name__) as s:
+                result = function(*args, **kwargs)
+                # the default (len) only for results that have a length
+                if rows is not None and result is not None and (rows is not len or hasattr(result, "__len__")):
+                    s.set_rows(rows(result))
+                return result
+        return wrapper
+    return decorator
+
+def _start_profiler(name):
+    os.makedirs(profile_dir, exist_ok=True)
+    if profiler == "py-spy":
+        if shutil.which("py-spy") is None:
+            print("py-spy not found, using cProfile")
+        else:
+            return subprocess.Popen(["py-spy", "record", "--pid", str(os.getpid()), "--output",
+                                     os.path.join(profile_dir, "profile_%s.svg" %name)])
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+def _stop_profiler(name, running_profiler):
+    if isinstance(running_profiler, cProfile.Profile):
+        running_profiler.disable()
+        outfile = os.path.join(profile_dir, "profile_%s.prof" %name)
+        running_profiler.dump_stats(outfile)
+    else:
+        # py-spy writes the flame graph when it is interrupted
+        running_profiler.send_signal(2)
+        running_profiler.wait()
+        outfile = os.path.join(profile_dir, "profile_%s.svg" %name)
+    print("Wrote profile of %s to %s" %(name, outfile))
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+# stability of the keyness statistics of the lemmas of the PR-BD Corpus vs the Reference Corpus (lemma_frequencies.py)
+# users are the resampling unit (as for the dispersion, one file per user in LancsBox):
+# - bootstrap: the users of each corpus are sampled with replacement; each replicate's lemma frequencies are the
+#   product of the user weights (how often each user was sampled) and the user x lemma count matrix, so a batch of
+#   replicates is one sparse x dense matrix product
+#   -> confidence intervals of LL and LR, and the stability of the key lemma selection (share of the replicates in
+#   which the lemma is selected with the cut-offs of select_key_lemmas.py)
+#   the dispersion of a replicate is the share of the distinct sampled users that use the lemma (a user sampled twice
+#   is one file in LancsBox, not two)
+#   the replicates are computed per chunk of lemmas (the same replicates for each chunk), so only the LL and LR of
+#   replicates x lemmas of a chunk are held for the percentiles
+# - permutation (optional): the users of both corpora are randomly assigned to the two corpora (same sizes)
+#   -> p value of LL: share of the permutations with LL >= the observed LL
+# batches of replicates (of a chunk of lemmas) are computed in a process pool
+# output: the statistics of keyness.write_statistics with the confidence intervals, stability and permutation p values
+# as further columns
+#
+# python keyness_resampling.py -b 1000 -p 8
+
+import argparse
+import multiprocessing
+
+import numpy as np
+import scipy.sparse
+
+import config as c
+import instrumentation
+import keyness
+import lemma_frequencies as lf
+import select_key_lemmas as skl
+
+# count matrices of the worker processes, set by _init
+_counts = {}
+
+def _init(counts, counts_ref, observed_LL=None):
+    _counts["corpus"] = counts
+    _counts["reference"] = counts_ref
+    _counts["observed_LL"] = observed_LL
+    # by column for the chunks of lemmas, the tokens per user for the totals of all lemmas
+    for name in ["corpus", "reference"]:
+        _counts[name + " columns"] = _counts[name].tocsc()
+        _counts[name + " used"] = (_counts[name + " columns"] > 0).astype(float)
+        _counts[name + " tokens"] = np.asarray(_counts[name].sum(axis=1)).ravel()
+
+def _weights(rng, n_users, n_replicates):
+    # how often each user is sampled in each replicate (n_replicates x n_users)
+    return rng.multinomial(n_users, np.full(n_users, 1.0 / n_users), size=n_replicates).astype(float)
+
+def _frequencies(counts, weights):
+    # lemma frequencies (n_replicates x n_lemmas) of the weighted users
+    return np.asarray(counts.T.dot(weights.T)).T
+
+def bootstrap_batch(seed, n_replicates, start=0, end=None):
+    # LL and LR of each replicate (float32) and the number of replicates in which each lemma is a key lemma, of the
+    # lemmas start:end
+    # the weights only depend on the seed, so the batch of a seed has the same replicates for each chunk of lemmas
+    rng = np.random.default_rng(seed)
+    lemmas = slice(start, end)
+    weights = _weights(rng, _counts["corpus"].shape[0], n_replicates)
+    weights_ref = _weights(rng, _counts["reference"].shape[0], n_replicates)
+    frequency = _frequencies(_counts["corpus columns"][:, lemmas], weights)
+    frequency_ref = _frequencies(_counts["reference columns"][:, lemmas], weights_ref)
+    # percentage of the distinct sampled users that use the lemma
+    sampled = (weights > 0).astype(float)
+    dispersion = _frequencies(_counts["corpus used"][:, lemmas], sampled) * 100 / sampled.sum(axis=1)[:, None]
+    # tokens of all lemmas
+    total = weights.dot(_counts["corpus tokens"])[:, None]
+    total_ref = weights_ref.dot(_counts["reference tokens"])[:, None]
+    LL = keyness.compute_log_likelihood(frequency, frequency_ref, total, total_ref)
+    LR = keyness.compute_log_ratio(frequency, frequency_ref, total, total_ref)
+    return LL.astype(np.float32), LR.astype(np.float32), skl.is_key(LL, LR, dispersion).sum(axis=0)
+
+def permutation_batch(seed, n_replicates):
+    # number of permutations in which each lemma's LL is at least the observed LL
+    rng = np.random.default_rng(seed)
+    counts = scipy.sparse.vstack([_counts["corpus"], _counts["reference"]]).tocsr()
+    n_users, n_corpus = counts.shape[0], _counts["corpus"].shape[0]
+    weights = np.zeros((n_replicates, n_users))
+    for replicate in range(n_replicates):
+        weights[replicate, rng.permutation(n_users)[:n_corpus]] = 1
+    frequency = _frequencies(counts, weights)
+    frequency_ref = np.asarray(counts.sum(axis=0)).ravel()[None, :] - frequency
+    total = frequency.sum(axis=1)[:, None]
+    total_ref = frequency_ref.sum(axis=1)[:, None]
+    LL = keyness.compute_log_likelihood(frequency, frequency_ref, total, total_ref)
+    return (LL >= _counts["observed_LL"] - 1e-9).sum(axis=0)
+
+def _batches(n_replicates, batch_size, seed):
+    sizes = [batch_size] * (n_replicates // batch_size) + ([n_replicates % batch_size] if n_replicates % batch_size else [])
+    return list(zip(np.random.SeedSequence(seed).spawn(len(sizes)), sizes))
+
+def _call(task):
+    function, batch = task
+    return function(*batch)
+
+def _run(function, batches, processes, initargs):
+    # results in the order of the batches, as they are computed
+    if processes == 1:
+        _init(*initargs)
+        for batch in batches:
+            yield function(*batch)
+        return
+    with multiprocessing.Pool(processes, initializer=_init, initargs=initargs) as pool:
+        for result in pool.imap(_call, [(function, batch) for batch in batches]):
+            yield result
+
+def bootstrap(n_lemmas, n_replicates, processes, batch_size, seed, initargs, quantiles, lemma_chunk=10000):
+    # percentiles of LL and LR (2 x n_lemmas each) and the number of replicates in which each lemma is a key lemma
+    batches = _batches(n_replicates, batch_size, seed)
+    starts = range(0, n_lemmas, lemma_chunk)
+    results = _run(bootstrap_batch, [(batch_seed, size, start, start + lemma_chunk) for start in starts
+                                     for batch_seed, size in batches], processes, initargs)
+    LL, LR = np.zeros((2, n_lemmas)), np.zeros((2, n_lemmas))
+    key = np.zeros(n_lemmas)
+    for start in starts:
+        # the batches of a chunk, then the chunk is reduced to its percentiles
+        chunk = [next(results) for _ in batches]
+        lemmas = slice(start, start + lemma_chunk)
+        LL[:, lemmas] = np.percentile(np.concatenate([result[0] for result in chunk]), quantiles, axis=0)
+        LR[:, lemmas] = np.percentile(np.concatenate([result[1] for result in chunk]), quantiles, axis=0)
+        key[lemmas] = sum(result[2] for result in chunk)
+    return LL, LR, key
+
+def resample(vocabulary, counts, counts_ref, n_replicates=1000, n_permutations=0, processes=1, batch_size=50, seed=0,
+             alpha=0.05, n_comparisons=1, lemma_chunk=10000):
+    frequency, _ = lf.frequency_dispersion(counts)
+    frequency_ref, _ = lf.frequency_dispersion(counts_ref)
+    statistics = keyness.compute_keyness(vocabulary, frequency, frequency_ref, frequency.sum(), frequency_ref.sum(),
+                                         n_comparisons)
+    initargs = (counts, counts_ref, statistics["log likelihood"].to_numpy())
+    quantiles = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+
+    if n_replicates:
+        with instrumentation.stage("keyness_bootstrap", total=n_replicates, processes=processes) as progress:
+            LL, LR, key = bootstrap(len(vocabulary), n_replicates, processes, batch_size, seed, initargs, quantiles,
+                                    lemma_chunk)
+            progress.set_rows(n_replicates)
+        for name, (low, high) in [("log likelihood", LL), ("log ratio", LR)]:
+            statistics["%s CI low" %name] = low
+            statistics["%s CI high" %name] = high
+        statistics["key lemma stability"] = key / n_replicates
+    if n_permutations:
+        with instrumentation.stage("keyness_permutation", total=n_permutations, processes=processes) as progress:
+            # _run is lazy: the permutations are computed by the sum, inside the stage
+            batches = _batches(n_permutations, batch_size, seed + 1)
+            exceeding = sum(_run(permutation_batch, batches, processes, initargs))
+            progress.set_rows(n_permutations)
+        statistics["permutation p value"] = (1 + exceeding) / (1 + n_permutations)
+    return statistics
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bootstrap confidence intervals and permutation p values of the "
+                                                 "keyness of lemmas, resampling users")
+    parser.add_argument("-b", "--replicates", type=int, default=1000, help="Number of bootstrap replicates")
+    parser.add_argument("--permutations", type=int, default=0, help="Number of permutations (0: no permutation test)")
+    parser.add_argument("-p", "--processes", type=int, default=1, help="Number of processes")
+    parser.add_argument("--batch_size", type=int, default=50,
+                        help="Replicates per batch (memory: batch size x lemmas of a chunk)")
+    parser.add_argument("--lemma_chunk", type=int, default=10000,
+                        help="Lemmas per chunk of the confidence intervals (memory: replicates x lemmas of a chunk)")
+    parser.add_argument("-a", "--alpha", type=float, default=0.05, help="Confidence intervals of 1 - alpha")
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    parser.add_argument("-n", "--n_comparisons", type=int, default=1,
+                        help="Number of comparisons to calculate Bonferroni corrected p-value")
+    parser.add_argument("-o", "--outfile", default=c.data + "PR-BD_Corpus_keyness_resampling.csv")
+    args = parser.parse_args()
+
+    vocabulary, counts, counts_ref = lf.corpus_counts()
+    statistics = resample(vocabulary, counts, counts_ref, args.replicates, args.permutations, args.processes,
+                          args.batch_size, args.seed, args.alpha, args.n_comparisons, args.lemma_chunk)
+    keyness.write_statistics(statistics.sort_values("log likelihood", ascending=False), args.outfile)
+    print("Wrote keyness statistics of %d lemmas to %s" %(len(statistics), args.outfile))
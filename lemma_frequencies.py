@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# lemma frequencies and dispersion in the PR-BD Corpus and Reference Corpus computed directly from the spacy tokens
+# (instead of writing one file per user and calculating them in LancsBox, see README.md)
+# the lemma counts are accumulated in a sparse user x lemma matrix per corpus
+# dispersion = percentage of users in the corpus that use the lemma (LancsBox range_percent with one file per user)
+# as in the LancsBox lemma lists, the items are lemma + coarse POS (e.g. support_n and support_v are counted separately),
+# the coarse POS classes are mapped from spacy's universal POS tags (coarse_pos), which are not the same tagger as
+# LancsBox's, so the frequencies are comparable but not identical; by_pos=False counts the bare lemmas
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+import config as c
+import keyness
+import token_table as tt
+
+# tokens that are not counted as words
+excluded_pos = ["PUNCT", "SPACE"]
+# LancsBox coarse POS of the universal POS tags, other tags: "other"
+coarse_pos = {"NOUN": "n", "PROPN": "n", "VERB": "v", "AUX": "v", "ADJ": "adj", "ADV": "adv", "PRON": "pron",
+              "ADP": "prep", "CCONJ": "conj", "SCONJ": "conj", "DET": "det", "NUM": "num", "INTJ": "intj",
+              "PART": "part"}
+
+def read_lemmas(spacy_csv, by_pos=True):
+    # lowercased lemmas (lemma_pos with by_pos) of all word tokens (from the token table if it exists)
+    tokens = tt.read_tokens(spacy_csv, ["post_id", "lemma", "pos"])
+    tokens = tokens[~tokens.pos.isin(excluded_pos)]
+    lemmas = tokens.lemma.astype(str).str.lower()
+    if by_pos:
+        lemmas = lemmas + "_" + tokens.pos.map(coarse_pos).fillna("other").astype(str)
+    return pd.DataFrame({"post_id": tokens.post_id, "lemma": lemmas})
+
+def corpus_lemmas(lemmas, corpus_file):
+    # lemmas of the posts in a corpus file written by create_corpora.py, with the user of each post
+    posts = pd.read_csv(c.data + corpus_file, usecols=["id", "user_id"])
+    return lemmas.merge(posts, left_on="post_id", right_on="id")[["post_id", "user_id", "lemma"]]
+
+def user_lemma_counts(tokens, vocabulary):
+    # tokens: user_id + lemma per token, vocabulary: pd.Index of lemmas
+    # returns the user x lemma count matrix and the user ids of the rows
+    user_index, users = pd.factorize(tokens.user_id)
+    lemma_index = vocabulary.get_indexer(tokens.lemma)
+    counts = scipy.sparse.coo_matrix((np.ones(len(tokens), dtype=np.int64), (user_index, lemma_index)),
+                                     shape=(len(users), len(vocabulary))).tocsr()
+    return counts, users
+
+def frequency_dispersion(counts):
+    frequency = np.asarray(counts.sum(axis=0)).ravel()
+    dispersion = counts.getnnz(axis=0) * 100 / counts.shape[0]
+    return frequency, dispersion
+
+def corpus_counts(spacy_csv=c.data + "posts_bd_spacy.csv", corpus_file="PR-BD_Corpus.csv",
+                  reference_file="Reference_Corpus.csv", by_pos=True):
+    # vocabulary (lemma_pos items with by_pos) and user x lemma count matrices of the corpus and the reference corpus
+    lemmas = read_lemmas(spacy_csv, by_pos)
+    corpus = corpus_lemmas(lemmas, corpus_file)
+    reference = corpus_lemmas(lemmas, reference_file)
+    del(lemmas)
+    vocabulary = pd.Index(pd.unique(pd.concat([corpus.lemma, reference.lemma])))
+
+    counts, users = user_lemma_counts(corpus, vocabulary)
+    counts_ref, users_ref = user_lemma_counts(reference, vocabulary)
+    print("Counted %d lemmas of %d users in %s and %d lemmas of %d users in %s (%d unique lemmas)" %(
+        counts.sum(), len(users), corpus_file, counts_ref.sum(), len(users_ref), reference_file, len(vocabulary)))
+    return vocabulary, counts, counts_ref
+
+def lemma_statistics(spacy_csv=c.data + "posts_bd_spacy.csv", corpus_file="PR-BD_Corpus.csv",
+                     reference_file="Reference_Corpus.csv", by_pos=True):
+    # same columns as select_key_lemmas.read_lancsbox_terms: term (lemma) and lemma_pos
+    vocabulary, counts, counts_ref = corpus_counts(spacy_csv, corpus_file, reference_file, by_pos)
+    frequency, dispersion = frequency_dispersion(counts)
+    frequency_ref, dispersion_ref = frequency_dispersion(counts_ref)
+    statistics = keyness.compute_keyness(vocabulary, frequency, frequency_ref, frequency.sum(), frequency_ref.sum(), 1)
+
+    terms = pd.Series(vocabulary, dtype=object)
+    return pd.DataFrame({"term": terms.str.rsplit("_", n=1).str[0] if by_pos else terms, "frequency": frequency,
+                         "dispersion": dispersion, "frequency_ref": frequency_ref, "dispersion_ref": dispersion_ref,
+                         "LL": statistics["log likelihood"].to_numpy(), "LR": statistics["log ratio"].to_numpy(),
+                         "lemma_pos": terms if by_pos else np.nan})
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# single-pass matcher for the PR term phrases in lemmatised posts
+# PR_scoring.identify_PR_phrases used to run one re.sub per PR term over every post (replace_phrases_sequential).
+# PhraseMatcher finds the occurrences of all terms at once with one regex built from a character trie of the terms and
+# then resolves overlapping occurrences in the same way as the sequence of re.sub calls: an occurrence of a term that
+# comes earlier in the term list wins over an overlapping occurrence of a later term, occurrences of the same term are
+# matched from left to right (e.g. "self care plan" -> "self care_plan" because "care plan" is listed before "self care")
+
+import os
+import random
+import re
+
+import pandas as pd
+
+import config as c
+
+def replace_phrases_sequential(text, terms):
+    # original implementation, one pass over the text per term
+    for term, replacement in zip(terms.term, terms.replacement):
+        # only match single terms, do not need re.IGNORECASE because lowercased both the post and the terms
+        text = re.sub(r"\b%s(?!\S)" % re.escape(term), replacement, text)
+    return text
+
+def _trie_pattern(node):
+    # node: dict char -> child node, key None marks the end of a term
+    alternatives = [re.escape(char) + _trie_pattern(child) for char, child in sorted(node.items(), key=lambda x: x[0] or "")
+                    if char is not None]
+    if not alternatives:
+        return ""
+    pattern = "(?:%s)" %"|".join(alternatives)
+    # a term ends here but longer terms continue: also try to match without the continuation
+    return pattern + "?" if None in node else pattern
+
+def trie_pattern(terms):
+    # regex that matches any of the terms (non-capturing groups only), one alternation per character of a trie of the
+    # terms instead of one alternative per term
+    trie = {}
+    for term in terms:
+        node = trie
+        for char in term:
+            node = node.setdefault(char, {})
+        node[None] = {}
+    return _trie_pattern(trie)
+
+class PhraseMatcher(object):
+
+    def __init__(self, terms, replacements):
+        self.replacements = {}
+        self.priority = {}
+        for term, replacement in zip(terms, replacements):
+            # replacing a term by itself (single word terms) does not change the text
+            # a term that is listed twice only matches the first time
+            if term == replacement or term in self.priority:
+                continue
+            self.priority[term] = len(self.priority)
+            self.replacements[term] = replacement
+
+        # the overlap resolution in replace() is only equivalent to replace_phrases_sequential if a replacement cannot
+        # create a new match for another term: replacements only join the words of a term by "_", no term contains "_"
+        # and no term starts with a non-word character that follows a space in another term (after the replacement,
+        # it would follow "_", a word character, and \b would match)
+        non_word_starts = {term[0] for term in self.priority if not re.match(r"\w", term[0])}
+        self.sequential = any(replacement != term.replace(" ", "_") or "_" in term or
+                              any(" " + char in term for char in non_word_starts)
+                              for term, replacement in self.replacements.items())
+        if self.sequential:
+            print("PR terms cannot be matched in a single pass, falling back to one pass per term")
+            self.terms = pd.DataFrame({"term": list(self.replacements), "replacement": list(self.replacements.values())})
+            return
+
+        self.terms_by_first_char = {}
+        if not self.priority:
+            # no term changes the text (the empty trie pattern would match at the end of every word)
+            self.pattern = None
+            return
+        for term in self.priority:
+            self.terms_by_first_char.setdefault(term[0], []).append(term)
+        # zero-width, so that finditer returns every position where at least one term matches
+        self.pattern = re.compile(r"(?=\b%s(?!\S))" %trie_pattern(self.priority))
+
+    @classmethod
+    def from_csv(cls, terms_file):
+        terms = pd.read_csv(terms_file)
+        return cls(terms.term, terms.replacement)
+
+    def replace(self, text):
+        if self.sequential:
+            return replace_phrases_sequential(text, self.terms)
+        if self.pattern is None:
+            return text
+
+        candidates = []
+        for match in self.pattern.finditer(text):
+            start = match.start()
+            for term in self.terms_by_first_char[text[start]]:
+                end = start + len(term)
+                if text.startswith(term, start) and (end == len(text) or text[end].isspace()):
+                    candidates.append((self.priority[term], start, end))
+        if not candidates:
+            return text
+
+        # an earlier term's replacement (words joined by "_") prevents any overlapping later match
+        accepted = []
+        for priority, start, end in sorted(candidates):
+            if all(end <= a_start or start >= a_end for a_start, a_end in accepted):
+                accepted.append((start, end))
+
+        parts = []
+        position = 0
+        for start, end in sorted(accepted):
+            parts.append(text[position:start])
+            parts.append(self.replacements[text[start:end]])
+            position = end
+        parts.append(text[position:])
+        return "".join(parts)
+
+def test_random(n_cases=2000, seed=0):
+    # random terms (overlapping words, terms that are prefixes of other terms, terms listed twice or replaced by
+    # themselves) and texts, compared with replace_phrases_sequential
+    rng = random.Random(seed)
+    words = ["a", "b", "ab", "self", "care", "plan", "care-plan", "mood", "ü"]
+    for case in range(n_cases):
+        terms = [" ".join(rng.choice(words) for _ in range(rng.randint(1, 3))) for _ in range(rng.randint(0, 6))]
+        replacements = [term.replace(" ", "_") for term in terms]
+        terms = pd.DataFrame({"term": terms, "replacement": replacements})
+        matcher = PhraseMatcher(terms.term, terms.replacement)
+        assert not matcher.sequential
+        for _ in range(5):
+            text = "".join(rng.choice(words) + rng.choice([" ", " ", " ", "\n", ", ", "-", ""])
+                           for _ in range(rng.randint(0, 12)))
+            computed = matcher.replace(text)
+            expected = replace_phrases_sequential(text, terms)
+            assert computed == expected, "terms %s, text %r: expected: %r computed: %r" %(list(terms.term), text,
+                                                                                          expected, computed)
+    print("%d random cases equal to replace_phrases_sequential" %n_cases)
+
+def test(posts_file=c.data + "posts_bd_spacy_phrases.csv", terms_file=c.data + "PR_terms.csv"):
+    test_random()
+
+    terms = pd.read_csv(terms_file)
+    matcher = PhraseMatcher(terms.term, terms.replacement)
+    assert not matcher.sequential
+
+    for text, expected in [("i make a self care plan", "i make a self care_plan"),
+                           ("find my own recovery journey", "find_my_own_recovery journey"),
+                           ("my own recovery process of recovery", "my own_recovery process_of_recovery"),
+                           ("self - care and self care", "self_-_care and self_care"),
+                           ("self careful", "self careful"),
+                           ("high mood chart\nhigh mood", "high_mood chart\nhigh_mood")]:
+        computed = matcher.replace(text)
+        print("%r: expected: %r computed: %r" %(text, expected, computed))
+        assert computed == expected == replace_phrases_sequential(text, terms)
+
+    # regression test against the output of the original implementation
+    if os.path.exists(posts_file):
+        posts = pd.read_csv(posts_file, keep_default_na=False, na_values=[], usecols=["text", "text_with_phrases"])
+        computed = posts.text.apply(matcher.replace)
+        print("%d of %d posts in %s differ" %((computed != posts.text_with_phrases).sum(), len(posts), posts_file))
+        assert (computed == posts.text_with_phrases).all()
+
+if __name__ == "__main__":
+    test()
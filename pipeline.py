@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# runs the stages of the main study in one process, each stage passes its result in memory to the next one:
+# - select_bd: steps 1-2, select BD posts (select_bd_posts.py) -> posts_bd.csv
+# - spacy: step 3.1, tokenise + lemmatise the posts (process_posts_with_spacy.py) -> posts_bd_spacy.csv
+# - score: step 3.2, identify the PR phrases and score the posts (PR_scoring.py) -> posts_bd_spacy_phrases.csv,
+#   posts_bd_PR_scored.csv
+# - corpora: steps 3.3 + 4, select the PR-BD Corpus and Reference Corpus (create_corpora.py select)
+# - ids: create the corpora from the post ids instead (create_corpora.py ids)
+# the intermediate files are only written with --write (e.g. --write posts_bd scored); a stage whose input was not
+# produced by an earlier stage of the same run reads it from the intermediate file
+# the modules of the stages (and spacy, sklearn) are only imported when the stage runs
+#
+# python pipeline.py                                # all stages, only the corpora are written
+# python pipeline.py --stages score corpora        # from posts_bd_spacy.csv and posts_bd.csv
+# python pipeline.py --stages ids
+
+import argparse
+
+import config as c
+import instrumentation
+
+stages = ["select_bd", "spacy", "score", "corpora", "ids"]
+intermediate_files = {"posts_bd": c.data + "posts_bd.csv", "spacy": c.data + "posts_bd_spacy.csv",
+                      "phrases": c.data + "posts_bd_spacy_phrases.csv", "scored": c.data + "posts_bd_PR_scored.csv"}
+PR_terms_file = c.data + "PR_terms.csv"
+
+def _fill_strings(posts):
+    # missing strings as "", as when the intermediate file is read with keep_default_na=False
+    columns = [col for col in posts.columns if posts[col].dtype == object]
+    return posts.fillna({col: "" for col in columns})
+
+def _posts_bd(results):
+    import pandas as pd
+    if "posts_bd" not in results:
+        results["posts_bd"] = pd.read_csv(intermediate_files["posts_bd"], keep_default_na=False, na_values=[])
+    return results["posts_bd"]
+
+def run_select_bd(results, args):
+    import select_bd_posts
+    results["posts_bd"] = _fill_strings(select_bd_posts.select_bd_posts())
+    if "posts_bd" in args.write:
+        results["posts_bd"].to_csv(intermediate_files["posts_bd"])
+    return len(results["posts_bd"])
+
+def run_spacy(results, args):
+    import process_posts_with_spacy as ps
+    import token_table as tt
+    if "posts_bd" in results:
+        posts = results["posts_bd"][["id", "text"]]
+    else:
+        posts = ps.read_posts(intermediate_files["posts_bd"])
+    nlp = ps.load_pipeline(args.lemmas_only)
+    with instrumentation.stage("nlp_preprocess_posts", total=len(posts)) as progress:
+        results["tokens"] = ps.tokenise_frame(nlp, posts, args.batch_size, args.n_process, progress)
+    if "spacy" in args.write:
+        results["tokens"].to_csv(intermediate_files["spacy"])
+        if args.table:
+            writer = tt.TokenTableWriter(tt.table_path(intermediate_files["spacy"]))
+            writer.add(results["tokens"])
+            writer.close()
+    return len(results["tokens"])
+
+def run_score(results, args):
+    import PR_scoring as pr
+    if "tokens" in results:
+        tokenised_posts = pr.concatenate_lemmas(results.pop("tokens"))
+    else:
+        tokenised_posts = pr.read_posts(intermediate_files["spacy"])
+    tokenised_posts = pr.identify_PR_phrases(tokenised_posts, PR_terms_file)
+    if "phrases" in args.write:
+        tokenised_posts.to_csv(intermediate_files["phrases"])
+    posts_PR_scored = pr.score_posts(tokenised_posts, PR_terms_file)
+    results["scored"] = pr.add_post_metadata(posts_PR_scored, _posts_bd(results))
+    if "scored" in args.write:
+        results["scored"].to_csv(intermediate_files["scored"])
+    return len(results["scored"])
+
+def run_corpora(results, args):
+    import create_corpora
+    # without the scored posts of this run, create_corpora streams posts_bd_PR_scored.csv
+    PR, not_PR = create_corpora.select(args.layout, posts=results.get("scored"), dedupe=args.dedupe)
+    return len(PR) + len(not_PR)
+
+def run_ids(results, args):
+    import create_corpora
+    PR, not_PR = create_corpora.from_ids(args.layout)
+    return len(PR) + len(not_PR)
+
+def run(args):
+    results = {}
+    for name in [stage for stage in stages if stage in args.stages]:
+        with instrumentation.stage("pipeline_%s" %name) as progress:
+            progress.set_rows(globals()["run_%s" %name](results, args))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run stages of the main study in one process")
+    parser.add_argument("--stages", nargs="+", choices=stages, default=["select_bd", "spacy", "score", "corpora"],
+                        help="Stages to run (in the order of the pipeline)")
+    parser.add_argument("--write", nargs="+", choices=sorted(intermediate_files), default=[],
+                        help="Intermediate files to write")
+    parser.add_argument("-p", "--n_process", type=int, default=1, help="spacy: number of processes")
+    parser.add_argument("-b", "--batch_size", type=int, default=1000, help="spacy: posts processed at once")
+    parser.add_argument("-l", "--lemmas_only", action="store_true",
+                        help="spacy: skip the dependency parser (see process_posts_with_spacy.py)")
+    parser.add_argument("-t", "--table", action="store_true", help="Also write the token table with --write spacy")
+    parser.add_argument("--layout", default="files", choices=["files", "tar", "zip", "offsets", "none"],
+                        help="Layout of the per-user files of the PR-BD Corpus, see corpus_files.py")
+    parser.add_argument("--dedupe", default="exact", choices=["exact", "normalised", "simhash"],
+                        help="Duplicate removal, see dedupe.py")
+    args = parser.parse_args()
+    if "ids" in args.stages and "corpora" in args.stages:
+        parser.error("corpora and ids both create the corpora, run only one of them")
+    run(args)
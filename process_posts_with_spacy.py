@@ -2,42 +2,291 @@
 
 # tokenise + lemmatise posts with spacy
 
-import sys
-import spacy
+import argparse
+import hashlib
+import json
+import os
+import numpy as np
 import pandas as pd
 
 import config as c
+import instrumentation
+import sharding
+import token_table as tt
 
-def nlp_preprocess_posts(fname):
-    posts = pd.read_csv(fname, usecols=["id", "text"])
-
-    # expect 0 here
-    print("%d posts do not have a text" %len(posts[posts.text.isna()]))
-    posts["text"].fillna("", inplace=True)
+headers = ['post_id', 'sentence_id', 'token_id', 'text', 'lemma', 'pos', 'tag', 'dep', 'shape', 'is_alpha', 'is_stop']
 
-    nlp = spacy.load('en_core_web_sm')
-    headers = ['post_id', 'sentence_id', 'token_id', 'text', 'lemma', 'pos', 'tag', 'dep', 'shape', 'is_alpha', 'is_stop']
+def load_pipeline(lemmas_only=False):
+    # spacy is imported here, so that importing this module (e.g. in pipeline.py) does not load it
+    import spacy
+    # the named entity recogniser does not change any of the token attributes we write
+    if not lemmas_only:
+        return spacy.load('en_core_web_sm', exclude=["ner"])
+    # the lemmatiser only needs the tagger + attribute ruler: replace the dependency parser by the (faster) statistical
+    # sentence segmenter; note that sentence boundaries may differ from the parser and the dep column will be empty,
+    # so this mode does not reproduce posts_bd_spacy.csv exactly
+    nlp = spacy.load('en_core_web_sm', exclude=["ner", "parser"])
+    nlp.enable_pipe("senter")
+    return nlp
 
-    processed_posts = []
-    for id, text in zip(posts["id"], posts["text"]):
+def tokenise_posts(nlp, ids, texts, batch_size=1000, n_process=1):
+    # yields the token rows of one post at a time
+    for doc, id in nlp.pipe(zip(texts, ids), as_tuples=True, batch_size=batch_size, n_process=n_process):
         param = []
         # spacy sentence segmentation: https://spacy.io/usage/linguistic-features#sbd
-        sentences = nlp(text).sents
-        for s_id, sentence in enumerate(sentences):
+        for s_id, sentence in enumerate(doc.sents):
             for t_id, token in enumerate(sentence):
                 param.append([id, s_id, t_id, token.text, token.lemma_, token.pos_,
                   token.tag_, token.dep_, token.shape_,
                   token.is_alpha, token.is_stop])
+        yield param
 
-        processed_posts.extend(param)
+def shard_file(shard_dir, shard):
+    return os.path.join(shard_dir, "shard_%05d.csv" %shard)
+
+def merge_shards(shard_dir, n_shards, outfile, table=False):
+    # concatenate the shards to the same format as writing all tokens at once (continuous index over all tokens)
+    writer = tt.TokenTableWriter(tt.table_path(outfile)) if table else None
+    offset = 0
+    with open(outfile, "w", newline="", encoding="utf-8") as f:
+        for shard in range(n_shards):
+            df = pd.read_csv(shard_file(shard_dir, shard), keep_default_na=False, na_filter=False,
+                             dtype={col: str for col in tt.string_columns})
+            df.index = range(offset, offset + len(df))
+            df.to_csv(f, header=shard == 0)
+            if writer:
+                writer.add(df)
+            offset += len(df)
+    if writer:
+        writer.close()
+    print("Merged %d shards with %d tokens into %s" %(n_shards, offset, outfile))
+
+def _shard_chunks(fname, positions, chunksize):
+    # chunks of the tokens of a hash shard with the position of each token's post in the posts file
+    for df in pd.read_csv(fname, keep_default_na=False, na_filter=False, dtype={col: str for col in tt.string_columns},
+                          chunksize=chunksize):
+        df["position"] = positions.get_indexer(df.post_id)
+        yield df
 
-    # print(processed_posts)
-    df = pd.DataFrame(processed_posts)
+def merge_hash_shards(fname, shard_dir, n_shards, outfile, table=False, chunksize=1000000):
+    # merges the hash shards into the same file as tokenising all posts of fname at once: the tokens of each shard are
+    # in the order of the posts file, the shards are merged by the position of the posts (reading chunksize tokens of
+    # each shard at a time)
+    positions = pd.Index(pd.read_csv(fname, usecols=["id"]).id.drop_duplicates())
+    readers = [_shard_chunks(sharding.shard_file(shard_dir, shard), positions, chunksize) for shard in range(n_shards)]
+    buffers = [pd.DataFrame(columns=headers + ["position"]) for reader in readers]
+    # shards whose tokens have all been read: their last post is complete
+    exhausted = [False] * n_shards
+    writer = tt.TokenTableWriter(tt.table_path(outfile)) if table else None
+    offset = 0
+    with open(outfile, "w", newline="", encoding="utf-8") as f:
+        while not all(exhausted) or any(len(buffer) for buffer in buffers):
+            # read on in the shards that have no tokens left in the buffer
+            for shard in range(n_shards):
+                if not exhausted[shard] and not len(buffers[shard]):
+                    chunk = next(readers[shard], None)
+                    if chunk is None:
+                        exhausted[shard] = True
+                    else:
+                        buffers[shard] = chunk
+            # the posts before the last (possibly incomplete) post of each shard that is still read are complete
+            ends = [buffers[shard].position.iloc[-1] for shard in range(n_shards) if not exhausted[shard]]
+            bound = min(ends) if ends else len(positions)
+            chunks = []
+            for shard in range(n_shards):
+                complete = (buffers[shard].position < bound).to_numpy()
+                chunks.append(buffers[shard][complete])
+                buffers[shard] = buffers[shard][~complete]
+                if not exhausted[shard] and len(buffers[shard]) and buffers[shard].position.iloc[-1] == bound:
+                    # the post at the bound may continue in the next chunk
+                    chunk = next(readers[shard], None)
+                    if chunk is None:
+                        exhausted[shard] = True
+                    else:
+                        buffers[shard] = pd.concat([buffers[shard], chunk])
+            chunks = [chunk for chunk in chunks if len(chunk)]
+            if not chunks:
+                continue
+            df = pd.concat(chunks).sort_values("position", kind="mergesort").drop(columns="position")
+            df.index = range(offset, offset + len(df))
+            df.to_csv(f, header=offset == 0)
+            if writer:
+                writer.add(df)
+            offset += len(df)
+        if offset == 0:
+            pd.DataFrame(columns=headers).to_csv(f)
+    if writer:
+        writer.close()
+    print("Merged %d hash shards with %d tokens in the order of %s into %s" %(n_shards, offset, fname, outfile))
+
+def read_posts(fname):
+    posts = pd.read_csv(fname, usecols=["id", "text"])
+
+    # expect 0 here
+    print("%d posts do not have a text" %len(posts[posts.text.isna()]))
+    posts["text"] = posts.text.fillna("")
+    return posts
+
+def tokenise_frame(nlp, posts, batch_size=1000, n_process=1, progress=None):
+    # tokens of the posts (DataFrame with the columns id and text) as one DataFrame with the columns headers
+    processed_posts = []
+    for param in tokenise_posts(nlp, posts["id"], posts["text"], batch_size, n_process):
+        processed_posts.extend(param)
+        if progress is not None:
+            progress.add_rows(1)
     # post id is same for every token in post
     # token id starts with 0 for every post
-    df.columns = headers
-    df.to_csv(fname.split(".")[0] + "_spacy.csv")
+    return pd.DataFrame(processed_posts, columns=headers)
+
+def write_tokens(nlp, posts, outfile, batch_size=1000, n_process=1, progress=None, index=True, table=False,
+                 chunk_tokens=1000000):
+    # tokenises the posts and appends their tokens to outfile whenever chunk_tokens tokens were produced, so that only
+    # one chunk of tokens is held in memory (same file as writing all tokens at once: continuous index over all tokens)
+    # written to a temporary file first, so an interrupted run does not leave an incomplete file behind
+    writer = tt.TokenTableWriter(tt.table_path(outfile)) if table else None
+    processed_posts = []
+    offset = 0
+    with open(outfile + ".tmp", "w", newline="", encoding="utf-8") as f:
+        for param in tokenise_posts(nlp, posts["id"], posts["text"], batch_size, n_process):
+            processed_posts.extend(param)
+            if progress is not None:
+                progress.add_rows(1)
+            if len(processed_posts) >= chunk_tokens:
+                offset = _write_chunk(f, processed_posts, offset, index, writer)
+                processed_posts = []
+        if processed_posts or offset == 0:
+            offset = _write_chunk(f, processed_posts, offset, index, writer)
+    if writer:
+        writer.close()
+    os.replace(outfile + ".tmp", outfile)
+    return offset
+
+def _write_chunk(f, processed_posts, offset, index, writer):
+    df = pd.DataFrame(processed_posts, columns=headers)
+    df.index = range(offset, offset + len(df))
+    df.to_csv(f, header=offset == 0, index=index)
+    if writer and len(df):
+        writer.add(df)
+    return offset + len(df)
+
+def shard_manifest(fname, posts, shard_size, lemmas_only):
+    # fingerprint of the input of the shards: the posts file (size, modification time), its post ids and the settings
+    stat = os.stat(fname)
+    ids = hashlib.sha256(posts.id.to_numpy(dtype=np.int64).tobytes()).hexdigest()
+    return {"posts_file": os.path.abspath(fname), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "ids": ids,
+            "shard_size": shard_size, "lemmas_only": lemmas_only}
+
+def check_shard_manifest(shard_dir, manifest):
+    # the shards of a restarted run are only reused if they were written from the same input
+    manifest_file = os.path.join(shard_dir, "manifest.json")
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            written = json.load(f)
+        if written != manifest:
+            raise ValueError("The shards in %s were written from a different posts file or with other settings, delete "
+                             "the directory to tokenise the posts again" %shard_dir)
+    elif os.path.isdir(shard_dir) and any(fname.startswith("shard_") for fname in os.listdir(shard_dir)):
+        raise ValueError("The shards in %s have no manifest.json, delete the directory to tokenise the posts again"
+                         %shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+def nlp_preprocess_posts(fname, batch_size=1000, n_process=1, shard_size=None, lemmas_only=False, table=False):
+    posts = read_posts(fname)
+
+    # progress (posts/s, estimated time remaining) and metrics of the stage, see instrumentation.py
+    with instrumentation.stage("nlp_preprocess_posts", total=len(posts), posts_file=fname) as progress:
+        nlp = load_pipeline(lemmas_only)
+        outfile = fname.split(".")[0] + "_spacy.csv"
+
+        if shard_size is None:
+            # the tokens are appended to outfile in chunks while the posts are tokenised
+            write_tokens(nlp, posts, outfile, batch_size, n_process, progress, table=table)
+            return
+
+        # write the tokens of every shard_size posts to their own file, so that only one shard is held in memory and a
+        # crashed run can be restarted with the same shard_size: shards that were completely written are skipped
+        shard_dir = fname.split(".")[0] + "_spacy_shards_%d" %shard_size
+        check_shard_manifest(shard_dir, shard_manifest(fname, posts, shard_size, lemmas_only))
+        n_shards = (len(posts) + shard_size - 1) // shard_size
+        for shard in range(n_shards):
+            if os.path.exists(shard_file(shard_dir, shard)):
+                print("Shard %d/%d already processed, skipping" %(shard + 1, n_shards))
+                progress.add_rows(min(shard_size, len(posts) - shard * shard_size))
+                continue
+            shard_posts = posts.iloc[shard * shard_size:(shard + 1) * shard_size]
+            # an interrupted write does not leave an incomplete shard behind
+            write_tokens(nlp, shard_posts, shard_file(shard_dir, shard), batch_size, n_process, progress, index=False)
+            print("Processed shard %d/%d (%d posts)" %(shard + 1, n_shards, min((shard + 1) * shard_size, len(posts))))
+
+        merge_shards(shard_dir, n_shards, outfile, table)
+
+def nlp_preprocess_shard(fname, shard, n_shards, batch_size=1000, n_process=1, lemmas_only=False, nlp=None):
+    # tokenise the posts in hash shard i of n (see sharding.py) into <base>_spacy_hash_shards_<n>/shard_<i>.csv
+    posts = read_posts(fname)
+    posts = posts[sharding.shard_of(posts.id, n_shards) == shard]
+    directory = sharding.shard_dir(fname.split(".")[0] + "_spacy.csv", n_shards)
+    os.makedirs(directory, exist_ok=True)
+    outfile = sharding.shard_file(directory, shard)
+
+    with instrumentation.stage("nlp_preprocess_shard", total=len(posts), shard=shard, n_shards=n_shards) as progress:
+        nlp = nlp or load_pipeline(lemmas_only)
+        # an interrupted write does not leave an incomplete shard behind
+        write_tokens(nlp, posts, outfile, batch_size, n_process, progress, index=False)
+    print("Processed shard %d/%d (%d posts) to %s" %(shard, n_shards, len(posts), outfile))
+    return outfile
+
+def nlp_preprocess_queue(fname, n_shards, batch_size=1000, n_process=1, lemmas_only=False, table=False, lease=None):
+    # process shards from the work queue (shared by all workers that are started with the same posts file and number of
+    # shards) until all are processed, the last worker merges the shards into <base>_spacy.csv
+    outfile = fname.split(".")[0] + "_spacy.csv"
+    directory = sharding.shard_dir(outfile, n_shards)
+    queue = sharding.WorkQueue(os.path.join(directory, "queue"), n_shards, lease)
+    nlp = load_pipeline(lemmas_only)
+    sharding.run_queue(queue, lambda shard: nlp_preprocess_shard(fname, shard, n_shards, batch_size, n_process,
+                                                                 nlp=nlp),
+                       lambda: merge_hash_shards(fname, directory, n_shards, outfile, table))
 
 if __name__ == '__main__':
-    posts_file = sys.argv[1] # c.data + "posts_bd.csv"
-    nlp_preprocess_posts(posts_file)
+    parser = argparse.ArgumentParser(description="tokenise + lemmatise posts with spacy")
+    parser.add_argument("posts_file", help="csv file with the columns id and text, e.g. %sposts_bd.csv" %c.data)
+    parser.add_argument("-b", "--batch_size", help="Number of posts spacy processes at once",
+                        type=int, required=False, default=1000)
+    parser.add_argument("-p", "--n_process", help="Number of processes spacy uses",
+                        type=int, required=False, default=1)
+    parser.add_argument("-s", "--shard_size", help="Write the tokens of this many posts to one shard file at a time "
+                                                   "(restartable); by default the tokens are appended to the output "
+                                                   "in chunks (not restartable)",
+                        type=int, required=False, default=None)
+    parser.add_argument("-l", "--lemmas_only", help="Skip the dependency parser (does not reproduce the dep column "
+                                                    "and the parser's sentence boundaries)",
+                        action="store_true")
+    parser.add_argument("-t", "--table", help="Also write the tokens as a compact token table (see token_table.py)",
+                        action="store_true")
+
+    parser.add_argument("--shard", help="Only process hash shard i of N posts (i/N, see sharding.py)",
+                        type=str, required=False, default=None)
+    parser.add_argument("--queue", help="Process hash shards of N posts from the work queue until all are processed "
+                                        "and merge them (start one worker per machine/process)",
+                        type=int, required=False, default=None)
+    parser.add_argument("--merge", help="Merge the N processed hash shards (in the order of the posts file, same "
+                                        "output as without shards)", type=int, required=False, default=None)
+    parser.add_argument("--lease", help="Work queue: seconds after which a claimed shard that was not processed is "
+                                        "claimed again (crashed worker)",
+                        type=float, required=False, default=None)
+
+    args = parser.parse_args()
+    if args.shard:
+        shard, n_shards = sharding.parse_shard(args.shard)
+        nlp_preprocess_shard(args.posts_file, shard, n_shards, args.batch_size, args.n_process, args.lemmas_only)
+    elif args.queue:
+        nlp_preprocess_queue(args.posts_file, args.queue, args.batch_size, args.n_process, args.lemmas_only, args.table,
+                             args.lease)
+    elif args.merge:
+        outfile = args.posts_file.split(".")[0] + "_spacy.csv"
+        merge_hash_shards(args.posts_file, sharding.shard_dir(outfile, args.merge), args.merge, outfile, args.table)
+    else:
+        nlp_preprocess_posts(args.posts_file, args.batch_size, args.n_process, args.shard_size, args.lemmas_only,
+                             args.table)
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 import pandas as pd
+import sys
 
 import config as c
+import lemma_frequencies as lf
 # select key lemmas from LancsBox output
+# or (mode "native") from lemma frequencies and dispersion computed from the spacy tokens, see lemma_frequencies.py
 
 # nead to read LancsBox output in as text files as they are not properly csv formatted (" not escaped)
 def read_lacsbox_file(fname):
@@ -15,31 +18,54 @@ def read_lacsbox_file(fname):
             lines.append(line.strip().split("\t"))
     return lines
 
-lines_LL = read_lacsbox_file("PR-BD_terms_LL.txt")
-terms_LL = pd.DataFrame(lines_LL, columns=["term", "frequency", "dispersion", "frequency_ref", "dispersion_ref", "LL"])
-terms_LR = pd.DataFrame(read_lacsbox_file("PR-BD_terms_LR.txt"),
-                           columns=["term", "frequency_c", "dispersion_c", "frequency_ref", "dispersion_ref", "LR"])
+def extract_lemma(term):
+    return term.split("_")[0].replace("|", " ")
 
-# merge LR and LL scores
-terms = terms_LL[["term", "frequency", "dispersion", "frequency_ref", "LL"]].\
-                        merge(terms_LR[["term", "LR"]], left_on="term", right_on="term", how="left")
+def read_lancsbox_terms():
+    lines_LL = read_lacsbox_file("PR-BD_terms_LL.txt")
+    terms_LL = pd.DataFrame(lines_LL, columns=["term", "frequency", "dispersion", "frequency_ref", "dispersion_ref", "LL"])
+    terms_LR = pd.DataFrame(read_lacsbox_file("PR-BD_terms_LR.txt"),
+                               columns=["term", "frequency_c", "dispersion_c", "frequency_ref", "dispersion_ref", "LR"])
 
-# preprocess lemmas: i|be_pron|v -> split at first "_", take only first part to remove POS, then replace | by " "
-terms["lemma_pos"] = terms.term
+    # merge LR and LL scores
+    terms = terms_LL[["term", "frequency", "dispersion", "frequency_ref", "LL"]].\
+                            merge(terms_LR[["term", "LR"]], left_on="term", right_on="term", how="left")
 
-def extract_lemma(term):
-    return term.split("_")[0].replace("|", " ")
+    # preprocess lemmas: i|be_pron|v -> split at first "_", take only first part to remove POS, then replace | by " "
+    terms["lemma_pos"] = terms.term
+
+    terms["term"] = terms.term.apply(extract_lemma)
+
+    # convert LancsBox statistics from str to float
+    for col in ["frequency", "dispersion", "frequency_ref", "LL", "LR"]:
+        terms[col] = terms[col].astype(float)
+    return terms
+
+# key lemmas: LL > LL_min & LR >= LR_min & dispersion >= dispersion_min
+LL_min = 15.13
+LR_min = 1.0
+dispersion_min = 5.0
 
-terms["term"] = terms.term.apply(extract_lemma)
+def is_key(LL, LR, dispersion):
+    return (LL > LL_min) & (LR >= LR_min) & (dispersion >= dispersion_min)
 
-# convert LancsBox statistics from str to float
-for col in ["frequency", "dispersion", "frequency_ref", "LL", "LR"]:
-    terms[col] = terms[col].astype(float)
+def select_key_lemmas(terms):
+    key_lemmas = terms[is_key(terms.LL, terms.LR, terms.dispersion)]
 
-key_lemmas = terms[(terms.LL > 15.13) & (terms.LR >= 1.0) & (terms.dispersion >= 5.0)]
+    print("Selected %d key lemmas with LL > %.2f & LR >= %.1f & dispersion >= %.1f" %(len(key_lemmas), LL_min, LR_min,
+                                                                                     dispersion_min))
 
-print("Selected %d key lemmas with LL > 15.13 & LR >= 1.0 & dispersion >= 5.0" %len(key_lemmas))
+    terms.to_csv(c.data + "PR-BD_and_Reference Corpus_terms.csv", index=False)
 
-terms.to_csv(c.data + "PR-BD_and_Reference Corpus_terms.csv", index=False)
+    key_lemmas.to_csv(c.data + "PR-BD Corpus_key_lemmas.csv", index=False)
+    return key_lemmas
 
-key_lemmas.to_csv(c.data + "PR-BD Corpus_key_lemmas.csv", index=False)
\ No newline at end of file
+if __name__ == '__main__':
+    mode = sys.argv[1] if len(sys.argv) > 1 else "lancsbox"
+    if mode == "lancsbox":
+        terms = read_lancsbox_terms()
+    elif mode == "native":
+        terms = lf.lemma_statistics().sort_values("LL", ascending=False)
+    else:
+        sys.exit("Unknown mode %s: lancsbox or native" %mode)
+    select_key_lemmas(terms)
\ No newline at end of file
@@ -1,34 +1,95 @@
 # -*- coding: utf-8 -*-
 
+import os
 import pandas as pd
 import sys
 
 import config as c
+import columnar_store as cs
+import id_index as ix
+import instrumentation
 
-def select_posts(post_ids_file):
-    post_ids = pd.read_csv("post_ids/" + post_ids_file)
-    print("Read in ids of %d posts" %len(post_ids))
+# number of rows read from posts_text.csv/posts_meta.csv at a time - peak RAM depends on this and on the number of
+# selected posts, not on the size of the S-BiDD dataset files
+chunksize = 1000000
+
+def read_csv_selected(fname, ids=None, filters=None, chunksize=chunksize, **kwargs):
+    # read fname once in chunks of chunksize rows and keep only the rows whose id is in ids and that match filters
+    # ids is converted to a set once, so checking each chunk is a hash lookup per row
+    if ids is not None:
+        ids = ids if isinstance(ids, (set, frozenset)) else set(ids)
+    selected = []
+    with instrumentation.stage("read_csv_selected", file=fname) as progress:
+        for chunk in pd.read_csv(fname, chunksize=chunksize, **kwargs):
+            # rows read so far
+            progress.add_rows(len(chunk))
+            if ids is not None:
+                chunk = chunk[chunk.id.isin(ids)]
+            selected.append(cs.apply_filters(chunk, filters))
+        selected = pd.concat(selected, ignore_index=True)
+        progress.fields["selected_rows"] = len(selected)
+    return selected
+
+def read_selected(fname, ids=None, filters=None, **kwargs):
+    # with an id index of fname (see id_index.py) only the rows of the ids are read, otherwise the whole file
+    if ids is not None and ix.available(fname):
+        with instrumentation.stage("read_id_index_selected", file=fname) as progress:
+            selected = cs.apply_filters(ix.IdIndex(fname).read(ids, **kwargs), filters)
+            progress.set_rows(len(selected))
+        return selected
+    return read_csv_selected(fname, ids=ids, filters=filters, **kwargs)
 
-    posts_text = pd.read_csv(c.data + "posts_text.csv", nrows=10000000)
-    posts = posts_text[posts_text.id.isin(post_ids.id)]
-    posts_text_1 = pd.read_csv(c.data + "posts_text.csv", skiprows=10000000, header=None, names=["id", "text"])
-    posts_text_1 = posts_text_1[posts_text_1.id.isin(post_ids.id)]
+def read_posts(table, columns=None, ids=None, filters=None, **csv_kwargs):
+    # read columns of posts_meta/posts_text, only for posts with the given ids and/or matching filters
+    # (list of (column, operator, value) tuples, e.g. [("mentions_bd", "==", True)])
+    # uses the columnar store if it was created with columnar_store.py, otherwise the csv file (and its id index if it
+    # was built with id_index.py)
+    if cs.available(table):
+        # the missing values of the csv file read with csv_kwargs (e.g. "" with keep_default_na=False)
+        return cs.csv_missing_values(cs.read_table(table, columns=columns, ids=ids, filters=filters), **csv_kwargs)
 
-    posts = pd.concat([posts, posts_text_1])
+    usecols = None
+    if columns is not None:
+        usecols = list(columns)
+        for col in (["id"] if ids is not None else []) + [f[0] for f in filters or []]:
+            if col not in usecols:
+                usecols.append(col)
+    posts = read_selected(c.data + table + ".csv", ids=ids, filters=filters, usecols=usecols, **csv_kwargs)
+    return posts if columns is None else posts[list(columns)]
 
-    del(posts_text_1)
+@instrumentation.instrument("select_posts", rows=lambda selected: sum(len(posts) for posts in selected.values()))
+def select_posts_multiple(post_ids_files):
+    # serve several post id files with a single pass over posts_text.csv and posts_meta.csv
+    post_ids = {}
+    for post_ids_file in post_ids_files:
+        # a file name is looked up in post_ids/, a path (e.g. data/<name>_post_ids.csv of text_index.py) as given
+        post_ids[post_ids_file] = pd.read_csv(post_ids_file if os.path.dirname(post_ids_file) else
+                                              c.post_ids + post_ids_file)
+        print("Read in ids of %d posts" %len(post_ids[post_ids_file]))
 
-    posts_meta = pd.read_csv(c.data + "posts_meta.csv")
+    all_ids = set()
+    for ids in post_ids.values():
+        all_ids.update(ids.id)
 
-    posts = posts.merge(posts_meta, left_on="id", right_on="id", how="left")
+    posts_text = read_posts("posts_text", ids=all_ids)
+    posts_meta = read_posts("posts_meta", ids=all_ids)
 
-    print("Selected %d posts from %d ids" %(len(posts), len(post_ids)))
+    selected = {}
+    for post_ids_file, ids in post_ids.items():
+        posts = posts_text[posts_text.id.isin(ids.id)]
+        posts = posts.merge(posts_meta, left_on="id", right_on="id", how="left")
 
-    # remove "post_ids" from filename
-    posts.to_csv(c.data + "_".join(post_ids_file.split("_")[:-2])+ ".csv", index=False)
+        print("Selected %d posts from %d ids" %(len(posts), len(ids)))
 
-    return posts
+        # remove "post_ids" from filename
+        posts.to_csv(c.data + "_".join(os.path.basename(post_ids_file).split("_")[:-2])+ ".csv", index=False)
+        selected[post_ids_file] = posts
+
+    return selected
+
+def select_posts(post_ids_file):
+    return select_posts_multiple([post_ids_file])[post_ids_file]
 
 if __name__ == '__main__':
-    post_ids_file = sys.argv[1]
-    select_posts(post_ids_file)
\ No newline at end of file
+    post_ids_files = sys.argv[1:]
+    select_posts_multiple(post_ids_files)
\ No newline at end of file
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# shard mode of process_posts_with_spacy.py and PR_scoring.py
+# the post ids are partitioned into n shards by a hash of the id (same partition on every machine), each shard is
+# processed independently into its own file and the shard files are merged in shard order
+# shards are coordinated by a work queue of lock files in a directory on shared storage: a worker claims a shard by
+# creating shard_<i>.lock (atomic, fails if another worker created it first) and marks it as processed by creating
+# shard_<i>.done; workers on several machines/containers can pull shards from the same queue
+# the worker that finds all shards processed first claims the merge (merge.lock, removed when the merge finished or
+# failed, so that running the queue again merges again); a lock left behind by a crashed worker is reported, with a
+# lease it expires like the lock of a shard
+
+import os
+import socket
+import time
+
+import numpy as np
+
+def parse_shard(shard):
+    # "i/N" -> (i, N), shards are numbered 0 to N - 1
+    i, n_shards = (int(part) for part in shard.split("/"))
+    if not 0 <= i < n_shards:
+        raise ValueError("Shard %s: i must be between 0 and N - 1" %shard)
+    return i, n_shards
+
+def mix(ids):
+    # splitmix64 finaliser of each id (uint64), consecutive ids get unrelated values
+    x = np.asarray(ids).astype(np.uint64)
+    with np.errstate(over="ignore"):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        x = x ^ (x >> np.uint64(31))
+    return x
+
+def shard_of(ids, n_shards):
+    # shard of each post id (mixed, so consecutive ids are spread over all shards)
+    return (mix(ids) % np.uint64(n_shards)).astype(np.int64)
+
+def shard_dir(outfile, n_shards):
+    # data/posts_bd_spacy.csv -> data/posts_bd_spacy_hash_shards_<n_shards>/
+    return outfile.split(".")[0] + "_hash_shards_%d/" %n_shards
+
+def shard_file(directory, shard, extension="csv"):
+    return os.path.join(directory, "shard_%05d.%s" %(shard, extension))
+
+def worker_id():
+    return "%s:%d" %(socket.gethostname(), os.getpid())
+
+class WorkQueue(object):
+
+    def __init__(self, directory, n_shards, lease=None):
+        # lease: seconds after which the lock of a shard that is not done is considered stale (crashed worker) and the
+        # shard can be claimed again; must be longer than processing a shard takes; None: locks never expire
+        self.directory = directory
+        self.n_shards = n_shards
+        self.lease = lease
+        os.makedirs(directory, exist_ok=True)
+
+    def _file(self, name):
+        return os.path.join(self.directory, name)
+
+    def _lock(self, name):
+        # atomic: only one worker can create the lock file
+        try:
+            fd = os.open(self._file(name), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self._steal(name):
+                return False
+            return self._lock(name)
+        with os.fdopen(fd, "w") as f:
+            f.write(worker_id())
+        return True
+
+    def _steal(self, name):
+        # removes a stale lock, only one worker can rename it
+        if self.lease is None:
+            return False
+        try:
+            if time.time() - os.path.getmtime(self._file(name)) < self.lease:
+                return False
+            os.rename(self._file(name), self._file("%s.stale-%s" %(name, worker_id())))
+        except OSError:
+            return False
+        print("Lock %s expired, claiming it again" %name)
+        return True
+
+    def is_done(self, shard):
+        return os.path.exists(self._file("shard_%05d.done" %shard))
+
+    def pending(self):
+        return [shard for shard in range(self.n_shards) if not self.is_done(shard)]
+
+    def all_done(self):
+        return not self.pending()
+
+    def claim(self):
+        # next shard that is neither done nor claimed by another worker, None if there is none
+        for shard in self.pending():
+            if self._lock("shard_%05d.lock" %shard):
+                # the shard may have been completed between pending() and claiming it
+                if self.is_done(shard):
+                    continue
+                return shard
+        return None
+
+    def done(self, shard):
+        with open(self._file("shard_%05d.done" %shard), "w") as f:
+            f.write(worker_id())
+
+    def claim_merge(self):
+        return self.all_done() and self._lock("merge.lock")
+
+    def release_merge(self):
+        os.remove(self._file("merge.lock"))
+
+    def locks(self):
+        # lock file -> worker of the locks that are held (shards not done, merge)
+        names = ["shard_%05d.lock" %shard for shard in self.pending()] + ["merge.lock"]
+        locks = {}
+        for name in names:
+            try:
+                with open(self._file(name)) as f:
+                    locks[name] = f.read()
+            except OSError:
+                pass
+        return locks
+
+def _report_locks(queue):
+    locks = queue.locks()
+    if locks:
+        print("Held by other workers (or left behind by a crashed worker): %s" %", ".join(
+            "%s (%s)" %(name, worker) for name, worker in sorted(locks.items())))
+        if queue.lease is None:
+            print("Locks do not expire without --lease: delete the lock files in %s to process the shards again"
+                  %queue.directory)
+
+def run_queue(queue, process_shard, merge):
+    # processes shards from the queue until none is left, the worker that claims the merge then runs merge()
+    # returns True if this worker merged the shards
+    processed = []
+    while True:
+        shard = queue.claim()
+        if shard is None:
+            break
+        print("%s processing shard %d/%d" %(worker_id(), shard, queue.n_shards))
+        process_shard(shard)
+        queue.done(shard)
+        processed.append(shard)
+    print("%s processed %d shards, %d shards pending" %(worker_id(), len(processed), len(queue.pending())))
+    if not queue.claim_merge():
+        _report_locks(queue)
+        return False
+    try:
+        merge()
+    finally:
+        queue.release_merge()
+    return True
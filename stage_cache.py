@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# runs pipeline steps and caches their output (pickled) under a fingerprint of everything the step depends on:
+# the contents of its input files (ids, term lists, code), its parameters (e.g. the random seed) and the fingerprint of
+# the step whose output it receives - a step whose fingerprint matches a cached output is skipped
+# large data files (posts_meta.csv, posts_text.csv) are fingerprinted by size and modification time instead of content,
+# directories (e.g. the columnar store) by the size and modification time of their files
+# the files a step writes (outputs) are checked too: if one of them was deleted, the step is run again
+# reports wall time and peak memory per step (see instrumentation.py, which also emits the json events of the steps)
+
+import hashlib
+import json
+import os
+import pickle
+import time
+
+import instrumentation
+
+# files larger than this are fingerprinted by size and modification time
+max_content_hash_size = 100 * 1024 * 1024
+
+def _hash_file(path, h):
+    if not os.path.exists(path):
+        # e.g. the columnar store if it was not created
+        h.update(b"missing")
+        return
+    if os.path.isdir(path):
+        for root, dirs, fnames in sorted(os.walk(path)):
+            dirs.sort()
+            for fname in sorted(fnames):
+                stat = os.stat(os.path.join(root, fname))
+                h.update(("%s:%d:%d" %(os.path.relpath(os.path.join(root, fname), path), stat.st_size,
+                                       stat.st_mtime_ns)).encode("utf-8"))
+        return
+    stat = os.stat(path)
+    if stat.st_size > max_content_hash_size:
+        h.update(("%s:%d:%d" %(os.path.basename(path), stat.st_size, stat.st_mtime_ns)).encode("utf-8"))
+    else:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+
+class StageCache(object):
+
+    def __init__(self, cache_dir, enabled=True):
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.report = []
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def fingerprint(self, name, files=(), params=None, upstream=None):
+        h = hashlib.sha256(name.encode("utf-8"))
+        for path in files:
+            h.update(path.encode("utf-8"))
+            _hash_file(path, h)
+        h.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+        h.update((upstream or "").encode("utf-8"))
+        return h.hexdigest()[:16]
+
+    def run(self, name, function, args=(), files=(), params=None, upstream=None, outputs=()):
+        # returns the output of function(*args) and its fingerprint (pass as upstream to the steps that use the output)
+        # outputs: files written by function, the cached output is only used if they all exist
+        key = self.fingerprint(name, files, params, upstream)
+        path = os.path.join(self.cache_dir, "%s_%s.pkl" %(name, key))
+        missing = [fname for fname in outputs if not os.path.exists(fname)]
+        cached = self.enabled and os.path.exists(path) and not missing
+        if self.enabled and os.path.exists(path) and missing:
+            print("%s: output %s is missing, running the step again" %(name, ", ".join(missing)))
+        with instrumentation.stage(name, cached=cached, fingerprint=key) as stage:
+            if cached:
+                print("%s: inputs unchanged, loading cached output %s" %(name, path))
+                with open(path, "rb") as f:
+                    result = pickle.load(f)
+            else:
+                result = function(*args)
+                # remove outputs of previous versions of the step
+                for fname in os.listdir(self.cache_dir):
+                    if fname.startswith(name + "_") and fname.endswith(".pkl"):
+                        os.remove(os.path.join(self.cache_dir, fname))
+                with open(path + ".tmp", "wb") as f:
+                    pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(path + ".tmp", path)
+            if hasattr(result, "__len__"):
+                stage.set_rows(len(result))
+        self.report.append({"step": name, "status": "cached" if cached else "run", "fingerprint": key,
+                            "seconds": time.time() - stage.start, "peak_memory_mb": stage.peak})
+        return result, key
+
+    def print_report(self):
+        print("%-25s %-7s %10s %16s" %("step", "status", "time (s)", "peak memory (MB)"))
+        for step in self.report:
+            print("%-25s %-7s %10.1f %16.0f" %(step["step"], step["status"], step["seconds"], step["peak_memory_mb"]))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# full-text index of posts_text.csv (SQLite FTS5), built once, to select posts by term or substring without scanning
+# all post texts (e.g. LOWER(texts.text) LIKE '%recover%' in exploratory_study_2/select_recover_posts.sql)
+# two contentless FTS5 tables, the rowid is the post id:
+# - posts_words: words (unicode61 tokenizer) for term queries, e.g. the terms of recover_content_terms.csv or
+#   PR_terms.csv, a term with several words matches them as a phrase
+# - posts_trigrams: trigrams for substring queries (at least 3 characters), e.g. recover
+# both are not case-sensitive
+# the selected post ids are written as data/<name>_post_ids.csv (post_ids/ only holds the published post ids, e.g.
+# post_ids/posts_contain_recover_post_ids.csv of exploratory_study_2 to compare them with)
+#
+# build the index (data/posts_text_fts.sqlite):
+#   python text_index.py build
+# posts that contain "recover" (in any word), only English posts:
+#   python text_index.py query -s recover -l en -o posts_contain_recover_post_ids.csv
+# posts that contain at least one of the terms in a csv file (column "term"):
+#   python text_index.py query -f exploratory_study_2/recover_content_terms.csv -o posts_contain_recover_content_term_post_ids.csv
+
+import argparse
+import os
+import sqlite3
+import time
+
+import pandas as pd
+
+import config as c
+import select_posts_via_ids as sp
+
+index_file = c.data + "posts_text_fts.sqlite"
+
+def connect(fname=index_file):
+    if not os.path.exists(fname):
+        raise FileNotFoundError("%s does not exist, build it with python text_index.py build" %fname)
+    return sqlite3.connect(fname)
+
+def build(fname=index_file, chunksize=sp.chunksize):
+    # written to a temporary file that replaces the previous index when complete
+    tmp_file = fname + ".tmp"
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    conn = sqlite3.connect(tmp_file)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("CREATE VIRTUAL TABLE posts_words USING fts5(text, content='', tokenize='unicode61 remove_diacritics 0')")
+    conn.execute("CREATE VIRTUAL TABLE posts_trigrams USING fts5(text, content='', tokenize='trigram')")
+
+    n_posts = 0
+    start = time.time()
+    for posts in pd.read_csv(c.data + "posts_text.csv", usecols=["id", "text"], chunksize=chunksize,
+                             keep_default_na=False, na_filter=False):
+        rows = list(zip(posts.id.tolist(), posts.text.tolist()))
+        with conn:
+            conn.executemany("INSERT INTO posts_words(rowid, text) VALUES (?, ?)", rows)
+            conn.executemany("INSERT INTO posts_trigrams(rowid, text) VALUES (?, ?)", rows)
+        n_posts += len(posts)
+        print("Indexed %d posts (%.0f s)" %(n_posts, time.time() - start))
+
+    with conn:
+        for table in ["posts_words", "posts_trigrams"]:
+            conn.execute("INSERT INTO %s(%s) VALUES ('optimize')" %(table, table))
+    conn.close()
+    os.replace(tmp_file, fname)
+    print("Wrote full-text index of %d posts to %s" %(n_posts, fname))
+
+def _phrase(text):
+    # FTS5 string: matches the words (posts_words) or characters (posts_trigrams) of text in this order
+    return '"%s"' %text.replace('"', '""')
+
+def term_ids(conn, term):
+    # ids of the posts that contain term (one or more words)
+    return [row[0] for row in conn.execute("SELECT rowid FROM posts_words WHERE posts_words MATCH ?", (_phrase(term),))]
+
+def substring_ids(conn, substring):
+    # ids of the posts whose text contains substring
+    if len(substring) < 3:
+        raise ValueError("Substring queries need at least 3 characters: %s" %substring)
+    return [row[0] for row in conn.execute("SELECT rowid FROM posts_trigrams WHERE posts_trigrams MATCH ?",
+                                           (_phrase(substring),))]
+
+def select_ids(terms=(), substrings=(), lang=None, fname=index_file):
+    # sorted ids of the posts that contain at least one of the terms or substrings
+    # lang: only posts in this language (lang column of posts_meta)
+    conn = connect(fname)
+    ids = set()
+    for term in terms:
+        ids.update(term_ids(conn, term))
+    for substring in substrings:
+        ids.update(substring_ids(conn, substring))
+    conn.close()
+    ids = sorted(ids)
+    if lang is not None:
+        ids = sp.read_posts("posts_meta", columns=["id"], ids=ids, filters=[("lang", "==", lang)]).id.sort_values().tolist()
+    return ids
+
+def write_post_ids(ids, post_ids_file):
+    pd.DataFrame({"id": ids}).to_csv(c.data + post_ids_file, index=False)
+    print("Wrote %d post ids to %s" %(len(ids), c.data + post_ids_file))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Full-text index of posts_text.csv")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="Build the index from posts_text.csv")
+    query = subparsers.add_parser("query", help="Write the ids of the posts that contain the terms/substrings")
+    query.add_argument("-t", "--terms", nargs="+", default=[], help="Terms (words or phrases)")
+    query.add_argument("-f", "--terms_file", help="csv file with a term column, e.g. PR_terms.csv")
+    query.add_argument("-s", "--substrings", nargs="+", default=[], help="Substrings (at least 3 characters)")
+    query.add_argument("-l", "--lang", help="Only posts in this language, e.g. en")
+    query.add_argument("-o", "--outfile", required=True, help="Post ids file written to data/")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build()
+    else:
+        terms = list(args.terms)
+        if args.terms_file:
+            terms += pd.read_csv(args.terms_file, keep_default_na=False, na_filter=False).term.tolist()
+        start = time.time()
+        ids = select_ids(terms, args.substrings, args.lang)
+        print("Selected %d posts in %.3f s" %(len(ids), time.time() - start))
+        write_post_ids(ids, args.outfile)
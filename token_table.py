@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+# compact, memory-mappable alternative to the *_spacy.csv token files written by process_posts_with_spacy.py
+# the token table for data/posts_bd_spacy.csv is the directory data/posts_bd_spacy_tokens/ with one .npy file per column:
+# - text, lemma, pos, tag, dep, shape: integer codes into a vocabulary (<column>_vocab.bin with the utf-8 encoded
+#   strings and <column>_vocab_offsets.npy with the start of each string)
+# - is_alpha, is_stop: bit-packed (np.packbits)
+# - sentence_id, token_id: int32
+# - post_ids + offsets: the tokens of post_ids[i] are the rows offsets[i]:offsets[i + 1]
+# all arrays are opened with mmap_mode="r", so reading the tokens of a post does not load or copy the whole table
+# VocabularyIndex.from_table adds text_index_* files: the rows of each unique lowercased token text
+
+import fnmatch
+import json
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+string_columns = ["text", "lemma", "pos", "tag", "dep", "shape"]
+flag_columns = ["is_alpha", "is_stop"]
+columns = ["post_id", "sentence_id", "token_id"] + string_columns + flag_columns
+
+def table_path(spacy_csv):
+    # data/posts_bd_spacy.csv -> data/posts_bd_spacy_tokens/
+    return spacy_csv[:-len(".csv")] + "_tokens/" if spacy_csv.endswith(".csv") else spacy_csv
+
+def exists(spacy_csv):
+    return os.path.exists(os.path.join(table_path(spacy_csv), "meta.json"))
+
+def _write_strings(path, values):
+    # utf-8 encoded strings in <path>.bin, start of each string in <path>_offsets.npy
+    encoded = [value.encode("utf-8") for value in values]
+    with open(path + ".bin", "wb") as f:
+        f.write(b"".join(encoded))
+    np.save(path + "_offsets.npy", np.cumsum([0] + [len(value) for value in encoded], dtype=np.int64))
+
+def _read_strings(path):
+    with open(path + ".bin", "rb") as f:
+        data = f.read()
+    offsets = np.load(path + "_offsets.npy")
+    return [data[start:end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+
+class TokenTableWriter(object):
+    # add tokens as DataFrames with the columns of *_spacy.csv (in post order, all tokens of a post consecutive)
+
+    def __init__(self, path):
+        self.path = path
+        self.vocabs = {col: {} for col in string_columns}
+        self.chunks = {col: [] for col in ["post_id", "sentence_id", "token_id"] + string_columns + flag_columns}
+
+    def _encode(self, col, values):
+        vocab = self.vocabs[col]
+        for value in pd.unique(values):
+            if value not in vocab:
+                vocab[value] = len(vocab)
+        return values.map(vocab).to_numpy(dtype=np.int32)
+
+    def add(self, tokens):
+        self.chunks["post_id"].append(tokens.post_id.to_numpy(dtype=np.int64))
+        for col in ["sentence_id", "token_id"]:
+            self.chunks[col].append(tokens[col].to_numpy(dtype=np.int32))
+        for col in string_columns:
+            self.chunks[col].append(self._encode(col, tokens[col].astype(str)))
+        for col in flag_columns:
+            self.chunks[col].append(tokens[col].astype(str).isin(["True", "true", "1"]).to_numpy())
+
+    def close(self):
+        os.makedirs(self.path, exist_ok=True)
+        # indexes of a previous version of the table (see VocabularyIndex.from_table) are out of date
+        for fname in os.listdir(self.path):
+            if "_index_" in fname:
+                os.remove(os.path.join(self.path, fname))
+        post_id = np.concatenate(self.chunks["post_id"]) if self.chunks["post_id"] else np.zeros(0, dtype=np.int64)
+        n_tokens = len(post_id)
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(post_id)) + 1]) if n_tokens else np.zeros(0, dtype=np.int64)
+        post_ids = post_id[starts]
+        if len(np.unique(post_ids)) != len(post_ids):
+            raise ValueError("The tokens of each post need to be consecutive")
+        np.save(os.path.join(self.path, "post_ids.npy"), post_ids)
+        np.save(os.path.join(self.path, "offsets.npy"), np.append(starts, n_tokens).astype(np.int64))
+
+        for col in ["sentence_id", "token_id"] + string_columns:
+            np.save(os.path.join(self.path, "%s.npy" %col),
+                    np.concatenate(self.chunks[col]) if n_tokens else np.zeros(0, dtype=np.int32))
+        for col in flag_columns:
+            np.save(os.path.join(self.path, "%s.npy" %col),
+                    np.packbits(np.concatenate(self.chunks[col]) if n_tokens else np.zeros(0, dtype=bool)))
+        for col in string_columns:
+            _write_strings(os.path.join(self.path, "%s_vocab" %col), self.vocabs[col])
+
+        # written last: a table without meta.json is incomplete
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump({"n_tokens": n_tokens, "n_posts": len(post_ids)}, f)
+        print("Wrote %d tokens of %d posts to %s" %(n_tokens, len(post_ids), self.path))
+
+class TokenTable(object):
+
+    def __init__(self, path):
+        self.path = table_path(path)
+        with open(os.path.join(self.path, "meta.json")) as f:
+            self.n_tokens = json.load(f)["n_tokens"]
+        self.post_ids = self._load("post_ids")
+        self.offsets = self._load("offsets")
+        self._vocabs = {}
+        self._flags = {}
+        self._post_order = None
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, "%s.npy" %name), mmap_mode="r")
+
+    def codes(self, col):
+        return self._load(col)
+
+    def vocab(self, col):
+        # decoded once per column, the vocabularies are small compared to the number of tokens
+        if col not in self._vocabs:
+            self._vocabs[col] = _read_strings(os.path.join(self.path, "%s_vocab" %col))
+        return self._vocabs[col]
+
+    def flags(self, col):
+        if col not in self._flags:
+            self._flags[col] = np.unpackbits(self._load(col), count=self.n_tokens).astype(bool)
+        return self._flags[col]
+
+    def post_rows(self, post_id):
+        # binary search in the sorted post ids
+        if self._post_order is None:
+            self._post_order = np.argsort(self.post_ids, kind="stable")
+        i = np.searchsorted(self.post_ids, post_id, sorter=self._post_order)
+        if i == len(self.post_ids) or self.post_ids[self._post_order[i]] != post_id:
+            raise KeyError(post_id)
+        i = self._post_order[i]
+        return self.offsets[i], self.offsets[i + 1]
+
+    def post_tokens(self, post_id, cols=string_columns):
+        # zero-copy views of the codes of the tokens of one post, decode with vocab(col)
+        start, end = self.post_rows(post_id)
+        return {col: self.codes(col)[start:end] for col in cols}
+
+    def lemma_texts(self, lowercase=True):
+        # yields (post id, lemmas joined by " ") in the order of the posts in the table
+        lemmas = self.vocab("lemma")
+        if lowercase:
+            lemmas = [lemma.lower() for lemma in lemmas]
+        codes = self.codes("lemma")
+        for post_id, start, end in zip(self.post_ids.tolist(), self.offsets[:-1].tolist(), self.offsets[1:].tolist()):
+            yield post_id, " ".join([lemmas[code] for code in codes[start:end].tolist()])
+
+    def to_frame(self, cols=None):
+        # same columns as reading the *_spacy.csv file with keep_default_na=False
+        tokens = pd.DataFrame()
+        for col in cols or columns:
+            if col == "post_id":
+                tokens[col] = np.repeat(np.asarray(self.post_ids), np.diff(self.offsets))
+            elif col in string_columns:
+                tokens[col] = np.asarray(self.vocab(col), dtype=object)[self.codes(col)]
+            elif col in flag_columns:
+                tokens[col] = self.flags(col)
+            else:
+                tokens[col] = np.asarray(self.codes(col))
+        return tokens
+
+class VocabularyIndex(object):
+    # lowercased vocabulary of a token column with the rows of each term (postings): rows[offsets[i]:offsets[i + 1]]
+    # are the (ascending) rows of the tokens whose lowercased text is terms[i]
+    # term queries, including wildcard queries such as *recover*, are run against the unique terms instead of all rows
+
+    def __init__(self, terms, rows, offsets, row_post_ids):
+        self.terms = terms
+        self.rows = rows
+        self.offsets = offsets
+        # function that maps an array of rows to the post ids of the rows
+        self.row_post_ids = row_post_ids
+        self._term_index = None
+
+    @staticmethod
+    def _postings(vocab, codes):
+        # vocab: the unique strings of the column, codes: index into vocab per row
+        # lowercases each unique string once, not every row
+        lower_codes, terms = pd.factorize(pd.Series([value.lower() for value in vocab], dtype=object))
+        codes = lower_codes[np.asarray(codes)] if len(vocab) else np.zeros(0, dtype=np.int64)
+        rows = np.argsort(codes, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(terms)))]).astype(np.int64)
+        return list(terms), rows, offsets
+
+    @classmethod
+    def from_series(cls, values, post_ids):
+        # index of a column of a DataFrame, rows are positions in the DataFrame
+        codes, vocab = pd.factorize(values)
+        post_ids = np.asarray(post_ids)
+        return cls(*cls._postings(list(vocab), codes), lambda rows: post_ids[rows])
+
+    @classmethod
+    def from_table(cls, table, col="text"):
+        # index of a column of a token table, built on first use and stored in the table directory
+        # rows are the rows of the table (and of TokenTable.to_frame())
+        if not isinstance(table, TokenTable):
+            table = TokenTable(table)
+        path = os.path.join(table.path, "%s_index" %col)
+        if os.path.exists(path + "_offsets.npy"):
+            terms = _read_strings(path + "_terms")
+            rows = np.load(path + "_rows.npy", mmap_mode="r")
+            offsets = np.load(path + "_offsets.npy")
+        else:
+            terms, rows, offsets = cls._postings(table.vocab(col), table.codes(col))
+            _write_strings(path + "_terms", terms)
+            np.save(path + "_rows.npy", rows)
+            # written last: an index without offsets is incomplete
+            np.save(path + "_offsets.npy", offsets)
+            print("Indexed %d unique lowercased %s values of %s" %(len(terms), col, table.path))
+        post_ids = table.post_ids
+        table_offsets = table.offsets
+        return cls(terms, rows, offsets,
+                   lambda rows: np.asarray(post_ids)[np.searchsorted(table_offsets, rows, side="right") - 1])
+
+    def match(self, pattern):
+        # indices of the terms that match a wildcard pattern (* matches any characters), not case-sensitive
+        regex = re.compile(fnmatch.translate(pattern.lower()))
+        return np.array([i for i, term in enumerate(self.terms) if regex.match(term)], dtype=np.int64)
+
+    def lookup(self, terms):
+        # indices of the given terms (not case-sensitive), terms that do not occur are ignored
+        if self._term_index is None:
+            self._term_index = {term: i for i, term in enumerate(self.terms)}
+        indices = [self._term_index.get(term.lower()) for term in terms]
+        return np.array(sorted(set(i for i in indices if i is not None)), dtype=np.int64)
+
+    def term_rows(self, indices):
+        # ascending rows of the tokens of the given terms
+        if len(indices) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.concatenate([self.rows[self.offsets[i]:self.offsets[i + 1]] for i in indices]))
+
+    def post_ids(self, indices):
+        # ids of the posts that contain at least one of the given terms
+        return np.unique(self.row_post_ids(self.term_rows(indices)))
+
+    def frequencies(self, indices, post_ids=None):
+        # frequency of the given terms (optionally only in the given posts), most frequent first
+        counts = []
+        for i in indices:
+            rows = self.rows[self.offsets[i]:self.offsets[i + 1]]
+            if post_ids is not None:
+                rows = rows[np.isin(self.row_post_ids(rows), post_ids)]
+            counts.append(len(rows))
+        terms = pd.DataFrame({"term": [self.terms[i] for i in indices], "frequency": counts}, columns=["term", "frequency"])
+        terms = terms[terms.frequency > 0].sort_values("frequency", ascending=False, kind="mergesort")
+        return terms.reset_index(drop=True)
+
+def read_tokens(spacy_csv, cols=None):
+    # read the tokens from the token table if it exists, otherwise from the csv file
+    if exists(spacy_csv):
+        return TokenTable(spacy_csv).to_frame(cols)
+    return pd.read_csv(spacy_csv, keep_default_na=False, na_filter=False, usecols=cols)
+
+def convert(spacy_csv, chunksize=1000000):
+    writer = TokenTableWriter(table_path(spacy_csv))
+    for tokens in pd.read_csv(spacy_csv, keep_default_na=False, na_filter=False, chunksize=chunksize,
+                              usecols=columns, dtype={col: str for col in string_columns}):
+        writer.add(tokens)
+    writer.close()
+
+if __name__ == '__main__':
+    # convert existing *_spacy.csv files, e.g. python token_table.py data/posts_bd_spacy.csv
+    for spacy_csv in sys.argv[1:]:
+        convert(spacy_csv)